@@ -9,103 +9,279 @@ import glob
 import asyncio
 import time
 import json
-import base64
 import uuid
+import base64
+import hashlib
+import random
+import resource
 import traceback
+import weakref
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import List, Optional
-from fastapi import FastAPI, HTTPException
+from typing import List, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import StreamingResponse, FileResponse, Response
 from pydantic import BaseModel, Field
 from google import genai
 from google.genai import types
 from dotenv import load_dotenv
-from PIL import Image
-from io import BytesIO
+from PIL import features
+from story_stream import StoryStreamParser
+from image_processing import ImageProcessor, ler_transformacao
+from reference_photos import ReferencePhotoCache, PhotoStore, PhotoTooLargeError, ReferenceSet, ReferenceMemory
+from story_index import StoryIndex, InvalidCursorError, REQUIRED_IMAGES, story_is_complete
+from jobs import JobStore, JobEventLog, JobWorker
+from hedging import LatencyTracker, HedgePolicy, hedged
+from metrics import MetricsRegistry, monitor_event_loop
+from story_log import LogWriter
+from image_variants import VariantCache, VARIANT_FORMATS, negociar_formato, escolher_largura
+from http_cache import (
+    StoryStaticFiles, EncodedBodyCache, CACHE_REVALIDATE, escolher_codificacao, etag_fraco,
+    nao_modificado, gravar_copias_comprimidas, copia_comprimida
+)
+from scheduler import GenerationScheduler, AimdController, is_quota_error, retry_after_hint
+from gemini_batch import BatchDispatcher
+from circuit_breaker import ModelChain
 
 load_dotenv()  # Tenta local primeiro
 load_dotenv(dotenv_path="../.env")  # Tenta pasta pai (Scripts)
 
 # === CONFIGURAÇÃO DE MODELOS ===
-GEMINI_TEXT_MODEL = os.getenv("GEMINI_TEXT_MODEL", "gemini-3-flash-preview")
-GEMINI_IMAGE_MODEL = os.getenv("GEMINI_IMAGE_MODEL", "gemini-3-pro-image-preview")
+# Listas em ordem de preferência, separadas por vírgula: com o circuito do
+# primeiro aberto, as chamadas vão para o seguinte (ver circuit_breaker.py)
+GEMINI_TEXT_MODELS = [m.strip() for m in os.getenv("GEMINI_TEXT_MODEL", "gemini-3-flash-preview").split(",") if m.strip()]
+GEMINI_IMAGE_MODELS = [m.strip() for m in os.getenv("GEMINI_IMAGE_MODEL", "gemini-3-pro-image-preview").split(",") if m.strip()]
+GEMINI_TEXT_MODEL = GEMINI_TEXT_MODELS[0]    # Preferidos
+GEMINI_IMAGE_MODEL = GEMINI_IMAGE_MODELS[0]
+
+# Circuit breaker por modelo: abre quando, nos últimos BREAKER_WINDOW_SECONDS e com
+# pelo menos BREAKER_MIN_CALLS chamadas, a fração de erros passa de BREAKER_ERROR_RATE
+# ou a de chamadas mais lentas que *_SLOW_CALL_SECONDS passa de BREAKER_SLOW_RATE.
+# Aberto, o modelo fica fora por BREAKER_OPEN_SECONDS; depois, BREAKER_HALF_OPEN_CALLS
+# chamadas de teste decidem se ele volta
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_RATE = float(os.getenv("BREAKER_SLOW_RATE", "0.5"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "8"))
+BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", "60"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+BREAKER_HALF_OPEN_CALLS = int(os.getenv("BREAKER_HALF_OPEN_CALLS", "2"))
+TEXT_SLOW_CALL_SECONDS = float(os.getenv("TEXT_SLOW_CALL_SECONDS", "90"))
+IMAGE_SLOW_CALL_SECONDS = float(os.getenv("IMAGE_SLOW_CALL_SECONDS", "120"))
+
+# "gemini" = API real; "fake" = respostas simuladas locais (benchmark.py)
+GEMINI_BACKEND = os.getenv("GEMINI_BACKEND", "gemini").lower()
+
+# Modo batch (só na geração em lote, python batch.py --batch-api): as chamadas
+# viram batch jobs do Gemini, mais baratos e fora da cota interativa. Um lote
+# fecha com BATCH_MAX_REQUESTS pedidos, BATCH_MAX_MB de pedidos inline ou
+# BATCH_MAX_WAIT_SECONDS após o primeiro; os jobs são consultados a cada
+# BATCH_POLL_SECONDS. BATCH_DEADLINE_SECONDS substitui os prazos por etapa
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "100"))
+BATCH_MAX_MB = float(os.getenv("BATCH_MAX_MB", "16"))
+BATCH_MAX_WAIT_SECONDS = float(os.getenv("BATCH_MAX_WAIT_SECONDS", "10"))
+BATCH_POLL_SECONDS = float(os.getenv("BATCH_POLL_SECONDS", "30"))
+BATCH_DEADLINE_SECONDS = float(os.getenv("BATCH_DEADLINE_SECONDS", "86400"))
+
+# Streaming do texto: as imagens começam assim que seus prompts chegam
+STORY_STREAMING = os.getenv("STORY_STREAMING", "true").lower() in ("1", "true", "sim")
+
+# === PRAZOS POR ETAPA (segundos) ===
+# Contam desde o início da etapa (incluindo fila e retries); uma nova tentativa
+# só começa se ainda couber no prazo. O prazo da história limita os demais.
+TEXT_DEADLINE_SECONDS = float(os.getenv("TEXT_DEADLINE_SECONDS", "180"))
+IMAGE_DEADLINE_SECONDS = float(os.getenv("IMAGE_DEADLINE_SECONDS", "300"))
+STORY_DEADLINE_SECONDS = float(os.getenv("STORY_DEADLINE_SECONDS", "900"))
+
+# === CONFIGURAÇÃO DO AGENDADOR GLOBAL ===
+# Máximo de chamadas simultâneas ao Gemini no processo (somando todas as histórias)
+MAX_IMAGE_CALLS_IN_FLIGHT = int(os.getenv("MAX_IMAGE_CALLS_IN_FLIGHT", "8"))
+MAX_TEXT_CALLS_IN_FLIGHT = int(os.getenv("MAX_TEXT_CALLS_IN_FLIGHT", "4"))
+
+# Controle adaptativo (AIMD): erros 429 reduzem o limite, sucessos o recuperam aos poucos
+AIMD_MIN_LIMIT = int(os.getenv("AIMD_MIN_LIMIT", "1"))
+AIMD_INCREASE = float(os.getenv("AIMD_INCREASE", "1"))       # +N vagas por "rodada" de sucessos
+AIMD_DECREASE = float(os.getenv("AIMD_DECREASE", "0.5"))     # Fator multiplicativo no 429
+AIMD_COOLDOWN = float(os.getenv("AIMD_COOLDOWN", "5"))       # Segundos entre reduções
+
+# Hedging das chamadas de imagem: se uma chamada passa do percentil HEDGE_PERCENTILE
+# das latências recentes do modelo, uma cópia é disparada e a primeira resposta vence.
+# HEDGE_MAX_FRACTION limita a fração de chamadas duplicadas (cota extra).
+IMAGE_HEDGING = os.getenv("IMAGE_HEDGING", "false").lower() in ("1", "true", "sim")
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.9"))
+HEDGE_MAX_FRACTION = float(os.getenv("HEDGE_MAX_FRACTION", "0.05"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+
+# Token opcional para os endpoints /api/admin (vazio = sem proteção)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
 
 # === CONFIGURAÇÃO DE VALIDAÇÃO DE IMAGENS ===
 MAX_IMAGE_SIZE_MB = 10  # Tamanho máximo por imagem em MB
-MAX_IMAGE_DIMENSION = 2048  # Dimensão máxima (largura ou altura)
+MAX_UPLOAD_FILES = 5    # Fotos por requisição de upload
+# Corpo máximo de um upload (as fotos mais a sobra do multipart), checado pelo
+# Content-Length antes de ler qualquer byte
+MAX_UPLOAD_BODY = MAX_UPLOAD_FILES * MAX_IMAGE_SIZE_MB * 1024 * 1024 + 64 * 1024
+# Fotos de referência como vão ao modelo de imagem: lado maior (px) e qualidade
+# do JPEG. Acima disso o modelo não ganha detalhe; só custa upload e memória
+REFERENCE_MAX_DIMENSION = int(os.getenv("REFERENCE_MAX_DIMENSION", "1024"))
+REFERENCE_JPEG_QUALITY = int(os.getenv("REFERENCE_JPEG_QUALITY", "88"))
+# Recorta cada foto na região do personagem (rosto com OpenCV, se instalado;
+# senão pela concentração de bordas) antes de reduzir
+REFERENCE_SUBJECT_CROP = os.getenv("REFERENCE_SUBJECT_CROP", "true").lower() in ("1", "true", "sim")
+
+# Dados persistentes da API (fotos enviadas por upload, índices)
+DATA_DIR = os.getenv("DATA_DIR") or os.path.join(os.path.dirname(__file__), "dados")
+PHOTOS_DIR = os.path.join(DATA_DIR, "fotos")
+STORY_INDEX_PATH = os.path.join(DATA_DIR, "index.sqlite3")
+
+# Jobs de geração e logs de eventos (retomada do SSE com Last-Event-ID)
+JOBS_DB_PATH = os.path.join(DATA_DIR, "jobs.sqlite3")
+JOB_RETENTION_HOURS = float(os.getenv("JOB_RETENTION_HOURS", "24"))
+# Fotos de referência (upload ou Base64) sem novo envio e sem job que as cite
+# são apagadas depois desse tempo; a limpeza roda a cada CLEANUP_INTERVAL_SECONDS
+PHOTO_RETENTION_HOURS = float(os.getenv("PHOTO_RETENTION_HOURS", "24"))
+CLEANUP_INTERVAL_SECONDS = float(os.getenv("CLEANUP_INTERVAL_SECONDS", "3600"))
+
+# Quem executa os jobs: "inline" = o próprio processo da API;
+# "external" = a API só enfileira e os workers (python worker.py) executam
+JOB_RUNNER = os.getenv("JOB_RUNNER", "inline").lower()
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "4"))  # Jobs simultâneos por worker
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "30"))  # Sem renovação, o job volta para a fila
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Jobs sem ninguém acompanhando o stream por esse tempo são cancelados, exceto
+# os criados com "detached": true (0 = nunca cancelar)
+JOB_ABANDON_SECONDS = float(os.getenv("JOB_ABANDON_SECONDS", "30"))
+
+# Pedidos idênticos (mesmos personagens, fotos, universo, descrição e modelos):
+# STORY_DEDUP junta os simultâneos em um único job, com os eventos para todos;
+# STORY_RESULT_CACHE_SECONDS devolve a história de um pedido igual concluído
+# há menos desse tempo (0 = desligado; depende de STORY_DEDUP e de JOB_RETENTION_HOURS)
+STORY_DEDUP = os.getenv("STORY_DEDUP", "true").lower() in ("1", "true", "sim")
+STORY_RESULT_CACHE_SECONDS = float(os.getenv("STORY_RESULT_CACHE_SECONDS", "0"))
+
+# Paginação da galeria (/api/stories)
+STORIES_PAGE_SIZE = 24
+STORIES_MAX_PAGE_SIZE = 100
+# Páginas da galeria já serializadas/comprimidas mantidas em memória (por versão do índice)
+STORIES_RESPONSE_CACHE_ENTRIES = int(os.getenv("STORIES_RESPONSE_CACHE_ENTRIES", "128"))
+
+# Cache das fotos de referência já preparadas (chave = hash do conteúdo)
+REFERENCE_CACHE_DIR = os.getenv("REFERENCE_CACHE_DIR") or os.path.join(os.path.dirname(__file__), "cache", "referencias")
+REFERENCE_CACHE_MEMORY_MB = int(os.getenv("REFERENCE_CACHE_MEMORY_MB", "256"))
+REFERENCE_CACHE_DISK_MB = int(os.getenv("REFERENCE_CACHE_DISK_MB", "2048"))
+
+# Como as fotos de referência chegam ao modelo de imagem:
+# "inline" = bytes em cada chamada; "files" = enviadas uma vez por história à Files API
+REFERENCE_UPLOAD_MODE = os.getenv("REFERENCE_UPLOAD_MODE", "inline").lower()
+
+# Variantes responsivas das ilustrações (/api/stories/{id}/images/{image_id}?w=&format=)
+IMAGE_VARIANT_WIDTHS = [int(w) for w in os.getenv("IMAGE_VARIANT_WIDTHS", "320,640,1200").split(",") if w.strip()]
+IMAGE_VARIANT_CACHE_DIR = os.getenv("IMAGE_VARIANT_CACHE_DIR") or os.path.join(os.path.dirname(__file__), "cache", "variantes")
+IMAGE_VARIANT_CACHE_MB = int(os.getenv("IMAGE_VARIANT_CACHE_MB", "1024"))
+
+# Intervalo máximo (segundos) entre gravações em lote dos logs de geração
+LOG_FLUSH_SECONDS = float(os.getenv("LOG_FLUSH_SECONDS", "1.0"))
+
+# Processos dedicados ao Pillow (PNG/WebP, decodificação das fotos); 0 = thread
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(4, os.cpu_count() or 1))))
 
 # === CLASSE DE LOGGING POR HISTÓRIA ===
-# === CLASSE DE LOGGING POR HISTÓRIA ===
+# Escritor em lote compartilhado pelos logs de todas as histórias (thread própria)
+log_writer = LogWriter(flush_interval=LOG_FLUSH_SECONDS)
+
 class StoryLogger:
-    """Logger que salva todas as operações em um arquivo de log na pasta da história"""
+    """
+    Logger das operações de uma história. Cada entrada vira uma linha JSON em
+    generation_log.jsonl na pasta da história (gravada em lote por log_writer);
+    generation_log.txt guarda só o cabeçalho e o resumo legível do finalize.
+    """
     
-    def __init__(self):
-        self.buffer = []
+    def __init__(self, writer: LogWriter = None):
+        self.writer = writer or log_writer
+        self.buffer = []  # Registros anteriores à criação da pasta
         self.file_path = None
+        self.summary_path = None
         self.original_start_time = datetime.now()
+        self._start = time.time()
         self.api_stats = {
             "calls": 0,
             "total_tokens_input": 0,
             "total_tokens_output": 0,
             "image_generated": 0,
-            "errors": 0
+            "errors": 0,
+            "reference_cache_hits": 0,
+            "reference_cache_misses": 0
         }
-        # Estrutura para rastrear detalhes de cada imagem
-        self.image_details = {} 
-        # Ex: "imagem capa": { "status": "pending", "tentativas": 0, "erros": [] }
+        # Modelo que de fato atendeu o texto e cada imagem (pode ser um fallback)
+        self.modelos = {"texto": None, "imagens": {}}
         # Estrutura para rastrear detalhes de cada imagem
         self.image_details = {} 
         # Ex: "imagem capa": { "status": "pending", "tentativas": 0, "erros": [] }
     
-    def start_file_logging(self, folder_path: str, story_title: str):
-        """Inicia o logging em arquivo e despeja o buffer"""
-        self.file_path = os.path.join(folder_path, "generation_log.txt")
+    def start_file_logging(self, folder_path: str, story_title: str, append: bool = False):
+        """
+        Inicia o logging em arquivo e despeja o buffer (append=True continua um
+        log existente). O cabeçalho traz o modelo que gerou o texto, se já
+        conhecido (track_model), e a cadeia de modelos de imagem.
+        """
+        modelo_texto = self.modelos["texto"] or " > ".join(GEMINI_TEXT_MODELS)
+        self.file_path = os.path.join(folder_path, "generation_log.jsonl")
+        self.summary_path = os.path.join(folder_path, "generation_log.txt")
         
-        # Cria o cabeçalho
-        header = f"""
+        if append and os.path.exists(self.file_path):
+            self._write({"ts": time.time(), "level": "INFO", "message": "RETOMADA"})
+            self.writer.write_text(self.summary_path, f"\n---------------------------- RETOMADA {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ----------------------------\n")
+        else:
+            # Cabeçalho: primeira linha do JSONL e início do resumo legível
+            self.writer.write_text(self.file_path, "", truncate=True)
+            self._write({
+                "ts": self.original_start_time.timestamp(),
+                "level": "INFO",
+                "message": "INÍCIO",
+                "data": {
+                    "historia": story_title,
+                    "modelo_texto": modelo_texto,
+                    "modelos_imagem": GEMINI_IMAGE_MODELS
+                }
+            })
+            header = f"""
 ================================================================================
                     SUPER HISTÓRIAS - LOG DE GERAÇÃO
 ================================================================================
 História: {story_title}
 Início do Processo: {self.original_start_time.strftime('%Y-%m-%d %H:%M:%S')}
-Modelo de Texto: {GEMINI_TEXT_MODEL}
-Modelo de Imagem: {GEMINI_IMAGE_MODEL}
+Modelo de Texto: {modelo_texto}
+Modelos de Imagem: {" > ".join(GEMINI_IMAGE_MODELS)}
+Log detalhado: generation_log.jsonl
 ================================================================================
 """
-        with open(self.file_path, 'w', encoding='utf-8') as f:
-            f.write(header)
-            
-        # Despeja buffer
-        with open(self.file_path, 'a', encoding='utf-8') as f:
-            for entry in self.buffer:
-                f.write(entry)
+            # Histórias anteriores ao JSONL: o .txt antigo (log completo) é preservado
+            self.writer.write_text(self.summary_path, header, truncate=not append)
         
-        self.buffer = [] # Limpa buffer para economizar memória (já está no disco)
+        # Despeja buffer
+        for record in self.buffer:
+            self._write(record)
+        self.buffer = []
+
+    def _write(self, record: dict):
+        self.writer.write_record(self.file_path, record)
 
     def log(self, level: str, message: str, data: dict = None):
-        """Adiciona uma entrada no log (buffer ou arquivo)"""
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-        elapsed = (datetime.now() - self.original_start_time).total_seconds()
-        
-        entry = f"[{timestamp}] [{elapsed:>8.2f}s] [{level:>5}] {message}\n"
-        
+        """Adiciona uma entrada no log (buffer ou fila do escritor)"""
+        now = time.time()
+        record = {
+            "ts": now,
+            "elapsed": round(now - self._start, 3),
+            "level": level,
+            "message": message
+        }
         if data:
-            for key, value in data.items():
-                str_value = str(value)
-                if len(str_value) > 2000: # Aumentei limite para inputs grandes
-                    str_value = str_value[:2000] + "... [TRUNCADO]"
-                entry += f"    └─ {key}: {str_value}\n"
+            record["data"] = dict(data)  # Cópia rasa: a serialização é feita depois, em outra thread
         
         if self.file_path:
-            with open(self.file_path, 'a', encoding='utf-8') as f:
-                f.write(entry)
+            self._write(record)
         else:
-            self.buffer.append(entry)
-        
-        # Também imprime no console (opcional, pode poluir)
-        # print(f"[{level}] {message}") 
+            self.buffer.append(record)
 
     def log_input(self, inputs: dict):
         """Log formatado para inputs do usuário"""
@@ -118,22 +294,19 @@ Modelo de Imagem: {GEMINI_IMAGE_MODEL}
         short_prompt = prompt_preview[:30] + "..." if len(prompt_preview) > 30 else prompt_preview
         
         self.info(f"REQ -> API ({endpoint})", {
-            "sent_at": datetime.now().strftime('%H:%M:%S.%f'),
             "prompt_preview": short_prompt
         })
 
     def log_api_response(self, endpoint: str, duration: float, metadata: dict = None):
         """Registra retorno de requisição"""
         data = {
-            "received_at": datetime.now().strftime('%H:%M:%S.%f'),
-            "duration": f"{duration:.2f}s"
+            "duration": round(duration, 3)
         }
         if metadata:
             data.update(metadata)
-            if "total_tokens" in metadata:
-                 # Exemplo de processamento simples de tokens se disponível
-                 pass
-                 
+            self.api_stats["total_tokens_input"] += metadata.get("tokens_entrada", 0)
+            self.api_stats["total_tokens_output"] += metadata.get("tokens_saida", 0)
+
         self.info(f"RES <- API ({endpoint})", data)
 
     def info(self, message: str, data: dict = None):
@@ -158,7 +331,7 @@ Modelo de Imagem: {GEMINI_IMAGE_MODEL}
         if error:
             # Simplificar mensagem de erro
             error_str = str(error)
-            if "RESOURCE_EXHAUSTED" in error_str:
+            if is_quota_error(error):
                 error_str = "Erro 429: Cota de API excedida (Resource Exhausted)"
             elif "NoneType" in error_str and "iterable" in error_str:
                 error_str = "Erro Interno: Resposta inesperada da API (NoneType)"
@@ -171,6 +344,20 @@ Modelo de Imagem: {GEMINI_IMAGE_MODEL}
             if attempt >= MAX_RETRIES:
                 self.image_details[image_id]["status"] = "failed"
 
+    def track_model(self, model: str, image_id: str = None):
+        """Registra o modelo usado no texto (image_id=None) ou em uma imagem"""
+        if image_id is None:
+            self.modelos["texto"] = model
+        else:
+            self.modelos["imagens"][image_id] = model
+
+    def track_reference_cache(self, hit: bool):
+        """Registra acerto/falta no cache de fotos de referência"""
+        if hit:
+            self.api_stats["reference_cache_hits"] += 1
+        else:
+            self.api_stats["reference_cache_misses"] += 1
+
     def track_image_success(self, image_id):
         """Registra sucesso de imagem"""
         if image_id not in self.image_details:
@@ -217,6 +404,16 @@ Status Final:       {final_status}
 --- ESTATÍSTICAS DE API ---
 Chamadas Totais:   {self.api_stats['calls']}
 Erros Registrados: {self.api_stats['errors']}
+Tokens Entrada:    {self.api_stats['total_tokens_input']}
+Tokens Saída:      {self.api_stats['total_tokens_output']}
+
+--- MODELOS USADOS ---
+Texto:   {self.modelos['texto'] or '-'}
+Imagens: {", ".join(f"{k}={v}" for k, v in sorted(self.modelos['imagens'].items())) or '-'}
+
+--- CACHE DE FOTOS DE REFERÊNCIA ---
+Acertos: {self.api_stats['reference_cache_hits']}
+Faltas:  {self.api_stats['reference_cache_misses']}
 
 --- GERAÇÃO DE ASSETS (Esperado: {expected_images}) ---
 Imagens Geradas:  {images_success}
@@ -227,17 +424,86 @@ Imagens Falharam: {images_failed}
 ================================================================================
 """
         if self.file_path:
-            with open(self.file_path, 'a', encoding='utf-8') as f:
-                f.write(footer)
+            # Versão estruturada do resumo no JSONL; o texto acima é só a visão legível
+            self._write({
+                "ts": time.time(),
+                "elapsed": round(time.time() - self._start, 3),
+                "level": "INFO",
+                "message": "RESUMO",
+                "summary": {
+                    "status": final_status,
+                    "tempo_total": round(total_time, 2),
+                    "imagens_geradas": images_success,
+                    "imagens_falharam": images_failed,
+                    "api": dict(self.api_stats),
+                    "modelos": {"texto": self.modelos["texto"], "imagens": dict(self.modelos["imagens"])},
+                    "imagens": {k: dict(v, erros=list(v["erros"])) for k, v in self.image_details.items()}
+                }
+            })
+            self.writer.write_text(self.summary_path, footer)
         else:
             print(footer)
 
-app = FastAPI(title="Super Histórias API", version="1.0.0")
+def limpar_dados_antigos():
+    """Jobs encerrados além da retenção e, depois, as fotos que só eles citavam"""
+    jobs = job_store.purge(JOB_RETENTION_HOURS * 3600)
+    photos = photo_store.sweep(PHOTO_RETENTION_HOURS * 3600, keep=job_store.referenced_photos())
+    if jobs or photos:
+        print(f"🧹 Limpeza: {jobs} jobs e {photos} fotos de referência removidos")
+
+async def limpeza_periodica():
+    while True:
+        try:
+            await asyncio.to_thread(limpar_dados_antigos)
+        except Exception as e:
+            print(f"⚠️ Falha na limpeza de dados antigos: {e}")
+        await asyncio.sleep(CLEANUP_INTERVAL_SECONDS)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Primeira execução com o índice: importa as histórias já existentes em disco
+    if await asyncio.to_thread(story_index.count) == 0:
+        total = await asyncio.to_thread(story_index.rebuild, STORIES_DIR)
+        if total:
+            print(f"📚 Índice de histórias criado a partir do disco ({total} histórias)")
+    cleanup_task = asyncio.create_task(limpeza_periodica())
+    
+    def registrar_lag(lag: float):
+        loop_lag_max["value"] = max(loop_lag_max["value"], lag)
+
+    lag_task = asyncio.create_task(monitor_event_loop(metric_loop_lag, on_lag=registrar_lag))
+
+    global job_worker
+    worker_task = None
+    if JOB_RUNNER == "inline":
+        job_worker = criar_job_worker()
+        worker_task = asyncio.create_task(job_worker.run())
+    yield
+    if worker_task:
+        # Jobs em andamento voltam para a fila e são retomados no próximo início
+        await job_worker.stop()
+        await asyncio.gather(worker_task, return_exceptions=True)
+        job_worker = None
+    lag_task.cancel()
+    cleanup_task.cancel()
+    await asyncio.to_thread(image_processor.shutdown)
+    await asyncio.to_thread(log_writer.close)
+
+app = FastAPI(title="Super Histórias API", version="1.0.0", lifespan=lifespan)
 
 # Pasta para salvar histórias
-STORIES_DIR = os.path.join(os.path.dirname(__file__), "historias")
+STORIES_DIR = os.getenv("STORIES_DIR") or os.path.join(os.path.dirname(__file__), "historias")
 os.makedirs(STORIES_DIR, exist_ok=True)
 
+# Índice SQLite da galeria (atualizado a cada story.json salvo)
+story_index = StoryIndex(STORY_INDEX_PATH)
+
+# Jobs de geração: fila + log de eventos persistentes
+# Com workers externos os eventos vêm de outro processo: leitura mais frequente
+job_store = JobStore(JOBS_DB_PATH)
+job_events = JobEventLog(job_store, poll_interval=2.0 if JOB_RUNNER == "inline" else 0.5)
+job_worker: Optional[JobWorker] = None  # Consumidor da fila no processo da API (JOB_RUNNER=inline)
+
 # Configuração de CORS a partir de variável de ambiente
 # Em produção, defina CORS_ORIGINS com as URLs permitidas
 default_origins = ["http://localhost:5173", "http://localhost:5174", "http://localhost:3000"]
@@ -250,12 +516,163 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Job-Id"],
+)
+
+# Servir arquivos estáticos das histórias (ilustrações imutáveis, story.json pré-comprimido)
+app.mount("/historias", StoryStaticFiles(directory=STORIES_DIR), name="historias")
+
+if GEMINI_BACKEND == "fake":
+    # Backend local (sem rede e sem cota) para benchmarks: ver fake_gemini.py
+    from fake_gemini import FakeClient
+    client = FakeClient.from_env()
+    print("🧪 GEMINI_BACKEND=fake: usando o Gemini simulado")
+else:
+    client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+
+# Pool de processos para todo trabalho do Pillow (nada disso roda no event loop)
+image_processor = ImageProcessor(IMAGE_WORKERS)
+
+photo_store = PhotoStore(PHOTOS_DIR)
+
+# AVIF depende do Pillow ter sido compilado com libavif (11.2+); sem ele, WebP/JPEG
+variant_cache = VariantCache(IMAGE_VARIANT_CACHE_DIR, IMAGE_VARIANT_CACHE_MB * 1024 * 1024)
+VARIANT_FORMATS_AVAILABLE = [fmt for fmt in ("avif", "webp") if features.check(fmt)] + ["jpeg"]
+
+stories_response_cache = EncodedBodyCache(STORIES_RESPONSE_CACHE_ENTRIES)
+
+reference_cache = ReferencePhotoCache(
+    REFERENCE_CACHE_DIR,
+    memory_budget=REFERENCE_CACHE_MEMORY_MB * 1024 * 1024,
+    disk_budget=REFERENCE_CACHE_DISK_MB * 1024 * 1024
+)
+# Fotos de referência em uso pelas histórias em andamento (por história e no total)
+reference_memory = ReferenceMemory()
+
+# Toda chamada de texto/imagem passa por aqui (limite global + fila justa entre histórias)
+def _novo_controlador_aimd() -> AimdController:
+    return AimdController(
+        min_limit=AIMD_MIN_LIMIT,
+        increase=AIMD_INCREASE,
+        decrease=AIMD_DECREASE,
+        cooldown=AIMD_COOLDOWN
+    )
+
+text_scheduler = GenerationScheduler("texto", MAX_TEXT_CALLS_IN_FLIGHT, controller=_novo_controlador_aimd())
+image_scheduler = GenerationScheduler("imagem", MAX_IMAGE_CALLS_IN_FLIGHT, controller=_novo_controlador_aimd())
+
+# Latências recentes por modelo (sempre registradas); sem IMAGE_HEDGING o orçamento é zero
+latency_tracker = LatencyTracker()
+image_hedge_policy = HedgePolicy(
+    latency_tracker,
+    percentile=HEDGE_PERCENTILE,
+    max_fraction=HEDGE_MAX_FRACTION if IMAGE_HEDGING else 0.0,
+    min_samples=HEDGE_MIN_SAMPLES
 )
 
-# Servir arquivos estáticos das histórias
-app.mount("/historias", StaticFiles(directory=STORIES_DIR), name="historias")
+# Cadeias de modelos com circuit breaker (o modelo de cada chamada sai daqui)
+def _nova_cadeia(kind: str, models: List[str], slow_call_seconds: float) -> ModelChain:
+    return ModelChain(
+        kind, models,
+        error_rate=BREAKER_ERROR_RATE,
+        slow_rate=BREAKER_SLOW_RATE,
+        slow_call_seconds=slow_call_seconds,
+        min_calls=BREAKER_MIN_CALLS,
+        window_seconds=BREAKER_WINDOW_SECONDS,
+        open_seconds=BREAKER_OPEN_SECONDS,
+        half_open_calls=BREAKER_HALF_OPEN_CALLS
+    )
+
+text_models = _nova_cadeia("texto", GEMINI_TEXT_MODELS, TEXT_SLOW_CALL_SECONDS)
+image_models = _nova_cadeia("imagem", GEMINI_IMAGE_MODELS, IMAGE_SLOW_CALL_SECONDS)
+
+# Métricas Prometheus (/metrics), alimentadas nos mesmos pontos do StoryLogger
+metrics = MetricsRegistry(prefix="superhistorias_")
+metric_text_latency = metrics.histogram(
+    "text_generation_seconds", "Duração das chamadas de geração do texto da história", ["model", "mode"])
+metric_image_latency = metrics.histogram(
+    "image_generation_seconds", "Duração das chamadas de geração de imagem (sem a fila)", ["model", "aspect_ratio"])
+metric_image_queue_wait = metrics.histogram(
+    "image_queue_wait_seconds", "Espera na fila do agendador global antes da chamada de imagem", ["model"])
+metric_pillow = metrics.histogram(
+    "image_processing_seconds", "Pós-processamento com Pillow (PNG/WebP e fotos de referência)", ["operation"])
+metric_sse_duration = metrics.histogram(
+    "sse_stream_seconds", "Duração das conexões SSE de acompanhamento de jobs",
+    buckets=(1, 5, 15, 30, 60, 120, 180, 300, 600, 900, 1800))
+metric_retries = metrics.counter(
+    "retries_total", "Tentativas que falharam e levaram a retry ou desistência", ["stage", "error_class"])
+metric_tokens = metrics.counter(
+    "tokens_total", "Tokens consumidos por modelo (input = prompt, output = resposta)", ["model", "direction"])
+metric_in_flight = metrics.gauge(
+    "calls_in_flight", "Chamadas ao Gemini em andamento neste processo", ["kind"])
+metric_in_flight.set_function(lambda: text_scheduler.in_flight, kind="texto")
+metric_in_flight.set_function(lambda: image_scheduler.in_flight, kind="imagem")
+metric_queue = metrics.gauge(
+    "calls_waiting", "Chamadas ao Gemini aguardando vaga no agendador global", ["kind"])
+metric_queue.set_function(lambda: text_scheduler.waiting, kind="texto")
+metric_queue.set_function(lambda: image_scheduler.waiting, kind="imagem")
+metric_limit = metrics.gauge(
+    "calls_limit", "Limite atual de chamadas simultâneas (ajustado pelo AIMD)", ["kind"])
+metric_limit.set_function(lambda: text_scheduler.limit, kind="texto")
+metric_limit.set_function(lambda: image_scheduler.limit, kind="imagem")
+metric_breaker_state = metrics.gauge(
+    "circuit_breaker_open", "Circuito do modelo (0 = fechado, 0.5 = meio aberto, 1 = aberto)", ["kind", "model"])
+for _cadeia in (text_models, image_models):
+    for _modelo, _breaker in _cadeia.breakers.items():
+        metric_breaker_state.set_function(
+            lambda b=_breaker: {"closed": 0.0, "half_open": 0.5, "open": 1.0}[b.state], kind=_cadeia.kind, model=_modelo)
+metric_story_requests = metrics.counter(
+    "story_requests_total", "Pedidos de história por resultado da deduplicação (new, joined, cached)", ["result"])
+metric_batch_latency = metrics.histogram(
+    "batch_request_seconds", "Do pedido à resposta no modo batch (espera do lote e do job)", ["kind"],
+    buckets=(10, 30, 60, 300, 600, 1800, 3600, 7200, 21600, 43200, 86400))
+metric_loop_lag = metrics.histogram(
+    "event_loop_lag_seconds", "Atraso do event loop em relação ao previsto (amostrado a cada 100ms)",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+loop_lag_max = {"value": 0.0}
+metrics.gauge("event_loop_lag_max_seconds", "Maior atraso do event loop desde o início do processo") \
+    .set_function(lambda: loop_lag_max["value"])
+# ru_maxrss vem em KB no Linux (o pool do Pillow não entra na conta)
+metrics.gauge("process_peak_rss_bytes", "Pico de memória residente do processo da API") \
+    .set_function(lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+metrics.gauge("process_rss_bytes", "Memória residente atual do processo da API") \
+    .set_function(lambda: rss_atual())
+metric_reference_bytes = metrics.gauge(
+    "reference_photos_bytes", "Fotos de referência em memória nas histórias em andamento (atual e pico)", ["kind"])
+metric_reference_bytes.set_function(lambda: reference_memory.bytes, kind="current")
+metric_reference_bytes.set_function(lambda: reference_memory.peak_bytes, kind="peak")
+metric_reference_story_bytes = metrics.histogram(
+    "reference_photos_story_bytes", "Tamanho das fotos de referência (já preparadas) de cada história",
+    buckets=(64 * 1024, 256 * 1024, 512 * 1024, 1024 ** 2, 2 * 1024 ** 2, 4 * 1024 ** 2, 8 * 1024 ** 2, 16 * 1024 ** 2))
+
+def rss_atual() -> int:
+    """RSS atual em bytes (Linux: /proc/self/statm; sem ele, o pico)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def registrar_tokens(model: str, usage) -> dict:
+    """Soma o usage_metadata da resposta nas métricas; retorna os campos para o log"""
+    if usage is None:
+        return {}
+    entrada = getattr(usage, "prompt_token_count", None) or 0
+    saida = getattr(usage, "candidates_token_count", None) or 0
+    metric_tokens.inc(entrada, model=model, direction="input")
+    metric_tokens.inc(saida, model=model, direction="output")
+    return {"tokens_entrada": entrada, "tokens_saida": saida}
 
-client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+def classe_do_erro(error) -> str:
+    """Rótulo de baixa cardinalidade para o tipo de erro"""
+    if is_quota_error(error):
+        return "quota"
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+        return "timeout"
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return f"http_{code}"
+    return type(error).__name__
 
 # --- MODELOS ---
 class Story(BaseModel):
@@ -272,7 +689,8 @@ class Story(BaseModel):
 class Character(BaseModel):
     id: str
     name: str
-    images: List[str]  # Base64 encoded images
+    images: List[str] = []  # Base64 encoded images (fallback)
+    photo_ids: List[str] = []  # Ids retornados por POST /api/characters/{id}/photos
 
 class Universe(BaseModel):
     id: str
@@ -287,6 +705,7 @@ class StoryRequest(BaseModel):
     characters: List[Character]
     universe: Universe
     description: Optional[str] = None
+    detached: bool = False  # Continua gerando mesmo sem ninguém acompanhando o stream
 
 # --- FUNÇÕES AUXILIARES ---
 
@@ -294,13 +713,49 @@ class StoryRequest(BaseModel):
 MAX_RETRIES = 5
 BASE_DELAY = 1  # segundos
 MAX_DELAY = 5   # segundos
+MAX_RETRY_AFTER = float(os.getenv("MAX_RETRY_AFTER", "30"))  # Teto para o retryDelay sugerido pela API
+
+class DeadlineExceeded(TimeoutError):
+    """O prazo da etapa acabou (ou não comporta mais uma tentativa)"""
+
+class ConteudoBloqueadoError(ValueError):
+    """
+    O modelo recusou o pedido (filtro de segurança ou bloqueio do prompt).
+    Repetir o mesmo pedido não adianta, e a recusa não conta como falha do modelo.
+    """
+
+# Motivos de término em que o modelo respondeu, mas bloqueou a imagem
+FINISH_REASONS_BLOQUEIO = {
+    types.FinishReason.SAFETY, types.FinishReason.BLOCKLIST, types.FinishReason.PROHIBITED_CONTENT,
+    types.FinishReason.SPII, types.FinishReason.IMAGE_SAFETY, types.FinishReason.IMAGE_PROHIBITED_CONTENT,
+    types.FinishReason.RECITATION, types.FinishReason.IMAGE_RECITATION,
+}
+
+# Cancelamentos e prazos (expostos em /api/admin/rate-limit)
+metricas_cancelamento = {
+    "historias_abandonadas": 0,          # Jobs cancelados sem ninguém acompanhando
+    "chamadas_desperdicadas": 0,         # Chamadas ao modelo feitas por histórias abandonadas
+    "prazos_esgotados": 0,               # Etapas encerradas pelo prazo
+    "chamadas_interrompidas_prazo": 0,   # Chamadas em andamento cortadas pelo prazo
+}
+
+# Chamadas ao modelo por história (apenas as contabilizadas, ver executar_job)
+chamadas_por_historia = {}
 
-async def retry_with_backoff(func, *args, operation_name="operação", logger: StoryLogger = None, on_attempt=None, **kwargs):
+def contar_chamada(story_key: str):
+    if story_key in chamadas_por_historia:
+        chamadas_por_historia[story_key] += 1
+
+async def retry_with_backoff(func, *args, operation_name="operação", logger: StoryLogger = None, on_attempt=None, deadline: float = None, expected_duration: float = 0, **kwargs):
     """
-    Executa uma função async com retry e backoff exponencial.
-    Tenta até MAX_RETRIES vezes, esperando de 1 a 5 segundos entre tentativas.
+    Executa uma função async com retry e backoff com jitter descorrelacionado.
+    Tenta até MAX_RETRIES vezes, esperando entre BASE_DELAY e MAX_DELAY segundos
+    (ou o retryDelay sugerido pela API em erros de cota).
+    deadline (time.monotonic()): cada tentativa é cortada ao fim do prazo, e uma
+    nova só começa se a espera mais expected_duration couber nele.
     """
     last_exception = None
+    delay = BASE_DELAY
     
     for attempt in range(1, MAX_RETRIES + 1):
         if on_attempt:
@@ -311,14 +766,45 @@ async def retry_with_backoff(func, *args, operation_name="operação", logger: S
                 on_attempt(attempt)
                 
         try:
-            res = await func(*args, **kwargs)
+            if deadline is None:
+                res = await func(*args, **kwargs)
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded(f"Prazo esgotado para {operation_name}")
+                try:
+                    res = await asyncio.wait_for(func(*args, **kwargs), timeout=remaining)
+                except asyncio.TimeoutError:
+                    if time.monotonic() < deadline:
+                        raise  # Timeout da própria chamada, não do prazo
+                    metricas_cancelamento["chamadas_interrompidas_prazo"] += 1
+                    raise DeadlineExceeded(f"Prazo esgotado para {operation_name} durante a tentativa {attempt}")
             # Se sucesso e for imagem, registrar
             if logger and "imagem" in operation_name.lower():
                 logger.track_image_success(operation_name)
             return res
+        except DeadlineExceeded as e:
+            metricas_cancelamento["prazos_esgotados"] += 1
+            if logger:
+                logger.error(str(e), {"tentativa": attempt})
+            print(f"⏱️ {e}")
+            raise
+        except ConteudoBloqueadoError as e:
+            metric_retries.inc(stage="imagem" if "imagem" in operation_name.lower() else "texto", error_class="bloqueio")
+            if logger:
+                logger.error(f"Pedido bloqueado pelo modelo em {operation_name} (sem nova tentativa)", {
+                    "erro": str(e),
+                    "tentativa": attempt
+                })
+            print(f"🚫 Pedido bloqueado em {operation_name}: {e}")
+            raise
         except Exception as e:
             last_exception = e
             error_msg = str(e)
+            metric_retries.inc(
+                stage="imagem" if "imagem" in operation_name.lower() else "texto",
+                error_class=classe_do_erro(e)
+            )
             
             # Log do erro específico
             if logger:
@@ -328,16 +814,31 @@ async def retry_with_backoff(func, *args, operation_name="operação", logger: S
                 
                 logger.warn(f"Erro na tentativa {attempt}/{MAX_RETRIES} para {operation_name}", {
                     "erro": error_msg,
-                    "tipo_erro": type(e).__name__
+                    "tipo_erro": type(e).__name__,
+                    "cota_excedida": is_quota_error(e)
                 })
             
             if attempt < MAX_RETRIES:
-                # Backoff exponencial: 1s, 2s, 3s, 4s, 5s (limitado a MAX_DELAY)
-                delay = min(BASE_DELAY * attempt, MAX_DELAY)
+                # Jitter descorrelacionado: sorteia entre BASE_DELAY e 3x a espera anterior
+                # (evita que todas as imagens repitam em sincronia)
+                delay = min(MAX_DELAY, random.uniform(BASE_DELAY, delay * 3))
+                hint = retry_after_hint(e)
+                if hint is not None:
+                    delay = max(delay, min(hint, MAX_RETRY_AFTER) + random.uniform(0, BASE_DELAY))
+                if deadline is not None and time.monotonic() + delay + expected_duration > deadline:
+                    # Não começa uma tentativa que não teria tempo de terminar
+                    metricas_cancelamento["prazos_esgotados"] += 1
+                    if logger:
+                        logger.error(f"Sem tempo no prazo para nova tentativa de {operation_name}", {
+                            "ultimo_erro": error_msg,
+                            "tentativas": attempt
+                        })
+                    print(f"⏱️ Sem tempo no prazo para nova tentativa de {operation_name}: {e}")
+                    raise DeadlineExceeded(f"Prazo insuficiente para nova tentativa de {operation_name} (último erro: {error_msg})") from e
                 print(f"⚠️ Tentativa {attempt}/{MAX_RETRIES} falhou para {operation_name}: {e}")
                 
                 if logger:
-                     logger.info(f"Aguardando {delay}s antes de tentar novamente...")
+                     logger.info(f"Aguardando {delay:.1f}s antes de tentar novamente...")
                      
                 await asyncio.sleep(delay)
             else:
@@ -354,10 +855,54 @@ def send_event(event_type: str, data: dict) -> str:
     payload = json.dumps({"type": event_type, **data}, ensure_ascii=False)
     return f"data: {payload}\n\n"
 
-def decode_base64_images(base64_images: List[str], logger: StoryLogger = None) -> List[Image.Image]:
+def chave_referencia(digest: str) -> str:
+    """Chave do cache: hash do conteúdo + parâmetros de preparo"""
+    crop = "_recorte" if REFERENCE_SUBJECT_CROP else ""
+    return f"{digest}_{REFERENCE_MAX_DIMENSION}_q{REFERENCE_JPEG_QUALITY}{crop}"
+
+async def preparar_foto_referencia(digest: str, source, idx: int, logger: StoryLogger = None) -> types.Part:
+    """
+    Retorna a foto de referência preparada, vinda do cache por conteúdo ou
+    preparada agora (no pool) a partir de `source` (bytes ou caminho do original).
+    """
+    key = chave_referencia(digest)
+    prepared = await reference_cache.get(key)
+    
+    if logger:
+        logger.track_reference_cache(prepared is not None)
+    
+    if prepared is not None:
+        if logger:
+            # A transformação feita no preparo vem no próprio JPEG (comentário)
+            logger.info(f"Imagem {idx + 1} reaproveitada do cache", {
+                "hash": key[:12],
+                "tamanho_kb": f"{len(prepared) / 1024:.1f}KB",
+                "transformacao": ler_transformacao(prepared)
+            })
+    else:
+        with metric_pillow.time(operation="preparar_referencia"):
+            prepared, transformacao = await image_processor.preparar_referencia(
+                source, REFERENCE_MAX_DIMENSION, REFERENCE_JPEG_QUALITY, REFERENCE_SUBJECT_CROP
+            )
+        await reference_cache.put(key, prepared)
+        
+        if logger:
+            logger.info(f"Imagem {idx + 1} preparada", {
+                "hash": key[:12],
+                "transformacao": transformacao,
+                "tamanho_preparado": f"{len(prepared) / 1024:.1f}KB"
+            })
+    
+    # O mesmo Part (mesmos bytes) é reutilizado nas seis chamadas de imagem
+    return types.Part.from_bytes(data=prepared, mime_type="image/jpeg")
+
+async def decode_base64_images(base64_images: List[str], logger: StoryLogger = None) -> List[Tuple[str, types.Part]]:
     """
-    Decodifica imagens Base64 para objetos PIL.
-    Valida tamanho máximo e redimensiona se necessário.
+    Prepara as fotos de referência (Base64) para o modelo de imagem.
+    Valida tamanho máximo e redimensiona se necessário; fotos já vistas vêm
+    do cache por conteúdo, sem nova decodificação. O original é guardado no
+    PhotoStore (pelo hash) para regenerar ilustrações da história depois.
+    Retorna [(id_da_foto, parte)].
     """
     images = []
     
@@ -381,33 +926,10 @@ def decode_base64_images(base64_images: List[str], logger: StoryLogger = None) -
         
         try:
             image_data = base64.b64decode(b64)
-            img = Image.open(BytesIO(image_data))
-            
-            # Log do tamanho original
-            original_size = img.size
-            
-            # Redimensionar se muito grande para economizar memória/processamento
-            if max(img.size) > MAX_IMAGE_DIMENSION:
-                img.thumbnail((MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION), Image.Resampling.LANCZOS)
-                if logger:
-                    logger.info(f"Imagem {idx + 1} redimensionada", {
-                        "original": f"{original_size[0]}x{original_size[1]}",
-                        "nova": f"{img.size[0]}x{img.size[1]}"
-                    })
-            
-            # Converter para RGB se necessário (remove alpha channel)
-            if img.mode in ('RGBA', 'LA', 'P'):
-                img = img.convert('RGB')
-            
-            images.append(img)
-            
-            if logger:
-                logger.info(f"Imagem {idx + 1} decodificada com sucesso", {
-                    "tamanho_mb": f"{estimated_size_mb:.2f}MB",
-                    "dimensoes": f"{img.size[0]}x{img.size[1]}",
-                    "modo": img.mode
-                })
-                
+            digest = hashlib.sha256(image_data).hexdigest()
+            part = await preparar_foto_referencia(digest, image_data, idx, logger)
+            await asyncio.to_thread(photo_store.save_bytes, image_data, digest)
+            images.append((digest, part))
         except Exception as e:
             error_msg = f"Erro ao processar imagem {idx + 1}: {str(e)}"
             if logger:
@@ -416,6 +938,27 @@ def decode_base64_images(base64_images: List[str], logger: StoryLogger = None) -
     
     return images
 
+async def load_uploaded_photos(photo_ids: List[str], logger: StoryLogger = None) -> List[Tuple[str, types.Part]]:
+    """Prepara as fotos enviadas por upload (referenciadas pelo id/hash). Retorna [(id_da_foto, parte)]."""
+    images = []
+    
+    for idx, photo_id in enumerate(photo_ids):
+        if not photo_store.exists(photo_id):
+            error_msg = f"Foto {photo_id[:12]} não encontrada. Envie-a novamente."
+            if logger:
+                logger.error(error_msg)
+            raise HTTPException(status_code=400, detail=error_msg)
+        
+        try:
+            images.append((photo_id, await preparar_foto_referencia(photo_id, photo_store.path(photo_id), idx, logger)))
+        except Exception as e:
+            error_msg = f"Erro ao processar foto {photo_id[:12]}: {str(e)}"
+            if logger:
+                logger.error(error_msg)
+            raise HTTPException(status_code=400, detail=error_msg)
+    
+    return images
+
 def sanitize_filename(name: str) -> str:
     """Remove caracteres inválidos de nomes de arquivo"""
     return re.sub(r'[<>:"/\\|?*]', '', name).replace(' ', '_')[:50]
@@ -429,8 +972,34 @@ def create_story_folder(title: str) -> tuple[str, str]:
     os.makedirs(folder_path, exist_ok=True)
     return folder_path, story_id, folder_name
 
-async def _gerar_json_historia_interno(characters: List[Character], universe: Universe, description: str, logger: StoryLogger = None):
-    """Função interna que gera a estrutura da história."""
+def salvar_story_json(story: dict) -> str:
+    """
+    Grava o story.json (escrita atômica) com as cópias .gz/.br servidas aos
+    clientes e atualiza o índice. Retorna o caminho.
+    """
+    json_path = os.path.join(STORIES_DIR, story["folder"], "story.json")
+    tmp_path = f"{json_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(story, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, json_path)
+    gravar_copias_comprimidas(json_path)
+    story_index.upsert(story)
+    return json_path
+
+def estado_das_imagens(images: dict, errors: dict) -> dict:
+    """Estado de cada uma das 6 imagens: done / failed (com o erro) / missing"""
+    state = {}
+    for image_id in REQUIRED_IMAGES:
+        if image_id in images:
+            state[image_id] = {"status": "done"}
+        elif image_id in errors:
+            state[image_id] = {"status": "failed", "error": errors[image_id]}
+        else:
+            state[image_id] = {"status": "missing"}
+    return state
+
+def _montar_prompt_historia(characters: List[Character], universe: Universe, description: str) -> str:
+    """Monta o prompt de geração da história."""
     nomes = ", ".join([c.name for c in characters])
     
     prompt_historia = f"""
@@ -483,40 +1052,10 @@ async def _gerar_json_historia_interno(characters: List[Character], universe: Un
     
     IMPORTANTE: Os protagonistas nas imagens são SEMPRE {nomes}.
     """
-    
-    if logger:
-        logger.info("Enviando requisição para geração de história", {
-            "modelo": GEMINI_TEXT_MODEL,
-            "personagens": nomes,
-            "universo": universe.name,
-            "descricao": description[:200] if description else "[nenhuma]"
-        })
-    
-    start_req = time.time()
-    response = await client.aio.models.generate_content(
-        model=GEMINI_TEXT_MODEL,
-        contents=prompt_historia,
-        config={
-            "response_mime_type": "application/json",
-            "response_json_schema": Story.model_json_schema(),
-        },
-    )
-    duration = time.time() - start_req
+    return prompt_historia
 
-    if logger:
-        # Tentar extrair usage metadata se disponível
-        metadata = {}
-        # if hasattr(response, "usage_metadata"):
-        #      metadata["usage"] = str(response.usage_metadata)
-             
-        logger.log_api_response("generate_story_text", duration, metadata)
-    
-    if not response or not response.text:
-        raise ValueError("Resposta vazia da API")
-    
-    # Parse do JSON
-    story_data = Story.model_validate_json(response.text)
-    
+def _validar_historia(story_data: Story, logger: StoryLogger = None) -> Story:
+    """Valida a estrutura da história gerada. Levanta exceção se inválida."""
     # === VALIDAÇÃO EXTRA #4: Verificar estrutura do output ===
     if len(story_data.parts) != 5:
         error_msg = f"Estrutura inválida: esperado 5 partes, recebido {len(story_data.parts)}"
@@ -565,32 +1104,176 @@ async def _gerar_json_historia_interno(characters: List[Character], universe: Un
     
     return story_data
 
-async def gerar_json_historia(characters: List[Character], universe: Universe, description: str, logger: StoryLogger = None):
+async def _gerar_json_historia_interno(characters: List[Character], universe: Universe, description: str, logger: StoryLogger = None, story_key: str = None, lote: BatchDispatcher = None):
+    """
+    Função interna que gera a estrutura da história.
+    lote: envia a chamada em um batch job (sem ocupar vaga no agendador global).
+    O modelo sai da cadeia text_models e fica registrado no logger.
+    """
+    nomes = ", ".join([c.name for c in characters])
+    prompt_historia = _montar_prompt_historia(characters, universe, description)
+    
+    if logger:
+        logger.info("Enviando requisição para geração de história", {
+            "modelos": GEMINI_TEXT_MODELS,
+            "personagens": nomes,
+            "universo": universe.name,
+            "descricao": description[:200] if description else "[nenhuma]",
+            "modo": "batch" if lote else "direto"
+        })
+    
+    config = {
+        "response_mime_type": "application/json",
+        "response_json_schema": Story.model_json_schema(),
+    }
+    if lote:
+        # A espera do lote não diz nada sobre a latência do modelo: o breaker só vê os erros
+        with text_models.escolher(track_latency=False) as modelo:
+            start_req = time.time()
+            contar_chamada(story_key)
+            response = await lote.generate_content(model=modelo, contents=prompt_historia, config=config)
+            duration = time.time() - start_req
+        metric_batch_latency.observe(duration, kind="texto")
+    else:
+        async with text_scheduler.slot(story_key):
+            with text_models.escolher() as modelo:
+                start_req = time.time()
+                contar_chamada(story_key)
+                response = await client.aio.models.generate_content(
+                    model=modelo,
+                    contents=prompt_historia,
+                    config=config,
+                )
+                duration = time.time() - start_req
+            latency_tracker.record(modelo, duration)
+            metric_text_latency.observe(duration, model=modelo, mode="sync")
+
+    metadata = registrar_tokens(modelo, getattr(response, "usage_metadata", None))
+    if logger:
+        logger.track_model(modelo)
+        logger.log_api_response("generate_story_text", duration, {"modelo": modelo, **metadata})
+    
+    if not response or not response.text:
+        raise ValueError("Resposta vazia da API")
+    
+    # Parse do JSON
+    story_data = Story.model_validate_json(response.text)
+    return _validar_historia(story_data, logger)
+
+async def _gerar_json_historia_stream_interno(characters: List[Character], universe: Universe, description: str, logger: StoryLogger = None, on_event=None, story_key: str = None):
+    """
+    Função interna que gera a história via streaming.
+    Chama on_event(tipo, chave, valor) assim que cada campo ou parte fica completo.
+    """
+    nomes = ", ".join([c.name for c in characters])
+    prompt_historia = _montar_prompt_historia(characters, universe, description)
+    
+    if logger:
+        logger.info("Enviando requisição para geração de história (streaming)", {
+            "modelos": GEMINI_TEXT_MODELS,
+            "personagens": nomes,
+            "universo": universe.name,
+            "descricao": description[:200] if description else "[nenhuma]"
+        })
+    
+    first_chunk = None
+    usage = None
+    parser = StoryStreamParser()
+    async with text_scheduler.slot(story_key):
+        with text_models.escolher() as modelo:
+            if logger:
+                # Antes dos eventos: o cabeçalho do log (criado durante o stream) já mostra o modelo
+                logger.track_model(modelo)
+            start_req = time.time()
+            contar_chamada(story_key)
+            stream = await client.aio.models.generate_content_stream(
+                model=modelo,
+                contents=prompt_historia,
+                config={
+                    "response_mime_type": "application/json",
+                    "response_json_schema": Story.model_json_schema(),
+                },
+            )
+            async for chunk in stream:
+                # O uso de tokens vem acumulado; vale o do último chunk que o trouxer
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                if not chunk.text:
+                    continue
+                if first_chunk is None:
+                    first_chunk = time.time() - start_req
+                for kind, key, value in parser.feed(chunk.text):
+                    if on_event:
+                        await on_event(kind, key, value)
+            duration = time.time() - start_req
+        latency_tracker.record(modelo, duration)
+        metric_text_latency.observe(duration, model=modelo, mode="stream")
+
+    metadata = registrar_tokens(modelo, usage)
+    if logger:
+        logger.log_api_response("generate_story_text_stream", duration, {
+            "modelo": modelo,
+            "primeiro_chunk": f"{first_chunk:.2f}s" if first_chunk is not None else "-",
+            **metadata
+        })
+    
+    if not parser.buffer.strip():
+        raise ValueError("Resposta vazia da API")
+    
+    story_data = Story.model_validate_json(parser.buffer)
+    return _validar_historia(story_data, logger)
+
+async def gerar_json_historia(characters: List[Character], universe: Universe, description: str, logger: StoryLogger = None, story_key: str = None, deadline: float = None, lote: BatchDispatcher = None):
     """Gera a estrutura da história usando Gemini com retry."""
     return await retry_with_backoff(
         _gerar_json_historia_interno,
         characters, universe, description, logger,
         operation_name="geração de história",
-        logger=logger
+        logger=logger,
+        deadline=deadline,
+        expected_duration=latency_tracker.percentile(GEMINI_TEXT_MODEL, 0.5) or 0,
+        story_key=story_key,
+        lote=lote
+    )
+
+async def gerar_json_historia_stream(characters: List[Character], universe: Universe, description: str, logger: StoryLogger = None, on_event=None, on_attempt=None, story_key: str = None, deadline: float = None):
+    """Gera a história via streaming com retry (on_attempt pode abortar novas tentativas)."""
+    return await retry_with_backoff(
+        _gerar_json_historia_stream_interno,
+        characters, universe, description, logger, on_event,
+        operation_name="geração de história",
+        logger=logger,
+        on_attempt=on_attempt,
+        deadline=deadline,
+        expected_duration=latency_tracker.percentile(GEMINI_TEXT_MODEL, 0.5) or 0,
+        story_key=story_key
     )
 
 async def _gerar_imagem_interno(
     id_imagem: str, 
     prompt: str, 
-    fotos_personagens: List[Image.Image], 
+    fotos_personagens: ReferenceSet, 
     nomes: str, 
     universo: str,
     pasta_destino: str,
     ratio: str = "2:3",
     logger: StoryLogger = None,
     visual_style: str = "",
-    character_bible: str = "" # Alterado de designs para bible
+    character_bible: str = "", # Alterado de designs para bible
+    story_key: str = None,
+    on_queue: callable = None,
+    nome_arquivo: str = None,
+    lote: BatchDispatcher = None
 ) -> str:
-    """Função interna que gera uma imagem. Levanta exceção se falhar."""
+    """
+    Função interna que gera uma imagem. Levanta exceção se falhar.
+    nome_arquivo: nome do PNG gravado (padrão: {id_imagem}.png).
+    lote: envia a chamada em um batch job (sem agendador global nem hedging).
+    """
     
     if logger:
         logger.info(f"Iniciando geração de imagem: {id_imagem}", {
-            "modelo": GEMINI_IMAGE_MODEL,
+            "modelos": GEMINI_IMAGE_MODELS,
+            "modo": "batch" if lote else "direto",
             "ratio": ratio,
             "style_guide": visual_style,
             "char_bible": character_bible,
@@ -629,26 +1312,110 @@ async def _gerar_imagem_interno(
     if logger:
         logger.log_api_request(f"generate_image_{id_imagem}", user_prompt)
 
-    start_req = time.time()
-    response = await client.aio.models.generate_content(
-        model=GEMINI_IMAGE_MODEL,
-        contents=[user_prompt] + fotos_personagens,
-        config=types.GenerateContentConfig(
-            response_modalities=['IMAGE'],
-            image_config=types.ImageConfig(
-                aspect_ratio=ratio,
-                image_size="2K"  # Ativação Real de 2K (Ponto 1 da avaliação)
-            ),
-        )
+    # No modo "files" o primeiro acesso envia as fotos; os demais reutilizam as referências
+    referencias = await fotos_personagens.contents()
+    
+    config = types.GenerateContentConfig(
+        response_modalities=['IMAGE'],
+        image_config=types.ImageConfig(
+            aspect_ratio=ratio,
+            image_size="2K"  # Ativação Real de 2K (Ponto 1 da avaliação)
+        ),
     )
-    duration = time.time() - start_req
+
+    modelo = None
+
+    def chamar_modelo():
+        contar_chamada(story_key)
+        return (lote or client.aio.models).generate_content(
+            model=modelo,
+            contents=[user_prompt] + referencias,
+            config=config
+        )
+    
+    hedge_apos = None
+    
+    def on_hedge(elapsed):
+        nonlocal hedge_apos
+        hedge_apos = elapsed
+        if logger:
+            logger.warn(f"Imagem {id_imagem} lenta: cópia da chamada disparada após {elapsed:.1f}s")
+    
+    def registrar_resposta(response, duration):
+        tokens = registrar_tokens(modelo, getattr(response, "usage_metadata", None))
+        if logger:
+            metadata = {"modelo": modelo, "espera_fila": f"{start_req - queued_at:.2f}s", **tokens}
+            if hedge_apos is not None:
+                metadata["hedge_apos"] = f"{hedge_apos:.1f}s"
+            logger.log_api_response(f"generate_image_{id_imagem}", duration, metadata)
+
+    # A imagem é extraída dentro do bloco do breaker: resposta vazia ou malformada conta como falha
+    # do modelo; bloqueio de conteúdo (ConteudoBloqueadoError) é problema do pedido e não conta
+    queued_at = time.time()
+    if lote:
+        with image_models.escolher(track_latency=False, neutral=(ConteudoBloqueadoError,)) as modelo:
+            start_req = time.time()
+            response = await chamar_modelo()
+            duration = time.time() - start_req
+            registrar_resposta(response, duration)
+            image = _imagem_da_resposta(response, id_imagem, logger)
+        metric_batch_latency.observe(duration, kind="imagem")
+    else:
+        async with image_scheduler.slot(story_key, on_position=on_queue):
+            # O modelo é escolhido já com a vaga: o circuito pode ter mudado durante a fila
+            with image_models.escolher(neutral=(ConteudoBloqueadoError,)) as modelo:
+                start_req = time.time()
+                # A cópia (hedge) só sai se houver vaga sobrando no agendador global
+                response = await hedged(
+                    modelo,
+                    chamar_modelo,
+                    image_hedge_policy,
+                    try_reserve=image_scheduler.try_acquire,
+                    release=image_scheduler.release,
+                    on_hedge=on_hedge
+                )
+                duration = time.time() - start_req
+                registrar_resposta(response, duration)
+                image = _imagem_da_resposta(response, id_imagem, logger)
+            metric_image_latency.observe(duration, model=modelo, aspect_ratio=ratio)
+            metric_image_queue_wait.observe(start_req - queued_at, model=modelo)
+
+    # Salvar imagem em disco
+    filename = nome_arquivo or f"{id_imagem}.png"
+    filepath = os.path.join(pasta_destino, filename)
+
+    # PNG no pool de processos (não bloqueia os outros streams SSE);
+    # as versões menores saem sob demanda em /api/stories/{id}/images/{image_id}
+    with metric_pillow.time(operation="salvar_imagem_gerada"):
+        info = await image_processor.salvar_imagem_gerada(image.image_bytes, filepath)
+    original_size = info["dimensoes"]
 
     if logger:
-        logger.log_api_response(f"generate_image_{id_imagem}", duration)
+        logger.track_model(modelo, id_imagem)
+        logger.success(f"Imagem gerada: {id_imagem}", {
+            "modelo": modelo,
+            "arquivo_png": filename,
+            "dimensoes": f"{original_size[0]}x{original_size[1]}",
+            "tamanho_png": f"{info['tamanho_png'] / 1024:.1f}KB"
+        })
+
+    return filename
 
+def _imagem_da_resposta(response, id_imagem: str, logger: StoryLogger = None):
+    """
+    Primeira imagem da resposta do modelo. Bloqueio de segurança ou do prompt
+    levanta ConteudoBloqueadoError; resposta vazia ou malformada, ValueError.
+    """
     if not response:
         raise ValueError("Resposta nula da API")
 
+    feedback = getattr(response, "prompt_feedback", None)
+    if feedback is not None and feedback.block_reason:
+        raise ConteudoBloqueadoError(f"Bloqueio de Prompt: {feedback.block_reason.name} {feedback.block_reason_message or ''}".strip())
+    candidates = getattr(response, "candidates", None) or []
+    if candidates and candidates[0].finish_reason in FINISH_REASONS_BLOQUEIO:
+        raise ConteudoBloqueadoError(f"Imagem bloqueada pelo modelo: {candidates[0].finish_reason.name}")
+
     # Validação robusta de partes/candidatos para evitar erro NoneType
     parts_to_process = []
     try:
@@ -676,34 +1443,7 @@ async def _gerar_imagem_interno(
 
     for part in parts_to_process:
         if image := part.as_image():
-            # Salvar imagem em disco
-            filename = f"{id_imagem}.png"
-            filepath = os.path.join(pasta_destino, filename)
-            image.save(filepath)
-            
-            # Também criar versão WebP otimizada
-            webp_filename = f"{id_imagem}.webp"
-            webp_filepath = os.path.join(pasta_destino, webp_filename)
-            
-            # Otimizar para web
-            with Image.open(filepath) as img:
-                original_size = img.size
-                img.thumbnail((1200, 1200), Image.Resampling.LANCZOS)
-                img.save(webp_filepath, "WEBP", quality=85, optimize=True)
-                webp_size = os.path.getsize(webp_filepath)
-            
-            png_size = os.path.getsize(filepath)
-            
-            if logger:
-                logger.success(f"Imagem gerada: {id_imagem}", {
-                    "arquivo_png": filename,
-                    "arquivo_webp": webp_filename,
-                    "dimensoes": f"{original_size[0]}x{original_size[1]}",
-                    "tamanho_png": f"{png_size / 1024:.1f}KB",
-                    "tamanho_webp": f"{webp_size / 1024:.1f}KB"
-                })
-            
-            return filename
+            return image
     
     error_msg = f"A resposta não continha uma imagem válida para {id_imagem}."
     if logger:
@@ -713,7 +1453,7 @@ async def _gerar_imagem_interno(
 async def gerar_imagem_async(
     id_imagem: str, 
     prompt: str, 
-    fotos_personagens: List[Image.Image], 
+    fotos_personagens: ReferenceSet, 
     nomes: str, 
     universo: str,
     pasta_destino: str,
@@ -721,17 +1461,33 @@ async def gerar_imagem_async(
     logger: StoryLogger = None,
     visual_style: str = "",
     character_bible: str = "",
-    on_attempt: callable = None
+    on_attempt: callable = None,
+    story_key: str = None,
+    on_queue: callable = None,
+    deadline: float = None,
+    nome_arquivo: str = None,
+    lote: BatchDispatcher = None
 ) -> Optional[str]:
-    """Gera uma imagem com retry e backoff. Retorna None se falhar após todas as tentativas."""
+    """
+    Gera uma imagem com retry e backoff. Retorna None se falhar após todas as
+    tentativas; o esgotamento do prazo (deadline) é propagado.
+    """
     try:
         return await retry_with_backoff(
             _gerar_imagem_interno,
             id_imagem, prompt, fotos_personagens, nomes, universo, pasta_destino, ratio, logger, visual_style, character_bible,
             operation_name=f"imagem {id_imagem}",
             logger=logger,
-            on_attempt=on_attempt
+            on_attempt=on_attempt,
+            deadline=deadline,
+            expected_duration=latency_tracker.percentile(GEMINI_IMAGE_MODEL, 0.5) or 0,
+            story_key=story_key,
+            on_queue=on_queue,
+            nome_arquivo=nome_arquivo,
+            lote=lote
         )
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         if logger:
             logger.error(f"Falha definitiva na imagem {id_imagem} capturada no handler externo", {
@@ -739,431 +1495,1141 @@ async def gerar_imagem_async(
             })
         return None
 
-# --- ENDPOINTS ---
-
-@app.post("/api/create-story")
-async def create_story(request: StoryRequest):
+async def executar_historia(request: StoryRequest, emitir, checkpoint: dict = None, salvar_checkpoint=None, story_key: str = None, lote: BatchDispatcher = None):
     """
-    Cria uma história completa com imagens.
-    Retorna eventos SSE em tempo real para o frontend acompanhar o progresso.
+    Pipeline completo de uma história (texto, ilustrações e story.json).
+    Cada evento de progresso é entregue a `emitir(tipo, dados)`.
+    checkpoint: estado salvo por uma execução anterior via `salvar_checkpoint`
+    (história escrita, pasta e imagens prontas); essas etapas não são refeitas.
+    story_key: chave da história nos agendadores (padrão: uuid novo).
+    lote: gera pelo modo batch (texto sem streaming; cada etapa com
+    BATCH_DEADLINE_SECONDS de prazo). Só para geração não interativa.
     """
-    async def event_generator():
-        start_time = time.time()
-        pasta_historia = None
-        folder_name = None
-        
-        # INICIALIZA LOGGER IMEDIATAMENTE (Buffer)
-        logger = StoryLogger()
-        
-        images_done = 0
-        images_failed = 0
-        
-        try:
-            # ========== ETAPA 1: INICIALIZAÇÃO ==========
-            yield send_event("stage", {
-                "stage": 1,
-                "title": "🚀 Iniciando",
-                "message": "Preparando os ingredientes mágicos...",
-                "progress": 5
-            })
-            await asyncio.sleep(0.5)
-            
-            # Preparar dados dos personagens (LIMITANDO A 5 PERSONAGENS)
-            request.characters = request.characters[:5]
-            nomes = ", ".join([c.name for c in request.characters])
-            description = request.description or f"Uma aventura épica com {nomes}"
-            
-            # LOG INPUTS
-            logger.log_input({
-                "personagens": [c.name for c in request.characters],
-                "universo": {
-                    "nome": request.universe.name,
-                    "estilo": request.universe.style
-                },
-                "descricao_usuario": request.description
-            })
-            
-            # Coletar todas as fotos (LIMITANDO A 2 FOTOS POR PERSONAGEM)
-            todas_fotos = []
-            for char in request.characters:
-                fotos_limitadas = char.images[:2]
-                fotos = decode_base64_images(fotos_limitadas, logger)
-                todas_fotos.extend(fotos)
-            
-            yield send_event("stage", {
-                "stage": 1,
-                "title": "🚀 Iniciando",
-                "message": f"Personagens carregados: {nomes}",
-                "progress": 10
-            })
-            
-            # ========== ETAPA 2: GERANDO HISTÓRIA ==========
-            yield send_event("stage", {
-                "stage": 2,
-                "title": "📜 Escrevendo a História",
-                "message": "A IA está criando uma narrativa épica...",
-                "progress": 15
-            })
-            
-            stage2_start = time.time()
-            
-            # Gerar história (Agora passamos o logger!)
-            # Usar task para permitir pings enquanto gera
-            story_task = asyncio.create_task(gerar_json_historia(
-                request.characters, 
-                request.universe, 
-                description,
-                logger=logger
-            ))
-            
-            # Loop de espera com ping
-            while not story_task.done():
-                await asyncio.sleep(2) # Ping a cada 2s para garantir conexão viva
-                yield send_event("ping", {"message": "Escrevendo..."})
-            
-            # Recuperar resultado ou erro
-            story_data = await story_task
-            
-            stage2_time = time.time() - stage2_start
-            
-            # Criar pasta para esta história
-            pasta_historia, story_id, folder_name = create_story_folder(story_data.title)
-            
+    checkpoint = checkpoint or {}
+    start_time = time.time()
+    # Prazo da história inteira; os prazos do texto e de cada imagem ficam dentro dele
+    story_deadline = time.monotonic() + (2 * BATCH_DEADLINE_SECONDS if lote else STORY_DEADLINE_SECONDS)
+    streaming = STORY_STREAMING and lote is None
+
+    def prazo(segundos: float) -> float:
+        if lote:
+            segundos = BATCH_DEADLINE_SECONDS
+        return min(time.monotonic() + segundos, story_deadline)
+    pasta_historia = None
+    folder_name = None
+
+    # INICIALIZA LOGGER IMEDIATAMENTE (Buffer)
+    logger = StoryLogger()
+    if checkpoint.get("models"):
+        # Modelos do texto e das imagens já prontos na execução anterior
+        logger.modelos = {"texto": checkpoint["models"].get("texto"), "imagens": dict(checkpoint["models"].get("imagens") or {})}
+
+    images_done = 0
+    images_failed = 0
+    tasks = {}  # id da imagem -> task de geração
+    referencias = None
+    # Chave da história no agendador global (fila justa e cancelamento em grupo)
+    story_key = story_key or uuid.uuid4().hex
+
+    try:
+        # ========== ETAPA 1: INICIALIZAÇÃO ==========
+        await emitir("stage", {
+            "stage": 1,
+            "title": "🚀 Iniciando",
+            "message": "Preparando os ingredientes mágicos...",
+            "progress": 5
+        })
+        await asyncio.sleep(0.5)
+
+        # Preparar dados dos personagens (LIMITANDO A 5 PERSONAGENS)
+        request.characters = request.characters[:5]
+        nomes = ", ".join([c.name for c in request.characters])
+        description = request.description or f"Uma aventura épica com {nomes}"
+
+        # LOG INPUTS
+        logger.log_input({
+            "personagens": [c.name for c in request.characters],
+            "universo": {
+                "nome": request.universe.name,
+                "estilo": request.universe.style
+            },
+            "descricao_usuario": request.description
+        })
+
+        # Coletar todas as fotos (LIMITANDO A 2 FOTOS POR PERSONAGEM)
+        # Fotos enviadas por upload têm prioridade sobre as em Base64
+        todas_fotos = []
+        fotos_ids = []  # Ids no PhotoStore, guardados no story.json para regenerar imagens
+        for char in request.characters:
+            ids_limitados = char.photo_ids[:2]
+            fotos = await load_uploaded_photos(ids_limitados, logger)
+            fotos_limitadas = char.images[:2 - len(fotos)]
+            fotos += await decode_base64_images(fotos_limitadas, logger)
+            todas_fotos.extend(part for _, part in fotos)
+            fotos_ids.extend(photo_id for photo_id, _ in fotos)
+            # Base64 só chega aqui em jobs criados antes de create_story trocar as fotos por
+            # photo_ids; os originais já estão no PhotoStore e não ficam em memória
+            char.images = []
+
+        referencias = ReferenceSet(
+            todas_fotos,
+            mode=REFERENCE_UPLOAD_MODE,
+            files_service=client.aio.files,
+            label=story_key[:8],
+            memory=reference_memory
+        )
+        metric_reference_story_bytes.observe(referencias.nbytes)
+
+        await emitir("stage", {
+            "stage": 1,
+            "title": "🚀 Iniciando",
+            "message": f"Personagens carregados: {nomes}",
+            "progress": 10
+        })
+
+        # ========== ETAPA 2: GERANDO HISTÓRIA ==========
+        await emitir("stage", {
+            "stage": 2,
+            "title": "📜 Escrevendo a História",
+            "message": "A IA está criando uma narrativa épica...",
+            "progress": 15
+        })
+
+        stage2_start = time.time()
+
+        # Fila única para eventos parciais da história, inícios, retries e resultados de imagens
+        result_queue = asyncio.Queue()
+        campos = {}   # Campos de primeiro nível já conhecidos da história
+        partes = {}   # Número da parte (1-5) -> [texto, prompt]
+        estagio_atual = 2
+        historia_fixada = False  # Retry do streaming depois de imagens disparadas
+        img_start = None
+        story_id = None
+        story_data = None
+
+        # Imagens que falharam definitivamente (id -> erro)
+        image_errors = {}
+
+        # Imagens concluídas em uma execução anterior e ainda presentes em disco
+        generated_images = {
+            id_img: url for id_img, url in (checkpoint.get("images") or {}).items()
+            if os.path.exists(os.path.join(STORIES_DIR, checkpoint["folder"], os.path.basename(url)))
+        } if checkpoint.get("folder") else {}
+
+        async def gravar_checkpoint():
+            """Salva a história escrita e as imagens prontas (para retomada do job)"""
+            if salvar_checkpoint and story_data is not None:
+                await salvar_checkpoint({
+                    "story": story_data.model_dump(),
+                    "story_id": story_id,
+                    "folder": folder_name,
+                    "images": generated_images,
+                    "models": logger.modelos
+                })
+
+        def preparar_pasta(titulo):
+            """Cria a pasta da história (uma única vez) e ativa o log em arquivo"""
+            nonlocal pasta_historia, story_id, folder_name
+            if pasta_historia:
+                return
+            if checkpoint.get("folder"):
+                # Retomada: reaproveita a pasta (e as imagens) da execução anterior
+                story_id, folder_name = checkpoint["story_id"], checkpoint["folder"]
+                pasta_historia = os.path.join(STORIES_DIR, folder_name)
+                os.makedirs(pasta_historia, exist_ok=True)
+            else:
+                pasta_historia, story_id, folder_name = create_story_folder(titulo)
+
             # ========== ATIVAR LOG EM ARQUIVO ==========
             # Agora que temos a pasta, despejamos o log
-            logger.start_file_logging(pasta_historia, story_data.title)
-            
+            logger.start_file_logging(pasta_historia, titulo, append=bool(checkpoint.get("folder")))
+
             logger.info("Geração de história iniciada", {
                 "personagens": nomes,
                 "universo": request.universe.name,
-                "descricao": description[:200]
-            })
-            logger.success(f"História gerada em {stage2_time:.1f}s", {
-                "titulo": story_data.title,
-                "partes": len(story_data.parts)
+                "descricao": description[:200],
+                "modo": "batch" if lote else "direto"
             })
-            
+
             # Log das fotos recebidas
-            logger.info(f"Imagens de personagens carregadas", {
+            logger.info("Imagens de personagens carregadas", {
                 "total_fotos": len(todas_fotos),
-                "personagens": [c.name for c in request.characters]
-            })
-            
-            yield send_event("story_created", {
-                "stage": 2,
-                "title": "📜 História Criada!",
-                "message": f"Título: {story_data.title}",
-                "progress": 25,
-                "elapsed": round(stage2_time, 1),
-                "data": {
-                    "title": story_data.title,
-                    "parts": story_data.parts,
-                    "storyId": story_id,
-                    "folder": folder_name
-                }
-            })
-            
-            # ========== ETAPA 3: GERANDO IMAGENS EM PARALELO ==========
-            total_images = 6  # 1 capa + 5 partes
-            generated_images = {}
-            
-            yield send_event("stage", {
-                "stage": 3,
-                "title": "🎨 Gerando Imagens",
-                "message": f"Criando {total_images} ilustrações em paralelo...",
-                "progress": 30
-            })
-            
-            # Enviar eventos de início para TODAS as imagens
-            yield send_event("image_start", {
-                "stage": 3,
-                "imageId": "capa",
-                "message": "Iniciando geração da capa...",
-                "currentImage": 1,
-                "totalImages": total_images
+                "personagens": [c.name for c in request.characters],
+                "modo_envio": referencias.mode,
+                "memoria_kb": round(referencias.nbytes / 1024, 1)
             })
-            
-            for i in range(1, 6):
-                yield send_event("image_start", {
-                    "stage": 3,
-                    "imageId": f"parte_{i}",
-                    "message": f"Iniciando capítulo {i}...",
-                    "currentImage": i + 1,
-                    "totalImages": total_images
+
+        async def gerar_e_notificar(id_img, prompt, ratio):
+            """Gera imagem e coloca resultado na queue"""
+            start = time.time()
+            try:
+                async def notify_attempt(attempt):
+                    await result_queue.put({
+                        "type": "retry",
+                        "id": id_img,
+                        "attempt": attempt
+                    })
+
+                def notify_queue(position):
+                    result_queue.put_nowait({
+                        "type": "queued",
+                        "id": id_img,
+                        "position": position
+                    })
+
+                filename = await gerar_imagem_async(
+                    id_img, prompt, referencias, nomes,
+                    request.universe.style, pasta_historia, ratio=ratio,
+                    logger=logger,
+                    visual_style=campos["visual_style"],
+                    character_bible=campos["character_bible"],
+                    on_attempt=notify_attempt,
+                    story_key=story_key,
+                    on_queue=notify_queue,
+                    deadline=prazo(IMAGE_DEADLINE_SECONDS),
+                    lote=lote
+                )
+                elapsed = time.time() - start
+                await result_queue.put({
+                    "type": "result",
+                    "id": id_img, 
+                    "filename": filename, 
+                    "elapsed": round(elapsed, 1),
+                    "error": None
                 })
-            
-            # Usar Queue para receber resultados em tempo real
-            result_queue = asyncio.Queue()
-            img_start = time.time()
-            
-            async def gerar_e_notificar(id_img, prompt, ratio):
-                """Gera imagem e coloca resultado na queue"""
-                start = time.time()
-                try:
-                    async def notify_attempt(attempt):
-                        await result_queue.put({
-                            "type": "retry",
-                            "id": id_img,
-                            "attempt": attempt
-                        })
+            except Exception as e:
+                elapsed = time.time() - start
+                await result_queue.put({
+                    "id": id_img, 
+                    "filename": None, 
+                    "elapsed": round(elapsed, 1),
+                    "error": str(e)
+                })
+
+        def lancar_imagem(id_img, prompt, ratio):
+            """Dispara a geração de uma imagem (uma única vez por id)"""
+            nonlocal img_start
+            if id_img in tasks or id_img in generated_images:
+                return
+            if img_start is None:
+                img_start = time.time()
+            result_queue.put_nowait({"type": "start", "id": id_img})
+            tasks[id_img] = image_scheduler.submit(story_key, gerar_e_notificar(id_img, prompt, ratio))
+
+        def lancar_prontas():
+            """Dispara as imagens cujo prompt e guias visuais já estão completos"""
+            if not all(k in campos for k in ("title", "visual_style", "character_bible")):
+                return
+            preparar_pasta(campos["title"])
+            if "cover_prompt" in campos:
+                lancar_imagem("capa", campos["cover_prompt"], "3:2")
+            for num, (texto, prompt) in sorted(partes.items()):
+                lancar_imagem(f"parte_{num}", prompt, "4:5")
 
-                    filename = await gerar_imagem_async(
-                        id_img, prompt, todas_fotos, nomes,
-                        request.universe.style, pasta_historia, ratio=ratio,
+        async def on_story_event(kind, key, value):
+            """Recebe cada campo/parte da história assim que o streaming o completa"""
+            if kind == "field":
+                if not (historia_fixada and key in campos):
+                    campos[key] = value
+            elif kind == "part" and isinstance(value, list) and len(value) == 2:
+                if not (historia_fixada and key + 1 in partes):
+                    partes[key + 1] = value
+            await result_queue.put({"type": "story_partial"})
+            lancar_prontas()
+
+        async def on_story_attempt(attempt):
+            """
+            Antes de qualquer imagem, a nova tentativa recomeça do zero. Com
+            imagens já disparadas, o que já chegou fica valendo (é o que elas
+            usam) e a nova tentativa só completa os campos e partes que faltam.
+            """
+            nonlocal historia_fixada
+            if attempt == 1:
+                return
+            if not tasks:
+                campos.clear()
+                partes.clear()
+                return
+            if not historia_fixada:
+                historia_fixada = True
+                logger.warn("Streaming da história interrompido após o início das ilustrações; mantendo o que já chegou", {
+                    "campos": sorted(campos),
+                    "partes": sorted(partes),
+                    "imagens_iniciadas": sorted(tasks)
+                })
+
+        def mesclar_fixados(story: Story) -> Story:
+            """História final com os campos e partes da tentativa que disparou as imagens"""
+            fixos = {k: v for k, v in campos.items() if k in Story.model_fields and k != "parts"}
+            fixos["parts"] = [partes.get(num, part) for num, part in enumerate(story.parts, 1)]
+            return story.model_copy(update=fixos)
+
+        async def escrever_historia():
+            """Gera a história (streaming ou resposta única) e sinaliza o fim na queue"""
+            try:
+                if checkpoint.get("story"):
+                    return Story.model_validate(checkpoint["story"])
+                if streaming:
+                    return await gerar_json_historia_stream(
+                        request.characters,
+                        request.universe,
+                        description,
                         logger=logger,
-                        visual_style=story_data.visual_style,
-                        character_bible=story_data.character_bible,
-                        on_attempt=notify_attempt
+                        on_event=on_story_event,
+                        on_attempt=on_story_attempt,
+                        story_key=story_key,
+                        deadline=prazo(TEXT_DEADLINE_SECONDS)
                     )
-                    elapsed = time.time() - start
-                    await result_queue.put({
-                        "type": "result",
-                        "id": id_img, 
-                        "filename": filename, 
-                        "elapsed": round(elapsed, 1),
-                        "error": None
-                    })
-                except Exception as e:
-                    elapsed = time.time() - start
-                    await result_queue.put({
-                        "id": id_img, 
-                        "filename": None, 
-                        "elapsed": round(elapsed, 1),
-                        "error": str(e)
+                return await gerar_json_historia(
+                    request.characters, 
+                    request.universe, 
+                    description,
+                    logger=logger,
+                    story_key=story_key,
+                    deadline=prazo(TEXT_DEADLINE_SECONDS),
+                    lote=lote
+                )
+            finally:
+                await result_queue.put({"type": "story_done"})
+
+        # Usar task para acompanhar os eventos enquanto gera
+        story_task = text_scheduler.submit(story_key, escrever_historia())
+
+        # ========== ETAPA 3: GERANDO IMAGENS (À MEDIDA QUE OS PROMPTS CHEGAM) ==========
+        total_images = 6  # 1 capa + 5 partes
+
+        # Processar eventos conforme vão chegando (tempo real)
+        images_done = len(generated_images)
+        images_failed = 0
+
+        while story_data is None or images_done + images_failed < total_images:
+            # Os pings do SSE ficam a cargo de quem acompanha o job
+            queue_item = await result_queue.get()
+
+            item_type = queue_item.get("type")
+
+            if item_type == "story_done":
+                # Recuperar resultado ou erro
+                story_data = await story_task
+                stage2_time = time.time() - stage2_start
+                if historia_fixada:
+                    story_data = mesclar_fixados(story_data)
+
+                campos.update(story_data.model_dump(exclude={"parts"}))
+                partes.update({num: part for num, part in enumerate(story_data.parts, 1)})
+                preparar_pasta(story_data.title)
+
+                logger.success(f"História gerada em {stage2_time:.1f}s", {
+                    "titulo": story_data.title,
+                    "partes": len(story_data.parts),
+                    "streaming": streaming,
+                    "imagens_ja_iniciadas": len(tasks)
+                })
+
+                await emitir("story_created", {
+                    "stage": estagio_atual,
+                    "title": "📜 História Criada!",
+                    "message": f"Título: {story_data.title}",
+                    "progress": 25 if estagio_atual == 2 else 30,
+                    "elapsed": round(stage2_time, 1),
+                    "data": {
+                        "title": story_data.title,
+                        "parts": story_data.parts,
+                        "storyId": story_id,
+                        "folder": folder_name
+                    }
+                })
+                await gravar_checkpoint()
+
+                if generated_images and not tasks:
+                    # Retomada: reenvia as ilustrações que já estavam prontas
+                    estagio_atual = 3
+                    await emitir("stage", {
+                        "stage": 3,
+                        "title": "🎨 Gerando Imagens",
+                        "message": f"Retomando: {len(generated_images)} de {total_images} ilustrações já prontas",
+                        "progress": 30
                     })
-            
-            # Iniciar todas as tasks em paralelo (sem await)
-            tasks = []
-            tasks.append(asyncio.create_task(
-                gerar_e_notificar("capa", story_data.cover_prompt, "3:2")
-            ))
-            for i, (texto, prompt) in enumerate(story_data.parts, 1):
-                tasks.append(asyncio.create_task(
-                    gerar_e_notificar(f"parte_{i}", prompt, "4:5")
-                ))
-            
-            # Processar resultados conforme vão chegando (tempo real)
-            images_done = 0
-            images_failed = 0
-            
-            for _ in range(total_images):
-                # Aguarda resultados ou retries com timeout para enviar pings
-                while True:
-                    try:
-                        # Tenta pegar objeto da fila
-                        queue_item = await asyncio.wait_for(result_queue.get(), timeout=2.0)
-                        
-                        # Se for um evento de retry, envia SSE e continua esperando o resultado final
-                        if queue_item.get("type") == "retry":
-                            yield send_event("image_retry", {
-                                "stage": 3,
-                                "imageId": queue_item["id"],
-                                "attempt": queue_item["attempt"]
-                            })
-                            continue
-                        
-                        # Se chegamos aqui, é um resultado final (sucesso ou erro definitivo)
-                        result = queue_item
-                        break 
-                    except asyncio.TimeoutError:
-                        # Caso demore, envia ping para manter o SSE vivo
-                        yield send_event("ping", {"message": "Gerando ilustrações..."})
-                        continue
-                
-                if result.get("error"):
-                    images_failed += 1
-                    if logger:
-                        logger.error(f"Falha na imagem {result['id']}", {
-                            "tempo": f"{result['elapsed']}s",
-                            "erro": result["error"]
+                    for id_img, image_url in generated_images.items():
+                        await emitir("image_done", {
+                            "stage": 3,
+                            "imageId": id_img,
+                            "message": "Ilustração recuperada",
+                            "elapsed": 0,
+                            "imageUrl": image_url,
+                            "totalImages": total_images,
+                            "progress": 30 + (len(generated_images) / total_images * 60)
                         })
-                    # Enviar evento de erro para essa imagem específica
-                    yield send_event("image_error", {
+
+                # Dispara o que ainda falta (tudo, no modo sem streaming)
+                lancar_prontas()
+                continue
+
+            if item_type == "story_partial":
+                if story_data is not None:
+                    continue
+                titulo = campos.get("title")
+                await emitir("story_created", {
+                    "stage": estagio_atual,
+                    "title": "📜 Escrevendo a História",
+                    "message": f"Título: {titulo}" if titulo else "A IA está criando uma narrativa épica...",
+                    "progress": 15 + 2 * len(partes) if estagio_atual == 2 else 30,
+                    "elapsed": round(time.time() - stage2_start, 1),
+                    "partial": True,
+                    "data": {
+                        "title": titulo,
+                        "parts": [partes[num] for num in sorted(partes)],
+                        "storyId": story_id,
+                        "folder": folder_name
+                    }
+                })
+                continue
+
+            if item_type in ("start", "queued"):
+                if estagio_atual == 2:
+                    estagio_atual = 3
+                    await emitir("stage", {
                         "stage": 3,
-                        "imageId": result["id"],
-                        "message": f"Falha ao gerar {result['id']}",
-                        "error": result["error"]
+                        "title": "🎨 Gerando Imagens",
+                        "message": f"Criando {total_images} ilustrações em paralelo...",
+                        "progress": 30
                     })
-                    continue
-                    
-                if result["filename"]:
-                    images_done += 1
-                    image_url = f"/historias/{folder_name}/{result['filename']}"
-                    generated_images[result["id"]] = image_url
-                    
-                    # Determinar número do capítulo para mensagem
-                    if result["id"] == "capa":
-                        msg = "Capa criada!"
-                        current_num = 1
-                    else:
-                        cap_num = int(result["id"].split("_")[1])
-                        msg = f"Capítulo {cap_num} ilustrado!"
-                        current_num = cap_num + 1
-                    
-                    # ENVIAR EVENTO IMEDIATAMENTE (tempo real!)
-                    yield send_event("image_done", {
+
+                if queue_item["id"] == "capa":
+                    msg = "Iniciando geração da capa..."
+                    current_num = 1
+                else:
+                    cap_num = int(queue_item["id"].split("_")[1])
+                    msg = f"Iniciando capítulo {cap_num}..."
+                    current_num = cap_num + 1
+
+                if item_type == "queued":
+                    # Posição na fila global (0 = vaga concedida); muda a cada avanço
+                    # e a cada retry, então não reinicia tentativas nem cronômetro
+                    position = queue_item["position"]
+                    await emitir("image_queued", {
                         "stage": 3,
-                        "imageId": result["id"],
-                        "message": msg,
-                        "elapsed": result["elapsed"],
-                        "imageUrl": image_url,
-                        "currentImage": current_num,
-                        "totalImages": total_images,
-                        "progress": 30 + ((images_done + images_failed) / total_images * 60)
+                        "imageId": queue_item["id"],
+                        "message": f"Na fila de geração (posição {position})..." if position > 0 else msg,
+                        "queuePosition": position
                     })
-            
-            # Garantir que todas as tasks terminaram
-            await asyncio.gather(*tasks, return_exceptions=True)
-            
-            total_img_time = time.time() - img_start
-            if logger:
-                logger.info(f"Geração de imagens concluída", {
-                    "sucesso": images_done,
-                    "falha": images_failed,
-                    "tempo_total": f"{total_img_time:.1f}s"
+                    continue
+
+                await emitir("image_start", {
+                    "stage": 3,
+                    "imageId": queue_item["id"],
+                    "message": msg,
+                    "currentImage": current_num,
+                    "totalImages": total_images
                 })
-            
-            # Verificar se houve falhas (NECESSÁRIO 6 IMAGENS PARA SUCESSO)
-            if images_failed > 0:
-                error_msg = f"Geração incompleta. {images_done} imagens geradas, {images_failed} falharam."
+                continue
+
+            # Se for um evento de retry, envia SSE e continua esperando o resultado final
+            if item_type == "retry":
+                await emitir("image_retry", {
+                    "stage": 3,
+                    "imageId": queue_item["id"],
+                    "attempt": queue_item["attempt"]
+                })
+                continue
+
+            # Se chegamos aqui, é um resultado final (sucesso ou erro definitivo)
+            result = queue_item
+
+            if result.get("error") or not result["filename"]:
+                result["error"] = result.get("error") or f"Falha após {MAX_RETRIES} tentativas"
+                image_errors[result["id"]] = result["error"]
+                images_failed += 1
                 if logger:
-                    logger.error(error_msg, {"sucesso": images_done, "falha": images_failed})
-                    logger.finalize(time.time() - start_time, images_done, images_failed)
-                
-                yield send_event("error", {
+                    logger.error(f"Falha na imagem {result['id']}", {
+                        "tempo": f"{result['elapsed']}s",
+                        "erro": result["error"]
+                    })
+                # Enviar evento de erro para essa imagem específica
+                await emitir("image_error", {
                     "stage": 3,
-                    "title": "❌ Geração Incompleta",
-                    "message": f"Não foi possível gerar todas as 6 imagens da história. Tente novamente mais tarde.",
-                    "progress": 0
+                    "imageId": result["id"],
+                    "message": f"Falha ao gerar {result['id']}",
+                    "error": result["error"]
                 })
-                # Não salva o JSON se estiver incompleto (ou poderia salvar com status failed/incomplete)
-                # O usuário pediu para não aparecer na galeria se não tiver todas.
-                # Então, vamos evitar criar o story.json final ou marcar como hidden.
-                # Opção: Não criar story.json final.
-                return
+                continue
 
-            # ========== ETAPA 4: SALVAR E FINALIZAR ==========
-            total_time = time.time() - start_time
-            
-            # Montar objeto final da história
-            final_story = {
-                "id": story_id,
-                "folder": folder_name,
-                "createdAt": datetime.now().isoformat(),
-                "status": "completed", # Status explícito
-                "title": story_data.title,
-                "visual_style": story_data.visual_style,
-                "character_bible": story_data.character_bible, # Salvando
-                "cover_prompt": story_data.cover_prompt,
-                "parts": story_data.parts,
-                "images": generated_images,
-                "universe": {
-                    "id": request.universe.id,
-                    "name": request.universe.name,
-                    "style": request.universe.style
-                },
-                "characters": [{"id": c.id, "name": c.name} for c in request.characters],
-                "totalTime": round(total_time, 1)
-            }
-            
-            # Salvar JSON da história
-            json_path = os.path.join(pasta_historia, "story.json")
-            with open(json_path, "w", encoding="utf-8") as f:
-                json.dump(final_story, f, indent=2, ensure_ascii=False)
-            
+            if result["filename"]:
+                images_done += 1
+                image_url = f"/historias/{folder_name}/{result['filename']}"
+                generated_images[result["id"]] = image_url
+
+                # Determinar número do capítulo para mensagem
+                if result["id"] == "capa":
+                    msg = "Capa criada!"
+                    current_num = 1
+                else:
+                    cap_num = int(result["id"].split("_")[1])
+                    msg = f"Capítulo {cap_num} ilustrado!"
+                    current_num = cap_num + 1
+
+                # ENVIAR EVENTO IMEDIATAMENTE (tempo real!)
+                await emitir("image_done", {
+                    "stage": 3,
+                    "imageId": result["id"],
+                    "message": msg,
+                    "elapsed": result["elapsed"],
+                    "imageUrl": image_url,
+                    "currentImage": current_num,
+                    "totalImages": total_images,
+                    "progress": 30 + ((images_done + images_failed) / total_images * 60)
+                })
+                await gravar_checkpoint()
+
+        # Garantir que todas as tasks terminaram
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+        total_img_time = time.time() - (img_start or start_time)
+        if logger:
+            logger.info("Geração de imagens concluída", {
+                "sucesso": images_done,
+                "falha": images_failed,
+                "tempo_total": f"{total_img_time:.1f}s"
+            })
+
+        # ========== ETAPA 4: SALVAR E FINALIZAR ==========
+        # Com falhas, a história é salva como incompleta: o texto e as imagens
+        # prontas são mantidos e as que faltam podem ser regeneradas uma a uma
+        total_time = time.time() - start_time
+
+        # Montar objeto final da história
+        final_story = {
+            "id": story_id,
+            "folder": folder_name,
+            "createdAt": datetime.now().isoformat(),
+            "status": "completed" if images_failed == 0 else "incomplete", # Status explícito
+            "title": story_data.title,
+            "visual_style": story_data.visual_style,
+            "character_bible": story_data.character_bible, # Salvando
+            "cover_prompt": story_data.cover_prompt,
+            "parts": story_data.parts,
+            "images": generated_images,
+            "image_state": estado_das_imagens(generated_images, image_errors),
+            # Modelo que de fato gerou o texto e cada imagem (pode ser um fallback da cadeia)
+            "models": {
+                "text": logger.modelos["texto"],
+                "images": {id_img: logger.modelos["imagens"].get(id_img) for id_img in generated_images}
+            },
+            "reference_photos": fotos_ids,
+            "universe": {
+                "id": request.universe.id,
+                "name": request.universe.name,
+                "style": request.universe.style
+            },
+            "characters": [{"id": c.id, "name": c.name} for c in request.characters],
+            "totalTime": round(total_time, 1)
+        }
+
+        # Salvar JSON da história
+        json_path = await asyncio.to_thread(salvar_story_json, final_story)
+
+        if images_failed > 0:
+            error_msg = f"Geração incompleta. {images_done} imagens geradas, {images_failed} falharam."
             if logger:
-                logger.success("JSON da história salvo", {"arquivo": json_path})
+                logger.error(error_msg, {"sucesso": images_done, "falha": images_failed, "arquivo": json_path})
                 logger.finalize(total_time, images_done, images_failed)
-            
-            yield send_event("complete", {
-                "stage": 4,
-                "title": "✨ História Completa!",
-                "message": f"Sua história foi criada em {round(total_time, 1)} segundos!",
-                "progress": 100,
-                "totalTime": round(total_time, 1),
+
+            await emitir("error", {
+                "stage": 3,
+                "title": "❌ Geração Incompleta",
+                "message": "Não foi possível gerar todas as 6 imagens da história. Ela foi salva na galeria e as ilustrações que faltam podem ser geradas novamente.",
+                "progress": 0,
                 "data": final_story
             })
-            
-        except Exception as e:
-            error_trace = traceback.format_exc()
-            print(f"❌ Erro na geração: {e}")
-            print(error_trace)
-            
-            if logger:
-                logger.error("Erro fatal na geração", {
-                    "erro": str(e),
-                    "traceback": error_trace[:1000]  # Limita para não ficar muito grande
-                })
-                logger.finalize(time.time() - start_time, images_done, images_failed)
-            
-            yield send_event("error", {
+            return
+
+        if logger:
+            logger.success("JSON da história salvo", {"arquivo": json_path})
+            logger.finalize(total_time, images_done, images_failed)
+
+        await emitir("complete", {
+            "stage": 4,
+            "title": "✨ História Completa!",
+            "message": f"Sua história foi criada em {round(total_time, 1)} segundos!",
+            "progress": 100,
+            "totalTime": round(total_time, 1),
+            "data": final_story
+        })
+
+    except Exception as e:
+        error_trace = traceback.format_exc()
+        print(f"❌ Erro na geração: {e}")
+        print(error_trace)
+
+        if logger:
+            logger.error("Erro fatal na geração", {
+                "erro": str(e),
+                "traceback": error_trace[:1000]  # Limita para não ficar muito grande
+            })
+            logger.finalize(time.time() - start_time, images_done, images_failed)
+
+        await emitir("error", {
+            "stage": -1,
+            "title": "❌ Erro",
+            "message": str(e),
+            "progress": 0
+        })
+    finally:
+        # Não deixar tasks órfãs consumindo cota se a geração foi interrompida
+        text_scheduler.cancel(story_key)
+        image_scheduler.cancel(story_key)
+
+        # Liberar as fotos (e remover as enviadas à Files API), mesmo se o stream foi cancelado
+        if referencias:
+            await asyncio.shield(referencias.close())
+
+async def executar_job(job: dict) -> str:
+    """
+    Handler da fila de jobs: roda a história (retomando do checkpoint, se
+    houver) com todo evento indo para o log do job. Retorna o estado final.
+    """
+    job_id = job["id"]
+    status = "error"
+
+    async def emitir(event_type: str, data: dict):
+        nonlocal status
+        if event_type == "complete":
+            status = "complete"
+        payload = json.dumps({"type": event_type, **data}, ensure_ascii=False)
+        await job_events.append(job_id, event_type, payload)
+
+    async def salvar_checkpoint(data: dict):
+        await asyncio.to_thread(job_store.save_checkpoint, job_id, data)
+
+    if job["attempts"] > JOB_MAX_ATTEMPTS:
+        # Job que derruba (ou sempre perde) o worker: não tenta de novo
+        await emitir("error", {
+            "stage": -1,
+            "title": "❌ Erro",
+            "message": "A geração foi interrompida repetidas vezes e não será retomada.",
+            "progress": 0
+        })
+        return "interrupted"
+
+    # Sai do dict do job: as fotos em Base64 não ficam vivas durante toda a geração
+    request = StoryRequest.model_validate(job.pop("request"))
+    # A chave da história nos agendadores é o id do job (contabiliza as chamadas)
+    chamadas_por_historia[job_id] = 0
+    try:
+        await executar_historia(request, emitir, job["checkpoint"], salvar_checkpoint, story_key=job_id)
+    except asyncio.CancelledError:
+        if job.get("abandoned"):
+            # Ninguém acompanhando: tudo o que foi gerado nesta execução é descartado
+            metricas_cancelamento["historias_abandonadas"] += 1
+            metricas_cancelamento["chamadas_desperdicadas"] += chamadas_por_historia.get(job_id, 0)
+            await emitir("error", {
                 "stage": -1,
-                "title": "❌ Erro",
-                "message": str(e),
+                "title": "❌ Cancelada",
+                "message": "A geração foi cancelada porque ninguém estava acompanhando.",
                 "progress": 0
             })
-    
+        raise
+    finally:
+        chamadas_por_historia.pop(job_id, None)
+    return status
+
+def criar_lote(journal_path: str = None) -> BatchDispatcher:
+    """Dispatcher do modo batch sobre a batch API do backend configurado"""
+    return BatchDispatcher(
+        client.aio.batches,
+        max_requests=BATCH_MAX_REQUESTS,
+        max_bytes=int(BATCH_MAX_MB * 1024 * 1024),
+        max_wait=BATCH_MAX_WAIT_SECONDS,
+        poll_interval=BATCH_POLL_SECONDS,
+        journal_path=journal_path
+    )
+
+def criar_job_worker() -> JobWorker:
+    """Consumidor da fila (no processo da API ou em worker.py)"""
+    return JobWorker(
+        job_events,
+        executar_job,
+        concurrency=JOB_CONCURRENCY,
+        lease_seconds=JOB_LEASE_SECONDS,
+        abandon_after=JOB_ABANDON_SECONDS or None
+    )
+
+async def acompanhar_job(job_id: str, after_seq: int = 0):
+    """Stream SSE de um job: repete os eventos após after_seq e segue ao vivo"""
+    with metric_sse_duration.time():
+        async for seq, payload in job_events.follow(job_id, after_seq, ping_interval=2.0):
+            if seq is None:
+                # Caso demore, envia ping para manter o SSE vivo
+                yield send_event("ping", {"message": "Gerando..."})
+                continue
+            yield f"id: {seq}\ndata: {payload}\n\n"
+
+def resposta_sse(job_id: str, after_seq: int = 0) -> StreamingResponse:
     return StreamingResponse(
-        event_generator(),
+        acompanhar_job(job_id, after_seq),
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
             "Connection": "keep-alive",
-            "X-Accel-Buffering": "no"
+            "X-Accel-Buffering": "no",
+            "X-Job-Id": job_id
         }
     )
 
+def guardar_fotos_base64(request: StoryRequest):
+    """
+    Move as fotos em Base64 do pedido para o PhotoStore: cada uma vira um
+    photo_id do personagem (depois das enviadas por upload, mantendo a
+    prioridade), e o job guarda só os ids, não os megabytes em Base64.
+    """
+    for c in request.characters:
+        for idx, b64 in enumerate(c.images):
+            if ',' in b64:
+                b64 = b64.split(',')[1]
+            estimated_size_mb = (len(b64) * 3 / 4) / (1024 * 1024)
+            if estimated_size_mb > MAX_IMAGE_SIZE_MB:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Imagem {idx + 1} de {c.name} muito grande: {estimated_size_mb:.2f}MB (máximo: {MAX_IMAGE_SIZE_MB}MB)"
+                )
+            try:
+                image_data = base64.b64decode(b64)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Imagem {idx + 1} de {c.name} inválida: {e}")
+            c.photo_ids.append(photo_store.save_bytes(image_data))
+        c.images = []
+
+def validar_photo_ids(request: StoryRequest):
+    """400 com os ids desconhecidos antes de enfileirar (o worker não descobre isso depois)"""
+    desconhecidos = [
+        photo_id for c in request.characters for photo_id in c.photo_ids
+        if not photo_store.exists(photo_id)
+    ]
+    if desconhecidos:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Fotos não encontradas: {', '.join(desconhecidos)}. Envie-as novamente em /api/characters/{{id}}/photos."
+        )
+
+def impressao_digital(request: StoryRequest) -> str:
+    """
+    Hash do pedido normalizado: personagens (com os ids das fotos, que já são
+    o hash do conteúdo), universo, descrição e modelos. O campo detached não
+    entra. Chamada depois de guardar_fotos_base64.
+    """
+    characters = []
+    for c in request.characters:
+        characters.append({"id": c.id, "name": c.name.strip(), "photos": list(c.photo_ids)})
+    normalized = {
+        "characters": characters,
+        "universe": request.universe.model_dump(),
+        "description": " ".join((request.description or "").split()),
+        "models": [GEMINI_BACKEND, GEMINI_TEXT_MODELS, GEMINI_IMAGE_MODELS],
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+# --- ENDPOINTS ---
+
+@app.post("/api/create-story")
+async def create_story(request: StoryRequest):
+    """
+    Cria uma história completa com imagens.
+    A geração é enfileirada como job e roda em um worker (não depende desta
+    conexão); a resposta são os eventos SSE do job. Se a conexão cair, retome
+    em /api/jobs/{id}/events; sem ninguém acompanhando por JOB_ABANDON_SECONDS
+    o job é cancelado, exceto com "detached": true.
+    Pedidos idênticos a um job ainda em andamento acompanham esse job (header
+    X-Job-Id com o id dele); com STORY_RESULT_CACHE_SECONDS, um pedido igual a
+    um concluído recentemente recebe direto o evento "complete" dele.
+    Fotos em Base64 vão para o PhotoStore antes do job: ele guarda só os ids.
+    """
+    await asyncio.to_thread(guardar_fotos_base64, request)
+    await asyncio.to_thread(validar_photo_ids, request)
+    fingerprint = await asyncio.to_thread(impressao_digital, request) if STORY_DEDUP else None
+    if fingerprint and STORY_RESULT_CACHE_SECONDS > 0:
+        cached = await asyncio.to_thread(job_store.completed, fingerprint, STORY_RESULT_CACHE_SECONDS)
+        if cached:
+            metric_story_requests.inc(result="cached")
+            job_id, seq = cached
+            return resposta_sse(job_id, seq - 1)
+    
+    job_id = uuid.uuid4().hex
+    active_id = await asyncio.to_thread(job_store.create, job_id, request.model_dump(), request.detached, fingerprint)
+    if active_id != job_id:
+        metric_story_requests.inc(result="joined")
+        return resposta_sse(active_id)
+    
+    metric_story_requests.inc(result="new")
+    if job_worker:
+        job_worker.wake()
+    return resposta_sse(job_id)
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Estado de um job de geração"""
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    return job
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events_stream(job_id: str, last_event_id: Optional[str] = Header(None), after: Optional[int] = None):
+    """
+    Eventos SSE de um job. Com o header Last-Event-ID (ou ?after=N), repete
+    apenas os eventos seguintes e continua ao vivo até o job terminar.
+    """
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    after_seq = after or 0
+    if last_event_id:
+        try:
+            after_seq = int(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Last-Event-ID inválido")
+    return resposta_sse(job_id, after_seq)
+
+@app.post("/api/characters/{character_id}/photos")
+async def upload_character_photos(character_id: str, request: Request, content_length: Optional[int] = Header(None)):
+    """
+    Recebe fotos de um personagem (multipart, campo `files`), grava em disco
+    em streaming e já deixa cada uma validada e preparada. Retorna os ids
+    (hash do conteúdo) para usar em `photo_ids` no POST /api/create-story.
+    O formulário é lido aqui, e não por File(...), para recusar pelo
+    Content-Length antes de o Starlette gravar o corpo em arquivo temporário.
+    """
+    if content_length is None:
+        raise HTTPException(status_code=411, detail="Content-Length obrigatório no upload")
+    if content_length > MAX_UPLOAD_BODY:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Upload maior que {MAX_UPLOAD_BODY // (1024 * 1024)}MB "
+                   f"(até {MAX_UPLOAD_FILES} fotos de {MAX_IMAGE_SIZE_MB}MB)"
+        )
+    
+    form = await request.form(max_files=MAX_UPLOAD_FILES)
+    files = [item for item in form.getlist("files") if not isinstance(item, str)]
+    if not files:
+        await form.close()
+        raise HTTPException(status_code=400, detail="Nenhum arquivo no campo files")
+    
+    photos = []
+    
+    try:
+        for upload in files:
+            try:
+                photo_id, size = await photo_store.save_stream(upload.read, MAX_IMAGE_SIZE_MB * 1024 * 1024)
+            except PhotoTooLargeError as e:
+                raise HTTPException(status_code=413, detail=f"{upload.filename}: {e}")
+            finally:
+                await upload.close()
+        
+            try:
+                part = await preparar_foto_referencia(photo_id, photo_store.path(photo_id), len(photos))
+            except Exception:
+                photo_store.remove(photo_id)
+                raise HTTPException(status_code=400, detail=f"{upload.filename}: arquivo não é uma imagem válida")
+        
+            photos.append({
+                "id": photo_id,
+                "filename": upload.filename,
+                "size": size,
+                "preparedSize": len(part.inline_data.data)
+            })
+    finally:
+        await form.close()  # Arquivos temporários das fotos não lidas (após um erro)
+    
+    return {"characterId": character_id, "photos": photos}
+
 @app.get("/api/stories")
-async def list_stories():
-    """Lista todas as histórias salvas"""
-    stories = []
-    
-    if os.path.exists(STORIES_DIR):
-        for folder_name in os.listdir(STORIES_DIR):
-            folder_path = os.path.join(STORIES_DIR, folder_name)
-            json_path = os.path.join(folder_path, "story.json")
-            
-            if os.path.isdir(folder_path) and os.path.exists(json_path):
-                try:
-                    with open(json_path, "r", encoding="utf-8") as f:
-                        story = json.load(f)
-                        images = story.get("images", {})
-                        required_keys = ["capa", "parte_1", "parte_2", "parte_3", "parte_4", "parte_5"]
-                        has_all_images = all(img_key in images for img_key in required_keys)
-                        
-                        is_complete = False
-                        if story.get("status") == "completed" and has_all_images:
-                             is_complete = True
-                        elif has_all_images:
-                             is_complete = True
-                              
-                        story["is_complete"] = is_complete
-                        stories.append(story)
-                except Exception as e:
-                    print(f"Erro ao ler {json_path}: {e}")
-    
-    # Ordenar por completude (True primeiro) e depois por data de criação (mais recente primeiro)
-    stories.sort(key=lambda x: (x.get("is_complete", False), x.get("createdAt", "")), reverse=True)
-    
-    return {"stories": stories}
+async def list_stories(
+    limit: int = Query(STORIES_PAGE_SIZE, ge=1, le=STORIES_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    universe: Optional[str] = None,
+    complete: Optional[bool] = None,
+    if_none_match: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None)
+):
+    """
+    Lista as histórias salvas (a partir do índice), uma página por vez.
+    - cursor: valor de `nextCursor` da página anterior
+    - fields: resumo por padrão; "full" para a história completa ou uma lista
+      de campos separados por vírgula (ex.: fields=title,parts)
+    - universe / complete: filtros por id do universo e por completude
+    `total` é o número de histórias com os mesmos filtros (não só da página).
+    O ETag é a versão do índice: sem histórias novas, responde 304.
+    """
+    field_list = None
+    if fields:
+        if fields in ("full", "*"):
+            field_list = ["*"]
+        else:
+            field_list = ["id"] + [f.strip() for f in fields.split(",") if f.strip() and f.strip() != "id"]
+
+    version = await asyncio.to_thread(story_index.version)
+    headers = {"ETag": etag_fraco(f"v{version}"), "Cache-Control": CACHE_REVALIDATE, "Vary": "Accept-Encoding"}
+    if nao_modificado(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    
+    def montar() -> bytes:
+        stories, next_cursor = story_index.list_page(limit, cursor, field_list, universe, complete)
+        total = story_index.count(universe, complete)
+        return json.dumps({"stories": stories, "nextCursor": next_cursor, "total": total}, ensure_ascii=False).encode("utf-8")
+    
+    key = (version, limit, cursor, tuple(field_list or ()), universe, complete)
+    try:
+        body, encoding = await asyncio.to_thread(
+            stories_response_cache.get_or_build, key, escolher_codificacao(accept_encoding), montar
+        )
+    except InvalidCursorError:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
 
 @app.get("/api/stories/{story_id}")
-async def get_story(story_id: str):
-    """Busca uma história específica pelo ID"""
-    if os.path.exists(STORIES_DIR):
-        for folder_name in os.listdir(STORIES_DIR):
-            if folder_name.startswith(story_id):
-                json_path = os.path.join(STORIES_DIR, folder_name, "story.json")
-                if os.path.exists(json_path):
-                    with open(json_path, "r", encoding="utf-8") as f:
-                        return json.load(f)
-    
-    raise HTTPException(status_code=404, detail="História não encontrada")
+async def get_story(
+    story_id: str,
+    if_none_match: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None)
+):
+    """
+    Busca uma história específica pelo ID. O ETag é a versão da história no
+    índice (304 sem ler os dados); o corpo comprimido vem das cópias do story.json.
+    """
+    entry = await asyncio.to_thread(story_index.lookup, story_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="História não encontrada")
+    story_id, folder, version = entry
+    headers = {"ETag": etag_fraco(f"{story_id}-{version}"), "Cache-Control": CACHE_REVALIDATE, "Vary": "Accept-Encoding"}
+    if nao_modificado(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    
+    encoding = escolher_codificacao(accept_encoding)
+    if encoding:
+        json_path = os.path.join(STORIES_DIR, folder, "story.json")
+        copy_path = await asyncio.to_thread(copia_comprimida, json_path, encoding)
+        if copy_path:
+            headers["Content-Encoding"] = encoding
+            return FileResponse(copy_path, media_type="application/json", headers=headers)
+    
+    # Sem cópia (histórias gravadas antes delas): o JSON do índice, comprimido uma vez por versão
+    def montar() -> bytes:
+        data = story_index.get_raw(story_id)
+        if data is None:
+            raise KeyError(story_id)
+        return data.encode("utf-8")
+    
+    try:
+        body, encoding = await asyncio.to_thread(
+            stories_response_cache.get_or_build, ("story", story_id, version), encoding, montar
+        )
+    except KeyError:
+        raise HTTPException(status_code=404, detail="História não encontrada")
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
+
+@app.get("/api/stories/{story_id}/images/{image_id}")
+async def get_story_image(
+    story_id: str,
+    image_id: str,
+    w: Optional[int] = Query(None, ge=1),
+    fmt: Optional[str] = Query(None, alias="format"),
+    accept: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    Ilustração redimensionada: a largura é arredondada para cima entre
+    IMAGE_VARIANT_WIDTHS e, sem ?format=, o formato sai do header Accept
+    (AVIF > WebP > JPEG). Gerada no primeiro pedido e servida do cache depois.
+    """
+    if image_id not in REQUIRED_IMAGES:
+        raise HTTPException(status_code=404, detail="Imagem não encontrada")
+    if fmt is not None and fmt not in VARIANT_FORMATS_AVAILABLE:
+        raise HTTPException(status_code=400, detail=f"Formato inválido. Use: {', '.join(VARIANT_FORMATS_AVAILABLE)}")
+    story = await asyncio.to_thread(story_index.get, story_id)
+    if story is None:
+        raise HTTPException(status_code=404, detail="História não encontrada")
+    filename = os.path.basename((story.get("images") or {}).get(image_id) or "")
+    if not filename:
+        raise HTTPException(status_code=404, detail="Imagem ainda não gerada")
+    
+    source = os.path.join(STORIES_DIR, story["folder"], filename)
+    formato = fmt or negociar_formato(accept, VARIANT_FORMATS_AVAILABLE)
+    largura = escolher_largura(w, IMAGE_VARIANT_WIDTHS)
+    try:
+        name = await asyncio.to_thread(VariantCache.key, source, largura, formato)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Imagem não encontrada")
+    
+    async def criar(dest_path: str) -> int:
+        with metric_pillow.time(operation=f"variante_{formato}"):
+            return await image_processor.gerar_variante(source, dest_path, largura, formato)
+    
+    # A URL é a mesma depois de uma regeneração: revalida, e o ETag (nome da variante) evita reenviar
+    headers = {"ETag": f'"{name}"', "Cache-Control": CACHE_REVALIDATE}
+    if not fmt:
+        headers["Vary"] = "Accept"
+    if nao_modificado(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    
+    path = await variant_cache.get_or_create(name, criar)
+    return FileResponse(path, media_type=VARIANT_FORMATS[formato][1], headers=headers)
+
+# Uma regeneração por vez por história (leitura-modificação-escrita do story.json).
+# Referências fracas: o lock some quando nenhuma regeneração o segura mais
+_story_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+@app.post("/api/stories/{story_id}/images/{image_id}/regenerate")
+async def regenerate_image(story_id: str, image_id: str):
+    """
+    Gera novamente uma única ilustração (capa ou parte_N), reaproveitando o
+    estilo visual, o guia dos personagens, o prompt e as fotos de referência
+    salvos na história. Completa histórias salvas como incompletas sem
+    refazer as demais chamadas. Retorna a história atualizada.
+    """
+    if image_id not in REQUIRED_IMAGES:
+        raise HTTPException(status_code=404, detail="Imagem não encontrada")
+    story = await asyncio.to_thread(story_index.get, story_id)
+    if story is None:
+        raise HTTPException(status_code=404, detail="História não encontrada")
+
+    lock = _story_locks.get(story["id"])
+    if lock is None:
+        lock = _story_locks[story["id"]] = asyncio.Lock()
+    async with lock:
+        # Relê dentro do lock: outra regeneração pode ter acabado de salvar
+        story = await asyncio.to_thread(story_index.get, story["id"])
+        
+        if image_id == "capa":
+            prompt, ratio = story.get("cover_prompt"), "3:2"
+        else:
+            num = int(image_id.split("_")[1])
+            parts = story.get("parts") or []
+            prompt, ratio = (parts[num - 1][1] if len(parts) >= num else None), "4:5"
+        if not prompt or not story.get("visual_style") or not story.get("character_bible"):
+            raise HTTPException(status_code=409, detail="A história não tem os dados necessários para regenerar esta imagem")
+        
+        pasta_historia = os.path.join(STORIES_DIR, story["folder"])
+        if not os.path.isdir(pasta_historia):
+            raise HTTPException(status_code=404, detail="Pasta da história não encontrada")
+        
+        logger = StoryLogger()
+        logger.start_file_logging(pasta_historia, story.get("title") or story["id"], append=True)
+        logger.info(f"Regenerando imagem {image_id}")
+        
+        # Fotos de referência guardadas no PhotoStore durante a geração original
+        ids_salvos = story.get("reference_photos") or []
+        ids_disponiveis = [photo_id for photo_id in ids_salvos if photo_store.exists(photo_id)]
+        if len(ids_disponiveis) < len(ids_salvos):
+            logger.warn("Fotos de referência ausentes; regenerando sem elas", {
+                "ausentes": len(ids_salvos) - len(ids_disponiveis)
+            })
+        fotos = await load_uploaded_photos(ids_disponiveis, logger)
+        referencias = ReferenceSet(
+            [part for _, part in fotos],
+            mode=REFERENCE_UPLOAD_MODE,
+            files_service=client.aio.files,
+            label=f"regen_{story['id'][:8]}",
+            memory=reference_memory
+        )
+        
+        universe = story.get("universe")
+        nomes = ", ".join(c.get("name", "") for c in story.get("characters") or [])
+        start = time.time()
+        try:
+            filename = await gerar_imagem_async(
+                image_id, prompt, referencias, nomes,
+                universe.get("style", "") if isinstance(universe, dict) else "",
+                pasta_historia, ratio=ratio,
+                logger=logger,
+                visual_style=story["visual_style"],
+                character_bible=story["character_bible"],
+                story_key=story["id"],
+                deadline=time.monotonic() + IMAGE_DEADLINE_SECONDS,
+                # /historias serve as ilustrações como imutáveis: a nova versão ganha outro nome
+                nome_arquivo=f"{image_id}_{uuid.uuid4().hex[:8]}.png"
+            )
+            erro = f"Falha após {MAX_RETRIES} tentativas"
+        except DeadlineExceeded as e:
+            filename, erro = None, str(e)
+        finally:
+            await asyncio.shield(referencias.close())
+        
+        state = story.get("image_state") or estado_das_imagens(story.get("images") or {}, {})
+        if not filename:
+            state[image_id] = {"status": "failed", "error": erro}
+            story["image_state"] = state
+            await asyncio.to_thread(salvar_story_json, story)
+            raise HTTPException(status_code=502, detail="Não foi possível gerar a imagem. Tente novamente mais tarde.")
+        
+        anterior = os.path.basename((story.get("images") or {}).get(image_id) or "")
+        story.setdefault("images", {})[image_id] = f"/historias/{story['folder']}/{filename}"
+        story.setdefault("models", {}).setdefault("images", {})[image_id] = logger.modelos["imagens"].get(image_id)
+        state[image_id] = {"status": "done"}
+        story["image_state"] = state
+        story["status"] = "completed" if story_is_complete(story) else "incomplete"
+        await asyncio.to_thread(salvar_story_json, story)
+        if anterior and anterior != filename:
+            try:
+                await asyncio.to_thread(os.remove, os.path.join(pasta_historia, anterior))
+            except OSError:
+                pass
+        logger.success(f"Imagem {image_id} regenerada em {time.time() - start:.1f}s", {"status": story["status"]})
+    
+    story["is_complete"] = story_is_complete(story)
+    return story
 
 @app.get("/api/health")
 async def health_check():
     return {"status": "ok", "timestamp": datetime.now().isoformat()}
 
+def verificar_admin(token: Optional[str]):
+    """Valida o token dos endpoints administrativos (se ADMIN_TOKEN estiver definido)"""
+    if ADMIN_TOKEN and token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Acesso negado")
+
+@app.get("/metrics")
+async def metrics_endpoint(x_admin_token: Optional[str] = Header(None), authorization: Optional[str] = Header(None)):
+    """
+    Métricas no formato Prometheus. Com ADMIN_TOKEN, aceita o header
+    X-Admin-Token ou "Authorization: Bearer <token>" (bearer_token do scrape).
+    """
+    if authorization and authorization.lower().startswith("bearer "):
+        x_admin_token = x_admin_token or authorization[7:].strip()
+    verificar_admin(x_admin_token)
+    return Response(metrics.render(), media_type=metrics.content_type)
+
+@app.get("/api/admin/rate-limit")
+async def rate_limit_status(x_admin_token: Optional[str] = Header(None)):
+    """Limites atuais do agendador global (ajustados pelo controle AIMD)"""
+    verificar_admin(x_admin_token)
+    return {
+        "texto": text_scheduler.stats(),
+        "imagem": image_scheduler.stats(),
+        "hedging": {"ativo": IMAGE_HEDGING, **image_hedge_policy.stats()},
+        "modelos": {"texto": text_models.stats(), "imagem": image_models.stats()},
+        "cancelamento": metricas_cancelamento,
+        "fotos_referencia": {"cache": reference_cache.stats(), "em_uso": reference_memory.stats()},
+        "variantes_imagem": variant_cache.stats(),
+        "respostas_galeria": stories_response_cache.stats(),
+        "deduplicacao": {
+            "ativa": STORY_DEDUP,
+            "cache_segundos": STORY_RESULT_CACHE_SECONDS,
+            **{result: metric_story_requests.value(result=result) for result in ("new", "joined", "cached")}
+        },
+        "jobs": {
+            "runner": JOB_RUNNER,
+            "pendentes": await asyncio.to_thread(job_store.pending),
+            "em_execucao_neste_processo": len(job_worker.running) if job_worker else 0
+        },
+        "timestamp": datetime.now().isoformat()
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,236 @@
+"""
+Geração de histórias em lote, sem HTTP
+Lê um manifesto JSONL (um StoryRequest por linha) e roda o mesmo pipeline da
+API (executar_historia) diretamente, com concorrência limitada. O progresso
+de cada registro fica em <pasta de estado>/<chave>.json: uma nova execução
+pula as histórias concluídas e retoma as interrompidas do último checkpoint
+(texto e imagens já prontos não são refeitos).
+
+    python batch.py catalogo.jsonl [--concurrency 4] [--state-dir DIR] [--report ARQ]
+    python batch.py catalogo.jsonl --fake    # Gemini simulado (fake_gemini.py)
+    python batch.py catalogo.jsonl --batch-api   # batch jobs do Gemini (gemini_batch.py)
+
+Um campo "id" na linha dá uma chave estável ao registro; sem ele, a chave é
+a impressão digital do pedido (linhas idênticas geram uma só história).
+Ao final, grava um relatório JSON com vazão, tempos e falhas.
+
+Com --batch-api as chamadas de texto e imagem vão em batch jobs (mais
+baratos, sem disputar a cota das chamadas interativas, mas com latência de
+minutos a horas). Os jobs enviados ficam no diário da pasta de estado: uma
+execução interrompida e retomada espera os mesmos jobs em vez de reenviar.
+"""
+import os
+import re
+import json
+import math
+import time
+import asyncio
+import argparse
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+KEY_PATTERN = re.compile(r"[^A-Za-z0-9_.-]")
+
+# No modo batch cada história passa a maior parte do tempo esperando o job:
+# mais histórias simultâneas enchem os lotes sem ocupar a cota interativa
+BATCH_API_CONCURRENCY = 32
+JOURNAL_FILE = "lotes_gemini.json"
+
+
+def percentil(values: List[float], q: float) -> Optional[float]:
+    """Percentil q (0-1) por nearest-rank; None sem valores"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[max(1, math.ceil(q * len(ordered))) - 1], 2)
+
+
+def ler_manifesto(path: str) -> Tuple[List[Tuple[int, dict]], List[dict]]:
+    """Registros do JSONL como [(linha, dict)] e a lista das linhas inválidas"""
+    records, invalid = [], []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("a linha não é um objeto JSON")
+                records.append((line_no, record))
+            except ValueError as e:
+                invalid.append({"linha": line_no, "erro": str(e)})
+    return records, invalid
+
+
+def ler_estado(state_dir: str, key: str) -> dict:
+    try:
+        with open(os.path.join(state_dir, f"{key}.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def gravar_estado(state_dir: str, key: str, state: dict):
+    """Escrita atômica: uma interrupção no meio não corrompe o estado do registro"""
+    path = os.path.join(state_dir, f"{key}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+async def processar_registro(api, key: str, line_no: int, request, state_dir: str, vagas: asyncio.Semaphore, lote=None) -> dict:
+    """Gera (ou retoma) a história de um registro e grava o estado final dele"""
+    state = await asyncio.to_thread(ler_estado, state_dir, key)
+    if state.get("status") == "complete":
+        return {**state, "pulado": True}
+
+    async with vagas:
+        final = {}
+
+        async def emitir(event_type: str, data: dict):
+            if event_type in ("complete", "error"):
+                final.update(type=event_type, message=data.get("message"), story=data.get("data"))
+
+        async def salvar_checkpoint(checkpoint: dict):
+            state["checkpoint"] = checkpoint
+            await asyncio.to_thread(gravar_estado, state_dir, key, state)
+
+        state.update(linha=line_no, status="running", tentativas=state.get("tentativas", 0) + 1)
+        await asyncio.to_thread(gravar_estado, state_dir, key, state)
+
+        start = time.monotonic()
+        await api.executar_historia(request, emitir, state.get("checkpoint"), salvar_checkpoint, story_key=f"lote_{key}", lote=lote)
+        duration = time.monotonic() - start
+
+        story = final.get("story") or {}
+        if final.get("type") == "complete":
+            status = "complete"
+        else:
+            # Com a história salva (faltando imagens) a próxima execução só gera o que falta
+            status = "incomplete" if story else "error"
+        state.update(
+            status=status,
+            story_id=story.get("id"),
+            folder=story.get("folder"),
+            erro=None if status == "complete" else final.get("message") or "Geração interrompida",
+            duracao_s=round(duration, 2),
+        )
+        if status == "complete":
+            state.pop("checkpoint", None)
+        await asyncio.to_thread(gravar_estado, state_dir, key, state)
+
+    icon = {"complete": "✅", "incomplete": "⚠️", "error": "❌"}[status]
+    print(f"{icon} [{key}] linha {line_no}: {status} em {duration:.1f}s" + (f" ({state['erro']})" if state["erro"] else ""))
+    return state
+
+
+async def executar_lote(args) -> dict:
+    # Importado aqui: a configuração da API (GEMINI_BACKEND etc.) vem do ambiente já ajustado
+    import api
+
+    records, invalid = ler_manifesto(args.manifest)
+    total = len(records) + len(invalid)
+    os.makedirs(args.state_dir, exist_ok=True)
+
+    pendentes, chaves, duplicados = [], set(), 0
+    for line_no, record in records:
+        try:
+            request = api.StoryRequest.model_validate(record)
+        except ValueError as e:
+            invalid.append({"linha": line_no, "erro": str(e).splitlines()[0]})
+            continue
+        key = KEY_PATTERN.sub("_", str(record["id"]))[:80] if record.get("id") else api.impressao_digital(request)[:24]
+        if key in chaves:
+            duplicados += 1
+            continue
+        chaves.add(key)
+        pendentes.append((key, line_no, request))
+
+    lote = api.criar_lote(os.path.join(args.state_dir, JOURNAL_FILE)) if args.batch_api else None
+    concurrency = args.concurrency or (BATCH_API_CONCURRENCY if lote else api.JOB_CONCURRENCY)
+    print(f"📦 {len(pendentes)} registros ({len(invalid)} inválidos, {duplicados} duplicados), {concurrency} simultâneos"
+          + (", modo batch" if lote else ""))
+    vagas = asyncio.Semaphore(concurrency)
+    start = time.monotonic()
+    try:
+        results = await asyncio.gather(*(
+            processar_registro(api, key, line_no, request, args.state_dir, vagas, lote)
+            for key, line_no, request in pendentes
+        ))
+    finally:
+        if lote:
+            await lote.close()
+        api.image_processor.shutdown()
+        await asyncio.to_thread(api.log_writer.close)
+    duration = time.monotonic() - start
+
+    rodados = [r for r in results if not r.get("pulado")]
+    completas = [r for r in rodados if r["status"] == "complete"]
+    duracoes = [r["duracao_s"] for r in completas]
+    return {
+        "manifesto": os.path.abspath(args.manifest),
+        "data": datetime.now().isoformat(timespec="seconds"),
+        "backend": api.GEMINI_BACKEND,
+        "modelos": {"texto": api.text_models.stats(), "imagem": api.image_models.stats()},
+        "modo": "batch" if lote else "direto",
+        "lote_gemini": lote.stats() if lote else None,
+        "concurrency": concurrency,
+        "registros": total,
+        "invalidos": len(invalid),
+        "duplicados": duplicados,
+        "pulados": len(results) - len(rodados),
+        "processados": len(rodados),
+        "completas": len(completas),
+        "incompletas": sum(1 for r in rodados if r["status"] == "incomplete"),
+        "falhas": sum(1 for r in rodados if r["status"] == "error"),
+        "duracao_s": round(duration, 2),
+        "historias_por_minuto": round(len(completas) / duration * 60, 2) if duration else 0,
+        "tempo_por_historia_s": {
+            "p50": percentil(duracoes, 0.5),
+            "p95": percentil(duracoes, 0.95),
+            "max": round(max(duracoes), 2) if duracoes else None,
+        },
+        "erros": invalid + [
+            {"linha": r["linha"], "story_id": r.get("story_id"), "status": r["status"], "erro": r["erro"]}
+            for r in rodados if r["status"] != "complete"
+        ],
+    }
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Gera as histórias de um manifesto JSONL (um StoryRequest por linha)")
+    parser.add_argument("manifest", help="Arquivo JSONL com os pedidos")
+    parser.add_argument("--concurrency", type=int, default=0,
+                        help=f"Histórias simultâneas (padrão: JOB_CONCURRENCY; {BATCH_API_CONCURRENCY} com --batch-api)")
+    parser.add_argument("--state-dir", help="Estado/checkpoints por registro (padrão: <manifesto>.estado/)")
+    parser.add_argument("--report", help="Relatório JSON (padrão: <manifesto>.relatorio.json)")
+    parser.add_argument("--fake", action="store_true", help="Usa o Gemini simulado (GEMINI_BACKEND=fake)")
+    parser.add_argument("--batch-api", action="store_true", help="Envia as chamadas em batch jobs do Gemini")
+    args = parser.parse_args()
+
+    base = os.path.splitext(args.manifest)[0]
+    args.state_dir = args.state_dir or f"{base}.estado"
+    args.report = args.report or f"{base}.relatorio.json"
+    if args.fake:
+        os.environ["GEMINI_BACKEND"] = "fake"
+
+    try:
+        report = asyncio.run(executar_lote(args))
+    except KeyboardInterrupt:
+        print(f"\n⏹️ Interrompido. O progresso está em {args.state_dir}; rode o mesmo comando para retomar.")
+        return
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"\n📊 {report['completas']}/{report['processados']} completas em {report['duracao_s']}s "
+          f"({report['historias_por_minuto']} histórias/min); {report['pulados']} já concluídas, "
+          f"{report['incompletas']} incompletas, {report['falhas']} falhas, {report['invalidos']} inválidas")
+    print(f"💾 Relatório salvo em {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+"""
+Benchmark offline da API de geração
+Sobe a API com o Gemini simulado (GEMINI_BACKEND=fake, ver fake_gemini.py)
+em pastas temporárias, abre N streams SSE simultâneos de /api/create-story e
+salva o resultado em JSON para comparar versões.
+
+    python benchmark.py --concurrency 8 --stories 32 --output benchmarks/antes.json
+    python benchmark.py --compare benchmarks/antes.json benchmarks/depois.json
+
+Com --url, mede um servidor já em execução (que deve estar com
+GEMINI_BACKEND=fake para não gastar cota).
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import base64
+import random
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from io import BytesIO
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import httpx
+from PIL import Image
+
+METRIC_LINE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})?\s+(\S+)$')
+LOOP_LAG = "superhistorias_event_loop_lag_seconds"
+
+
+def percentil(values: List[float], q: float) -> Optional[float]:
+    """Percentil q (0-1) por nearest-rank; None sem valores"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[max(1, math.ceil(q * len(ordered))) - 1], 3)
+
+
+def resumo(values: List[float]) -> dict:
+    return {
+        "p50": percentil(values, 0.5),
+        "p95": percentil(values, 0.95),
+        "p99": percentil(values, 0.99),
+        "max": round(max(values), 3) if values else None,
+    }
+
+
+def foto_sintetica(seed: int) -> str:
+    """JPEG 900x1200 determinístico em Base64 (passa pelo preparo das referências)"""
+    rng = random.Random(seed)
+    img = Image.frombytes("RGB", (45, 60), rng.randbytes(45 * 60 * 3)).resize((900, 1200), Image.Resampling.BICUBIC)
+    buffer = BytesIO()
+    img.save(buffer, "JPEG", quality=90)
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def montar_pedido(index: int, photos: int) -> dict:
+    fotos = [foto_sintetica(index * 10 + i) for i in range(photos)]
+    return {
+        "characters": [{"id": "1", "name": f"Herói {index}", "images": fotos}],
+        "universe": {"id": "benchmark", "name": "Benchmark", "style": "aventura clássica em um farol"},
+        "description": "História gerada pelo benchmark"
+    }
+
+
+def ler_metricas(text: str) -> Dict[str, float]:
+    """Amostras do formato texto do Prometheus, indexadas por nome{labels}"""
+    samples = {}
+    for line in text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            name, labels, value = match.groups()
+            samples[name + (labels or "")] = float(value.replace("+Inf", "inf"))
+    return samples
+
+
+def lag_do_loop(antes: Dict[str, float], depois: Dict[str, float]) -> dict:
+    """Percentis aproximados (limite superior do bucket) do atraso do loop durante a medição"""
+    buckets = []
+    for key, value in depois.items():
+        match = re.fullmatch(LOOP_LAG + r'_bucket\{le="([^"]+)"\}', key)
+        if match:
+            buckets.append((float(match.group(1).replace("+Inf", "inf")), value - antes.get(key, 0)))
+    buckets.sort()
+    total = buckets[-1][1] if buckets else 0
+
+    def limite(q: float) -> Optional[float]:
+        for bound, count in buckets:
+            if total and count >= q * total:
+                return bound if bound != math.inf else None
+        return None
+
+    return {
+        "amostras": int(total),
+        "p50_ate": limite(0.5),
+        "p99_ate": limite(0.99),
+        "max_processo": round(depois.get("superhistorias_event_loop_lag_max_seconds", 0), 4),
+    }
+
+
+async def gerar_historia(http: httpx.AsyncClient, base_url: str, pedido: dict) -> dict:
+    """Abre o stream SSE de uma história e mede os tempos até a primeira imagem e o fim"""
+    inicio = time.monotonic()
+    resultado = {"status": "error", "primeira_imagem": None, "total": None, "imagens": 0, "retries": 0, "erro": None}
+    try:
+        async with http.stream("POST", f"{base_url}/api/create-story", json=pedido) as response:
+            if response.status_code != 200:
+                resultado["erro"] = f"HTTP {response.status_code}"
+                return resultado
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                event = json.loads(line[6:])
+                kind = event.get("type")
+                if kind == "image_done" and event.get("imageUrl"):
+                    resultado["imagens"] += 1
+                    if resultado["primeira_imagem"] is None:
+                        resultado["primeira_imagem"] = round(time.monotonic() - inicio, 3)
+                elif kind == "image_retry" and event.get("attempt", 1) > 1:
+                    resultado["retries"] += 1
+                elif kind == "complete":
+                    resultado["status"] = "complete"
+                elif kind == "error":
+                    resultado["erro"] = event.get("message")
+    except httpx.HTTPError as e:
+        resultado["erro"] = f"{type(e).__name__}: {e}"
+    resultado["total"] = round(time.monotonic() - inicio, 3)
+    return resultado
+
+
+async def rodar_carga(base_url: str, stories: int, concurrency: int, photos: int, warmup: int) -> dict:
+    async with httpx.AsyncClient(timeout=httpx.Timeout(None, connect=10)) as http:
+        if warmup:
+            # Aquece caches do processo (imagens sintéticas, pool do Pillow) fora da medição
+            print(f"🔥 Aquecimento: {warmup} história(s)")
+            await asyncio.gather(*(gerar_historia(http, base_url, montar_pedido(-1 - i, photos)) for i in range(warmup)))
+
+        antes = ler_metricas((await http.get(f"{base_url}/metrics")).text)
+        # RSS de repouso: o que passar disso no pico é atribuído às histórias simultâneas
+        rss_base = antes.get("superhistorias_process_rss_bytes") or antes.get("superhistorias_process_peak_rss_bytes", 0)
+        vagas = asyncio.Semaphore(concurrency)
+
+        async def uma(index: int) -> dict:
+            async with vagas:
+                resultado = await gerar_historia(http, base_url, montar_pedido(index, photos))
+                print(f"  #{index + 1}: {resultado['status']} em {resultado['total']}s ({resultado['imagens']} imagens)")
+                return resultado
+
+        print(f"🏁 {stories} histórias, {concurrency} simultâneas")
+        inicio = time.monotonic()
+        resultados = await asyncio.gather(*(uma(i) for i in range(stories)))
+        duracao = time.monotonic() - inicio
+        depois = ler_metricas((await http.get(f"{base_url}/metrics")).text)
+
+    completas = [r for r in resultados if r["status"] == "complete"]
+    return {
+        "duracao_s": round(duracao, 2),
+        "historias": stories,
+        "completas": len(completas),
+        "falhas": stories - len(completas),
+        "historias_por_minuto": round(len(completas) / duracao * 60, 2) if duracao else 0,
+        "tempo_ate_primeira_imagem_s": resumo([r["primeira_imagem"] for r in resultados if r["primeira_imagem"] is not None]),
+        "tempo_ate_completar_s": resumo([r["total"] for r in completas]),
+        "retries_de_imagem": sum(r["retries"] for r in resultados),
+        "event_loop_lag_s": lag_do_loop(antes, depois),
+        "pico_rss_mb": round(depois.get("superhistorias_process_peak_rss_bytes", 0) / 1024 / 1024, 1),
+        "pico_rss_por_historia_mb": round(
+            max(0.0, depois.get("superhistorias_process_peak_rss_bytes", 0) - rss_base) / min(concurrency, stories) / 1024 / 1024, 2
+        ),
+        "pico_referencias_mb": round(depois.get('superhistorias_reference_photos_bytes{kind="peak"}', 0) / 1024 / 1024, 2),
+        "erros": sorted({r["erro"] for r in resultados if r["erro"]}),
+        "por_historia": resultados,
+    }
+
+
+def porta_livre() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def iniciar_servidor(args, pasta: str) -> subprocess.Popen:
+    """API em subprocesso com o Gemini simulado e dados em `pasta`"""
+    env = dict(
+        os.environ,
+        GEMINI_BACKEND="fake",
+        STORIES_DIR=os.path.join(pasta, "historias"),
+        DATA_DIR=os.path.join(pasta, "dados"),
+        REFERENCE_CACHE_DIR=os.path.join(pasta, "cache", "referencias"),
+        IMAGE_VARIANT_CACHE_DIR=os.path.join(pasta, "cache", "variantes"),
+        FAKE_GEMINI_TEXT_MEDIAN=str(args.text_median),
+        FAKE_GEMINI_IMAGE_MEDIAN=str(args.image_median),
+        FAKE_GEMINI_LATENCY_SIGMA=str(args.latency_sigma),
+        FAKE_GEMINI_QUOTA_ERROR_RATE=str(args.quota_error_rate),
+        FAKE_GEMINI_SEED=str(args.seed),
+        FAKE_GEMINI_BATCH_DIR=os.path.join(pasta, "cache", "lotes_fake"),
+    )
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env
+    )
+
+
+async def aguardar_servidor(base_url: str, processo: Optional[subprocess.Popen], timeout: float = 60):
+    limite = time.monotonic() + timeout
+    async with httpx.AsyncClient() as http:
+        while time.monotonic() < limite:
+            if processo and processo.poll() is not None:
+                raise RuntimeError("A API encerrou antes de ficar pronta")
+            try:
+                if (await http.get(f"{base_url}/api/health")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError(f"A API não respondeu em {timeout:.0f}s")
+
+
+def versao_git() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def comparar(caminho_a: str, caminho_b: str):
+    """Tabela com as métricas principais de dois resultados"""
+    with open(caminho_a, encoding="utf-8") as f:
+        a = json.load(f)
+    with open(caminho_b, encoding="utf-8") as f:
+        b = json.load(f)
+    linhas = [
+        ("histórias/min", lambda r: r["resultado"]["historias_por_minuto"]),
+        ("1ª imagem p50 (s)", lambda r: r["resultado"]["tempo_ate_primeira_imagem_s"]["p50"]),
+        ("1ª imagem p95 (s)", lambda r: r["resultado"]["tempo_ate_primeira_imagem_s"]["p95"]),
+        ("completa p50 (s)", lambda r: r["resultado"]["tempo_ate_completar_s"]["p50"]),
+        ("completa p95 (s)", lambda r: r["resultado"]["tempo_ate_completar_s"]["p95"]),
+        ("completa p99 (s)", lambda r: r["resultado"]["tempo_ate_completar_s"]["p99"]),
+        ("lag do loop máx (s)", lambda r: r["resultado"]["event_loop_lag_s"]["max_processo"]),
+        ("pico RSS (MB)", lambda r: r["resultado"]["pico_rss_mb"]),
+        ("RSS/história (MB)", lambda r: r["resultado"].get("pico_rss_por_historia_mb")),
+        ("referências pico (MB)", lambda r: r["resultado"].get("pico_referencias_mb")),
+        ("falhas", lambda r: r["resultado"]["falhas"]),
+    ]
+    print(f"{'':22} {a.get('versao') or caminho_a:>16} {b.get('versao') or caminho_b:>16}   variação")
+    for nome, extrair in linhas:
+        va, vb = extrair(a), extrair(b)
+        variacao = f"{(vb - va) / va * 100:+.1f}%" if va and vb is not None else "-"
+        print(f"{nome:22} {str(va):>16} {str(vb):>16}   {variacao}")
+
+
+async def main_async(args) -> dict:
+    processo = None
+    with tempfile.TemporaryDirectory(prefix="superhistorias-bench-") as pasta:
+        if args.url:
+            base_url = args.url.rstrip("/")
+        else:
+            args.port = args.port or porta_livre()
+            base_url = f"http://127.0.0.1:{args.port}"
+            processo = iniciar_servidor(args, pasta)
+        try:
+            await aguardar_servidor(base_url, processo)
+            resultado = await rodar_carga(base_url, args.stories, args.concurrency, args.photos, args.warmup)
+        finally:
+            if processo:
+                processo.terminate()
+                try:
+                    processo.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    processo.kill()
+
+    return {
+        "versao": versao_git(),
+        "data": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "servidor": args.url or "local (GEMINI_BACKEND=fake)",
+        "parametros": {
+            "stories": args.stories,
+            "concurrency": args.concurrency,
+            "photos": args.photos,
+            "warmup": args.warmup,
+            "text_median": args.text_median,
+            "image_median": args.image_median,
+            "latency_sigma": args.latency_sigma,
+            "quota_error_rate": args.quota_error_rate,
+            "seed": args.seed,
+        },
+        "resultado": resultado,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline da API com o Gemini simulado")
+    parser.add_argument("--stories", type=int, default=16, help="Histórias medidas")
+    parser.add_argument("--concurrency", type=int, default=4, help="Streams SSE simultâneos")
+    parser.add_argument("--photos", type=int, default=1, help="Fotos (Base64) por pedido")
+    parser.add_argument("--warmup", type=int, default=1, help="Histórias de aquecimento (fora da medição)")
+    parser.add_argument("--text-median", type=float, default=8.0, help="Latência mediana do texto (s)")
+    parser.add_argument("--image-median", type=float, default=20.0, help="Latência mediana de cada imagem (s)")
+    parser.add_argument("--latency-sigma", type=float, default=0.3, help="Dispersão log-normal das latências")
+    parser.add_argument("--quota-error-rate", type=float, default=0.0, help="Fração das chamadas que recebem 429")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--url", help="Mede um servidor já em execução em vez de iniciar um")
+    parser.add_argument("--port", type=int, default=0, help="Porta do servidor iniciado (padrão: livre)")
+    parser.add_argument("--output", help="Arquivo JSON do resultado (padrão: benchmarks/<data>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("A", "B"), help="Compara dois resultados salvos")
+    args = parser.parse_args()
+
+    if args.compare:
+        comparar(*args.compare)
+        return
+
+    relatorio = asyncio.run(main_async(args))
+    saida = args.output or os.path.join("benchmarks", f"{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(saida) or ".", exist_ok=True)
+    with open(saida, "w", encoding="utf-8") as f:
+        json.dump(relatorio, f, ensure_ascii=False, indent=2)
+
+    r = relatorio["resultado"]
+    print(f"\n📊 {r['completas']}/{r['historias']} completas em {r['duracao_s']}s: {r['historias_por_minuto']} histórias/min")
+    print(f"   1ª imagem: {r['tempo_ate_primeira_imagem_s']}")
+    print(f"   completa:  {r['tempo_ate_completar_s']}")
+    print(f"   lag do loop: {r['event_loop_lag_s']} | pico RSS: {r['pico_rss_mb']} MB ({r['pico_rss_por_historia_mb']} MB por história simultânea)")
+    print(f"   fotos de referência em memória (pico): {r['pico_referencias_mb']} MB")
+    print(f"💾 Resultado salvo em {saida}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+Circuit breaker por modelo e cadeia de modelos de fallback
+Cada modelo tem um breaker que observa as chamadas recentes (janela de
+tempo): com erros ou chamadas lentas demais acima do limite, o circuito abre
+e as chamadas vão para o próximo modelo da cadeia. Depois de open_seconds o
+circuito fica meio aberto e deixa passar algumas chamadas de teste; se elas
+derem certo, fecha de novo. Com todos os modelos abertos, a chamada falha na
+hora (CircuitOpenError), sem gastar cota nem esperar o modelo degradado.
+"""
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple, Type
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Todos os modelos da cadeia estão com o circuito aberto"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after  # Segundos até o primeiro circuito aceitar teste
+
+
+class CircuitBreaker:
+    """
+    Breaker de um modelo. Abre quando, na janela de window_seconds e com pelo
+    menos min_calls chamadas, a fração de erros passa de error_rate ou a de
+    chamadas mais lentas que slow_call_seconds passa de slow_rate.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        error_rate: float = 0.5,
+        slow_rate: float = 0.5,
+        slow_call_seconds: Optional[float] = None,
+        min_calls: int = 8,
+        window_seconds: float = 60.0,
+        open_seconds: float = 30.0,
+        half_open_calls: int = 2,
+    ):
+        self.name = name
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.min_calls = max(1, min_calls)
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = max(1, half_open_calls)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._calls: deque = deque()  # (instante, erro, lenta)
+        self._probes = 0              # Chamadas de teste em andamento (meio aberto)
+        self._probe_successes = 0
+        self.opens = 0
+        self.rejections = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes = 0
+            self._probe_successes = 0
+        return self._state
+
+    def retry_after(self) -> float:
+        """Segundos até o circuito aceitar chamadas de teste (0 se já aceita)"""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+
+    def try_acquire(self) -> bool:
+        """Reserva a passagem de uma chamada (no meio aberto, só as de teste)"""
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and self._probes < self.half_open_calls:
+            self._probes += 1
+            return True
+        self.rejections += 1
+        return False
+
+    def is_slow(self, duration: float) -> bool:
+        return self.slow_call_seconds is not None and duration >= self.slow_call_seconds
+
+    def record(self, failed: bool, duration: Optional[float] = None):
+        """Resultado de uma chamada liberada por try_acquire (duration=None: sem medir latência)"""
+        slow = duration is not None and self.is_slow(duration)
+        if self._state == HALF_OPEN:
+            self._probes = max(0, self._probes - 1)
+            if failed or slow:
+                self._open()
+                return
+            self._probe_successes += 1
+            if self._probe_successes >= self.half_open_calls:
+                self._state = CLOSED
+                self._calls.clear()
+            return
+        if self._state == OPEN:
+            return  # Chamada que começou antes da abertura
+
+        now = time.monotonic()
+        self._calls.append((now, failed, slow))
+        while self._calls and now - self._calls[0][0] > self.window_seconds:
+            self._calls.popleft()
+        total = len(self._calls)
+        if total < self.min_calls:
+            return
+        errors = sum(1 for _, f, _ in self._calls if f)
+        slow_calls = sum(1 for _, _, s in self._calls if s)
+        if errors / total >= self.error_rate or slow_calls / total >= self.slow_rate:
+            self._open()
+
+    def release(self):
+        """Chamada cancelada sem resultado: devolve a vaga de teste"""
+        if self._state == HALF_OPEN:
+            self._probes = max(0, self._probes - 1)
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._calls.clear()
+        self._probes = 0
+        self.opens += 1
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        recent = [c for c in self._calls if now - c[0] <= self.window_seconds]
+        return {
+            "state": self.state,
+            "calls": len(recent),
+            "errors": sum(1 for _, f, _ in recent if f),
+            "slow": sum(1 for _, _, s in recent if s),
+            "opens": self.opens,
+            "rejections": self.rejections,
+            "retry_after": round(self.retry_after(), 1),
+        }
+
+
+class ModelChain:
+    """
+    Lista ordenada de modelos (o primeiro é o preferido), cada um com seu
+    breaker. escolher() entrega o primeiro modelo com o circuito fechado (ou
+    aceitando teste) e registra o resultado da chamada feita dentro do bloco.
+    """
+
+    def __init__(self, kind: str, models: Sequence[str], **breaker_options):
+        if not models:
+            raise ValueError(f"Nenhum modelo configurado para {kind}")
+        self.kind = kind
+        self.models: List[str] = list(models)
+        self.breakers: Dict[str, CircuitBreaker] = {m: CircuitBreaker(m, **breaker_options) for m in self.models}
+        self.fallbacks = 0  # Chamadas que saíram por um modelo que não o preferido
+
+    @property
+    def primary(self) -> str:
+        return self.models[0]
+
+    def _selecionar(self) -> str:
+        for model in self.models:
+            if self.breakers[model].try_acquire():
+                if model != self.primary:
+                    self.fallbacks += 1
+                return model
+        retry_after = min(b.retry_after() for b in self.breakers.values())
+        raise CircuitOpenError(
+            f"Circuito aberto para todos os modelos de {self.kind} ({', '.join(self.models)}); "
+            f"novo teste em {retry_after:.0f}s",
+            retry_after
+        )
+
+    @contextmanager
+    def escolher(self, track_latency: bool = True, neutral: Tuple[Type[BaseException], ...] = ()):
+        """
+        `with chain.escolher() as modelo:` em volta da chamada ao modelo.
+        Exceções contam como erro, exceto as de `neutral` (o modelo respondeu;
+        o problema é do pedido, ex.: conteúdo bloqueado); cancelamentos só
+        contam se a chamada já estava lenta. track_latency=False ignora a
+        duração (ex.: modo batch).
+        """
+        model = self._selecionar()
+        breaker = self.breakers[model]
+        start = time.monotonic()
+        try:
+            yield model
+        except Exception as e:
+            breaker.record(not isinstance(e, neutral), time.monotonic() - start if track_latency else None)
+            raise
+        except BaseException:
+            # Cancelada (prazo, hedge perdedor, história abandonada)
+            duration = time.monotonic() - start
+            if track_latency and breaker.is_slow(duration):
+                breaker.record(False, duration)
+            else:
+                breaker.release()
+            raise
+        else:
+            breaker.record(False, time.monotonic() - start if track_latency else None)
+
+    def stats(self) -> dict:
+        return {
+            "models": self.models,
+            "fallbacks": self.fallbacks,
+            "breakers": {m: b.stats() for m, b in self.breakers.items()},
+        }
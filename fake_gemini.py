@@ -0,0 +1,391 @@
+"""
+Stand-ins locais dos serviços do Gemini, para rodar sem rede e sem cota
+- FakeFiles: imita client.aio.files (upload / get / delete), em memória
+- FakeModels: imita client.aio.models (generate_content e
+  generate_content_stream) com história fixa, imagens sintéticas em 2K,
+  latência sorteada (log-normal), injeção de erros 429 e modelos fora do ar
+- LocalBatches: imita client.aio.batches (create / get) com os jobs em
+  arquivos locais, para testar o modo batch (gemini_batch.py) offline
+
+Ative na API com GEMINI_BACKEND=fake (ver FakeClient.from_env); usado pelo
+benchmark.py para medir o servidor sem gastar cota.
+"""
+import os
+import json
+import math
+import time
+import uuid
+import random
+import asyncio
+from io import BytesIO
+from typing import Dict, Sequence, Tuple
+from google.genai import types
+from PIL import Image
+
+# Resolução "2K" de cada proporção usada pela API
+IMAGE_SIZES_2K = {
+    "1:1": (2048, 2048),
+    "2:3": (1696, 2528),
+    "3:2": (2528, 1696),
+    "4:5": (1856, 2304),
+    "5:4": (2304, 1856),
+    "16:9": (2752, 1536),
+    "9:16": (1536, 2752),
+}
+
+FAKE_STORY = {
+    "title": "A Jornada do Farol Esquecido",
+    "cover_prompt": "Low angle wide shot of the heroes facing a towering ancient lighthouse at dusk, dramatic rim light",
+    "visual_style": "Cinematic digital painting, warm teal and amber palette, volumetric light, soft film grain",
+    "character_bible": "Each hero wears a weathered explorer jacket, leather satchel and a brass compass pendant",
+    "parts": [
+        ["Numa vila costeira esquecida pelos mapas, os heróis ouviram falar de um farol que nunca se apagava, nem mesmo nas noites sem vento.",
+         "Quiet coastal village at sunset, heroes listening to an old fisherman, lighthouse on the horizon"],
+        ["Certa manhã, a luz do farol sumiu, e com ela todos os barcos da vila. Só restou um bilhete com um mapa rabiscado às pressas.",
+         "Empty harbor at dawn, heroes holding a crumpled hand-drawn map, dark silent lighthouse behind them"],
+        ["A trilha até o farol cruzava pântanos, pontes quebradas e enigmas gravados em pedra que só a coragem do grupo conseguia decifrar.",
+         "Heroes crossing a broken rope bridge over a misty marsh, glowing runes carved into stones"],
+        ["No topo do farol, uma tempestade viva guardava a lâmpada apagada. Os heróis enfrentaram os ventos juntos, sem soltar as mãos.",
+         "Epic climax at the top of the lighthouse, heroes bracing against a living storm, lightning everywhere"],
+        ["Quando a luz voltou a brilhar, os barcos retornaram ao porto, e a vila inteira celebrou os heróis até o amanhecer.",
+         "Joyful harbor festival at night, lighthouse shining brightly, boats returning, heroes celebrated"],
+    ],
+}
+
+
+def _config_value(config, key: str):
+    if config is None:
+        return None
+    if isinstance(config, dict):
+        return config.get(key)
+    return getattr(config, key, None)
+
+
+class FakeFiles:
+    """Files API local: guarda os arquivos em memória e conta as operações"""
+
+    def __init__(self):
+        self.files: Dict[str, Tuple[types.File, bytes]] = {}
+        self.uploads = 0
+        self.deletes = 0
+
+    async def upload(self, *, file, config=None) -> types.File:
+        if hasattr(file, "read"):
+            data = file.read()
+        else:
+            with open(file, "rb") as f:
+                data = f.read()
+        name = f"files/{uuid.uuid4().hex[:16]}"
+        uploaded = types.File(
+            name=name,
+            display_name=_config_value(config, "display_name"),
+            uri=f"local://{name}",
+            mime_type=_config_value(config, "mime_type") or "application/octet-stream",
+            size_bytes=len(data),
+            state=types.FileState.ACTIVE
+        )
+        self.files[name] = (uploaded, data)
+        self.uploads += 1
+        return uploaded
+
+    async def get(self, *, name: str, config=None) -> types.File:
+        if name not in self.files:
+            raise KeyError(f"Arquivo não encontrado: {name}")
+        return self.files[name][0]
+
+    async def delete(self, *, name: str, config=None):
+        if self.files.pop(name, None) is None:
+            raise KeyError(f"Arquivo não encontrado: {name}")
+        self.deletes += 1
+
+    def read(self, uri: str) -> bytes:
+        """Conteúdo de um arquivo a partir da URI usada nas chamadas"""
+        return self.files[uri.removeprefix("local://")][1]
+
+
+class FakeQuotaError(Exception):
+    """Erro 429 injetado (mesma forma que is_quota_error reconhece)"""
+
+    code = 429
+
+    def __init__(self, retry_delay: float):
+        super().__init__(f"429 RESOURCE_EXHAUSTED. {{'retryDelay': '{retry_delay:g}s'}}")
+
+
+class FakeUnavailableError(Exception):
+    """Erro 503 de um modelo configurado como fora do ar (failing_models)"""
+
+    code = 503
+
+    def __init__(self, model: str):
+        super().__init__(f"503 UNAVAILABLE. O modelo {model} está sobrecarregado.")
+
+
+class LatencyModel:
+    """Latência log-normal: mediana em segundos e dispersão sigma (0 = fixa)"""
+
+    def __init__(self, median: float, sigma: float = 0.0):
+        self.median = median
+        self.sigma = sigma
+
+    def sample(self, rng: random.Random) -> float:
+        if self.median <= 0:
+            return 0.0
+        if self.sigma <= 0:
+            return self.median
+        return self.median * math.exp(rng.gauss(0.0, self.sigma))
+
+
+class FakeModels:
+    """
+    client.aio.models local. Respostas determinísticas para a mesma seed:
+    a história é sempre FAKE_STORY e cada proporção tem uma imagem sintética
+    fixa (gerada uma vez e reaproveitada).
+    """
+
+    def __init__(
+        self,
+        text_latency: LatencyModel = None,
+        image_latency: LatencyModel = None,
+        quota_error_rate: float = 0.0,
+        retry_delay: float = 1.0,
+        stream_chunks: int = 20,
+        seed: int = 0,
+        failing_models: Sequence[str] = (),
+    ):
+        self.text_latency = text_latency or LatencyModel(0.0)
+        self.image_latency = image_latency or LatencyModel(0.0)
+        self.quota_error_rate = quota_error_rate
+        self.retry_delay = retry_delay
+        self.stream_chunks = max(1, stream_chunks)
+        self.failing_models = set(failing_models)
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self._images: Dict[str, bytes] = {}
+        self.calls = {"text": 0, "image": 0}
+        self.calls_by_model: Dict[str, int] = {}
+        self.quota_errors = 0
+
+    def _is_image_call(self, config) -> bool:
+        modalities = _config_value(config, "response_modalities") or []
+        return "IMAGE" in [str(m).upper() for m in modalities]
+
+    def _check_model(self, model: str):
+        self.calls_by_model[model] = self.calls_by_model.get(model, 0) + 1
+        if model in self.failing_models:
+            raise FakeUnavailableError(model)
+
+    def _maybe_quota_error(self):
+        if self.quota_error_rate > 0 and self.rng.random() < self.quota_error_rate:
+            self.quota_errors += 1
+            raise FakeQuotaError(self.retry_delay)
+
+    def _usage(self, contents, output_tokens: int) -> types.GenerateContentResponseUsageMetadata:
+        text = contents if isinstance(contents, str) else " ".join(c for c in contents if isinstance(c, str))
+        return types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=len(text) // 4,
+            candidates_token_count=output_tokens,
+            total_token_count=len(text) // 4 + output_tokens
+        )
+
+    def _text_response(self, text: str, usage=None) -> types.GenerateContentResponse:
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=text)]))],
+            usage_metadata=usage
+        )
+
+    def image_bytes(self, ratio: str) -> bytes:
+        """PNG sintético na resolução 2K da proporção (textura suave, tamanho realista)"""
+        if ratio not in self._images:
+            width, height = IMAGE_SIZES_2K.get(ratio, IMAGE_SIZES_2K["1:1"])
+            rng = random.Random(f"{self.seed}:{ratio}")
+            small = (max(1, width // 16), max(1, height // 16))
+            img = Image.frombytes("RGB", small, rng.randbytes(small[0] * small[1] * 3))
+            img = img.resize((width, height), Image.Resampling.BICUBIC)
+            buffer = BytesIO()
+            img.save(buffer, "PNG")
+            self._images[ratio] = buffer.getvalue()
+        return self._images[ratio]
+
+    async def generate_content(self, *, model: str, contents, config=None) -> types.GenerateContentResponse:
+        if self._is_image_call(config):
+            self.calls["image"] += 1
+            await asyncio.sleep(self.image_latency.sample(self.rng))
+            self._check_model(model)
+            self._maybe_quota_error()
+            image_config = _config_value(config, "image_config")
+            ratio = _config_value(image_config, "aspect_ratio") or "1:1"
+            data = await asyncio.to_thread(self.image_bytes, ratio)
+            return types.GenerateContentResponse(
+                candidates=[types.Candidate(content=types.Content(
+                    role="model",
+                    parts=[types.Part.from_bytes(data=data, mime_type="image/png")]
+                ))],
+                usage_metadata=self._usage(contents, 1290)
+            )
+
+        self.calls["text"] += 1
+        await asyncio.sleep(self.text_latency.sample(self.rng))
+        self._check_model(model)
+        self._maybe_quota_error()
+        text = json.dumps(FAKE_STORY, ensure_ascii=False)
+        return self._text_response(text, self._usage(contents, len(text) // 4))
+
+    async def generate_content_stream(self, *, model: str, contents, config=None):
+        self.calls["text"] += 1
+        total = self.text_latency.sample(self.rng)
+        # O erro de cota chega antes do primeiro chunk, como na API real
+        await asyncio.sleep(total / (self.stream_chunks + 1))
+        self._check_model(model)
+        self._maybe_quota_error()
+        text = json.dumps(FAKE_STORY, ensure_ascii=False)
+        usage = self._usage(contents, len(text) // 4)
+        size = math.ceil(len(text) / self.stream_chunks)
+
+        async def chunks():
+            for i in range(0, len(text), size):
+                if i:
+                    await asyncio.sleep(total / (self.stream_chunks + 1))
+                last = i + size >= len(text)
+                yield self._text_response(text[i:i + size], usage if last else None)
+
+        return chunks()
+
+    def stats(self) -> dict:
+        return {"calls": dict(self.calls), "calls_by_model": dict(self.calls_by_model), "quota_errors": self.quota_errors}
+
+
+class LocalBatches:
+    """
+    Batch API local baseada em arquivos: cada job é um diretório em
+    `directory` com os pedidos (requests.jsonl) e o estado (job.json). O job
+    fica pronto `latency` segundos após a criação; a primeira consulta depois
+    disso executa os pedidos no FakeModels (sem a latência dele) e grava
+    responses.jsonl. Como tudo fica em disco, outro processo consegue
+    consultar um job criado antes de uma interrupção.
+    """
+
+    def __init__(self, directory: str, models: FakeModels, latency: LatencyModel = None):
+        self.directory = directory
+        self.models = models
+        self.latency = latency or LatencyModel(0.0)
+        self.created = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name: str, filename: str) -> str:
+        return os.path.join(self.directory, name.removeprefix("batches/"), filename)
+
+    def _write(self, path: str, data: str):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _job(self, meta: dict, responses=None) -> types.BatchJob:
+        return types.BatchJob(
+            name=meta["name"],
+            display_name=meta.get("display_name"),
+            model=meta["model"],
+            state=types.JobState(meta["state"]),
+            dest=types.BatchJobDestination(inlined_responses=responses) if responses is not None else None
+        )
+
+    async def create(self, *, model: str, src, config=None) -> types.BatchJob:
+        name = f"batches/{uuid.uuid4().hex[:16]}"
+        os.makedirs(self._path(name, ""))
+        requests = [types.InlinedRequest.model_validate(r) for r in src]
+        lines = "".join(r.model_dump_json(exclude_none=True) + "\n" for r in requests)
+        meta = {
+            "name": name,
+            "display_name": _config_value(config, "display_name"),
+            "model": model,
+            "state": types.JobState.JOB_STATE_PENDING.value,
+            "requests": len(requests),
+            "ready_at": time.time() + self.latency.sample(self.models.rng),
+        }
+        await asyncio.to_thread(self._write, self._path(name, "requests.jsonl"), lines)
+        await asyncio.to_thread(self._write, self._path(name, "job.json"), json.dumps(meta))
+        self.created += 1
+        return self._job(meta)
+
+    async def get(self, *, name: str, config=None) -> types.BatchJob:
+        try:
+            with open(self._path(name, "job.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            raise KeyError(f"Batch job não encontrado: {name}")
+
+        if meta["state"] == types.JobState.JOB_STATE_SUCCEEDED.value:
+            with open(self._path(name, "responses.jsonl"), "r", encoding="utf-8") as f:
+                responses = [types.InlinedResponse.model_validate_json(line) for line in f if line.strip()]
+            return self._job(meta, responses)
+        if time.time() < meta["ready_at"]:
+            if meta["state"] != types.JobState.JOB_STATE_RUNNING.value:
+                meta["state"] = types.JobState.JOB_STATE_RUNNING.value
+                await asyncio.to_thread(self._write, self._path(name, "job.json"), json.dumps(meta))
+            return self._job(meta)
+
+        # Pronto: executa os pedidos (cada um pode falhar com o 429 injetado)
+        with open(self._path(name, "requests.jsonl"), "r", encoding="utf-8") as f:
+            requests = [types.InlinedRequest.model_validate_json(line) for line in f if line.strip()]
+        responses = []
+        for request in requests:
+            try:
+                response = await self.models.generate_content(model=request.model, contents=request.contents, config=request.config)
+                responses.append(types.InlinedResponse(response=response, metadata=request.metadata))
+            except (FakeQuotaError, FakeUnavailableError) as e:
+                responses.append(types.InlinedResponse(error=types.JobError(code=e.code, message=str(e)), metadata=request.metadata))
+        lines = "".join(r.model_dump_json(exclude_none=True) + "\n" for r in responses)
+        await asyncio.to_thread(self._write, self._path(name, "responses.jsonl"), lines)
+        meta["state"] = types.JobState.JOB_STATE_SUCCEEDED.value
+        await asyncio.to_thread(self._write, self._path(name, "job.json"), json.dumps(meta))
+        return self._job(meta, responses)
+
+
+class _FakeAio:
+    def __init__(self, models: FakeModels = None, batches: LocalBatches = None):
+        self.files = FakeFiles()
+        self.models = models or FakeModels()
+        self.batches = batches
+
+
+class FakeClient:
+    """Imita o genai.Client nos pontos usados pela API"""
+
+    def __init__(self, models: FakeModels = None, batches: LocalBatches = None):
+        self.aio = _FakeAio(models, batches)
+
+    @classmethod
+    def from_env(cls) -> "FakeClient":
+        """
+        Configuração pelas variáveis FAKE_GEMINI_* (latências em segundos):
+        TEXT_MEDIAN, IMAGE_MEDIAN, LATENCY_SIGMA, QUOTA_ERROR_RATE,
+        RETRY_DELAY, STREAM_CHUNKS, SEED e FAILING_MODELS (modelos que sempre
+        respondem 503, separados por vírgula); para a batch API local,
+        BATCH_MEDIAN (tempo até o job ficar pronto) e BATCH_DIR.
+        """
+        def env(name: str, default: str) -> str:
+            return os.getenv(f"FAKE_GEMINI_{name}", default)
+
+        sigma = float(env("LATENCY_SIGMA", "0.3"))
+        quota_error_rate = float(env("QUOTA_ERROR_RATE", "0"))
+        seed = int(env("SEED", "0"))
+        failing_models = [m.strip() for m in env("FAILING_MODELS", "").split(",") if m.strip()]
+        batch_dir = env("BATCH_DIR", os.path.join(os.path.dirname(__file__), "cache", "lotes_fake"))
+        return cls(
+            FakeModels(
+                text_latency=LatencyModel(float(env("TEXT_MEDIAN", "8")), sigma),
+                image_latency=LatencyModel(float(env("IMAGE_MEDIAN", "20")), sigma),
+                quota_error_rate=quota_error_rate,
+                retry_delay=float(env("RETRY_DELAY", "1")),
+                stream_chunks=int(env("STREAM_CHUNKS", "20")),
+                seed=seed,
+                failing_models=failing_models
+            ),
+            # Os pedidos do lote rodam sem a latência por chamada: o custo é o tempo do job
+            LocalBatches(
+                batch_dir,
+                FakeModels(quota_error_rate=quota_error_rate, seed=seed, failing_models=failing_models),
+                latency=LatencyModel(float(env("BATCH_MEDIAN", "60")), sigma)
+            )
+        )
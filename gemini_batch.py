@@ -0,0 +1,318 @@
+"""
+Modo batch do Gemini para geração não interativa
+BatchDispatcher tem a mesma interface de client.aio.models.generate_content,
+mas junta as chamadas em batch jobs (client.aio.batches): os pedidos de cada
+modelo se acumulam por até max_wait segundos (ou até encher o lote), viram
+um batch job com os pedidos inline, e um poller por job entrega cada resposta
+a quem a pediu. O batch custa menos por chamada e não disputa a cota das
+chamadas interativas, em troca de latência (minutos a horas).
+
+Com um diário (journal_path), os jobs enviados sobrevivem a uma interrupção:
+o mesmo pedido feito de novo (mesmo modelo, conteúdo e config) volta a
+esperar o job já enviado em vez de pagar outro.
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+from typing import Dict, List, Optional
+from google.genai import types
+
+TERMINAL_STATES = {
+    types.JobState.JOB_STATE_SUCCEEDED,
+    types.JobState.JOB_STATE_PARTIALLY_SUCCEEDED,
+    types.JobState.JOB_STATE_FAILED,
+    types.JobState.JOB_STATE_CANCELLED,
+    types.JobState.JOB_STATE_EXPIRED,
+}
+
+# Falhas seguidas na consulta de um job antes de desistir dele
+MAX_POLL_FAILURES = 5
+
+
+class BatchItemError(Exception):
+    """Um pedido do lote falhou (o código segue o da API: 429 = cota)"""
+
+    def __init__(self, code: Optional[int], message: str):
+        super().__init__(f"{code} {message}" if code else message)
+        self.code = code
+
+
+class BatchJobError(Exception):
+    """O batch job inteiro terminou sem respostas (falhou, expirou ou foi cancelado)"""
+
+
+def chave_do_pedido(model: str, contents, config) -> str:
+    """Hash estável do pedido (modelo, conteúdo e config), usado no diário"""
+    digest = hashlib.sha256(model.encode())
+    for item in contents if isinstance(contents, list) else [contents]:
+        if isinstance(item, str):
+            digest.update(item.encode())
+        else:
+            digest.update(item.model_dump_json(exclude_none=True).encode())
+    if config is not None:
+        dumped = config.model_dump_json(exclude_none=True) if hasattr(config, "model_dump_json") else json.dumps(config, sort_keys=True)
+        digest.update(dumped.encode())
+    return digest.hexdigest()[:32]
+
+
+def tamanho_do_pedido(contents) -> int:
+    """Tamanho aproximado do pedido inline (bytes em base64 + texto)"""
+    size = 0
+    for item in contents if isinstance(contents, list) else [contents]:
+        if isinstance(item, str):
+            size += len(item.encode())
+        elif getattr(item, "inline_data", None) is not None and item.inline_data.data:
+            size += len(item.inline_data.data) * 4 // 3
+        else:
+            size += len(item.model_dump_json(exclude_none=True))
+    return size
+
+
+class _Pedido:
+    """Um pedido ainda não enviado"""
+    __slots__ = ("key", "contents", "config", "size")
+
+    def __init__(self, key: str, contents, config, size: int):
+        self.key = key
+        self.contents = contents
+        self.config = config
+        self.size = size
+
+
+class BatchDispatcher:
+    """
+    Junta chamadas generate_content em batch jobs e entrega as respostas.
+    batches: serviço no formato de client.aio.batches (create / get).
+    """
+
+    def __init__(
+        self,
+        batches,
+        max_requests: int = 100,
+        max_bytes: int = 16 * 1024 * 1024,
+        max_wait: float = 10.0,
+        poll_interval: float = 30.0,
+        journal_path: str = None,
+        label: str = "superhistorias",
+    ):
+        self.batches = batches
+        self.max_requests = max(1, max_requests)
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.journal_path = journal_path
+        self.label = label
+        self._pending: Dict[str, List[_Pedido]] = {}       # modelo -> pedidos a enviar
+        self._pending_bytes: Dict[str, int] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._waiting: Dict[str, List[asyncio.Future]] = {}  # chave -> quem espera a resposta
+        self._pollers: Dict[str, asyncio.Task] = {}         # nome do job -> poller
+        self._tasks = set()
+        self._journal: Dict[str, str] = {}                  # chave -> nome do job
+        if journal_path and os.path.exists(journal_path):
+            with open(journal_path, "r", encoding="utf-8") as f:
+                self._journal = json.load(f)
+        self.jobs_created = 0
+        self.requests_sent = 0
+        self.reattached = 0
+        self.item_errors = 0
+        self.job_errors = 0
+
+    async def generate_content(self, *, model: str, contents, config=None) -> types.GenerateContentResponse:
+        key = chave_do_pedido(model, contents, config)
+        future = asyncio.get_running_loop().create_future()
+        already_waiting = key in self._waiting
+        self._waiting.setdefault(key, []).append(future)
+
+        if already_waiting:
+            pass  # Pedido idêntico já a caminho (na fila ou em um job): recebe a mesma resposta
+        elif key in self._journal:
+            # Enviado por uma execução anterior: espera o mesmo job
+            self.reattached += 1
+            self._acompanhar(self._journal[key])
+        else:
+            self._enfileirar(model, _Pedido(key, contents, config, tamanho_do_pedido(contents)))
+
+        try:
+            return await future
+        finally:
+            waiters = self._waiting.get(key)
+            if waiters and future in waiters and future.cancelled():
+                waiters.remove(future)
+                if not waiters:
+                    del self._waiting[key]
+
+    def _enfileirar(self, model: str, pedido: _Pedido):
+        queue = self._pending.setdefault(model, [])
+        if queue and self._pending_bytes[model] + pedido.size > self.max_bytes:
+            self._enviar(model)  # O pedido não cabe no lote atual
+            queue = self._pending.setdefault(model, [])
+        queue.append(pedido)
+        self._pending_bytes[model] = self._pending_bytes.get(model, 0) + pedido.size
+
+        if len(queue) >= self.max_requests or self._pending_bytes[model] >= self.max_bytes:
+            self._enviar(model)
+        elif model not in self._timers:
+            self._timers[model] = asyncio.get_running_loop().call_later(self.max_wait, self._enviar, model)
+
+    def _enviar(self, model: str):
+        """Fecha o lote atual do modelo e o envia em background"""
+        timer = self._timers.pop(model, None)
+        if timer is not None:
+            timer.cancel()
+        pedidos = self._pending.pop(model, [])
+        self._pending_bytes.pop(model, None)
+        # Pedidos cujos interessados desistiram (prazo, cancelamento) não vão no lote
+        pedidos = [p for p in pedidos if self._waiting.get(p.key)]
+        if pedidos:
+            self._spawn(self._criar_job(model, pedidos))
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _criar_job(self, model: str, pedidos: List[_Pedido]):
+        try:
+            job = await self.batches.create(
+                model=model,
+                src=[
+                    types.InlinedRequest(model=model, contents=p.contents, config=p.config, metadata={"key": p.key})
+                    for p in pedidos
+                ],
+                config={"display_name": f"{self.label}-{int(time.time())}"}
+            )
+        except Exception as e:
+            # Cada interessado recebe o erro (e decide se tenta de novo)
+            print(f"⚠️ Falha ao criar batch job ({model}, {len(pedidos)} pedidos): {e}")
+            for p in pedidos:
+                self._entregar(p.key, error=e)
+            return
+
+        self.jobs_created += 1
+        self.requests_sent += len(pedidos)
+        print(f"📨 Batch job {job.name}: {len(pedidos)} pedidos para {model}")
+        for p in pedidos:
+            self._journal[p.key] = job.name
+        # O poller começa antes da escrita: o job já existe e as respostas precisam chegar
+        self._acompanhar(job.name)
+        await self._salvar_diario()
+
+    def _acompanhar(self, name: str):
+        if name not in self._pollers:
+            self._pollers[name] = self._spawn(self._poll(name))
+
+    async def _poll(self, name: str):
+        """Consulta o job até um estado final e entrega as respostas"""
+        failures = 0
+        try:
+            while True:
+                try:
+                    job = await self.batches.get(name=name)
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    if failures >= MAX_POLL_FAILURES:
+                        self._falhar_job(name, BatchJobError(f"Não foi possível consultar o batch job {name}: {e}"))
+                        return
+                    print(f"⚠️ Falha ao consultar o batch job {name} ({failures}/{MAX_POLL_FAILURES}): {e}")
+                else:
+                    if job.state in TERMINAL_STATES:
+                        self._concluir(name, job)
+                        return
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            self._pollers.pop(name, None)
+            await self._salvar_diario()
+
+    def _concluir(self, name: str, job: types.BatchJob):
+        responses = (job.dest.inlined_responses if job.dest else None) or []
+        if not responses:
+            state = job.state.name if job.state else "?"
+            detail = f": {job.error.message}" if job.error and job.error.message else ""
+            self._falhar_job(name, BatchJobError(f"Batch job {name} terminou em {state}{detail}"))
+            return
+
+        keys = [k for k, job_name in self._journal.items() if job_name == name]
+        delivered = set()
+        for index, item in enumerate(responses):
+            # As respostas vêm na ordem dos pedidos; o metadata traz a chave de volta
+            key = (item.metadata or {}).get("key") or (keys[index] if index < len(keys) else None)
+            if key is None:
+                continue
+            delivered.add(key)
+            if item.error is not None:
+                self.item_errors += 1
+                self._entregar(key, error=BatchItemError(item.error.code, item.error.message or "Erro no pedido do lote"))
+            else:
+                self._entregar(key, response=item.response)
+        for key in keys:
+            if key not in delivered:
+                self._entregar(key, error=BatchItemError(None, f"Pedido ausente nas respostas do batch job {name}"))
+
+    def _falhar_job(self, name: str, error: Exception):
+        self.job_errors += 1
+        print(f"❌ {error}")
+        for key in [k for k, job_name in self._journal.items() if job_name == name]:
+            self._entregar(key, error=error)
+
+    def _entregar(self, key: str, response=None, error: Exception = None):
+        """
+        Resolve quem espera a chave. Sem ninguém esperando (a história foi
+        interrompida), a chave fica no diário para uma execução seguinte.
+        """
+        waiters = self._waiting.pop(key, [])
+        if not waiters and error is None:
+            return
+        self._journal.pop(key, None)
+        for future in waiters:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(response)
+
+    async def _salvar_diario(self):
+        """
+        Grava o diário em uma thread a partir de uma cópia tirada no loop (o
+        dicionário continua mudando enquanto o arquivo é escrito). Uma falha
+        na escrita só custa a retomada, então vira aviso.
+        """
+        if not self.journal_path:
+            return
+        try:
+            await asyncio.to_thread(self._gravar_diario, dict(self._journal))
+        except Exception as e:
+            print(f"⚠️ Falha ao gravar o diário do batch ({self.journal_path}): {e}")
+
+    def _gravar_diario(self, snapshot: Dict[str, str]):
+        """Escrita atômica do diário (chave -> job) para retomar após interrupção"""
+        tmp_path = f"{self.journal_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.journal_path)
+
+    async def close(self):
+        """Para os pollers e timers; os jobs enviados continuam no serviço e no diário"""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._salvar_diario()
+
+    def stats(self) -> dict:
+        return {
+            "jobs_criados": self.jobs_created,
+            "pedidos_enviados": self.requests_sent,
+            "pedidos_retomados": self.reattached,
+            "erros_por_pedido": self.item_errors,
+            "jobs_com_falha": self.job_errors,
+            "jobs_em_andamento": len(self._pollers),
+            "pedidos_na_fila": sum(len(q) for q in self._pending.values()),
+        }
@@ -0,0 +1,148 @@
+"""
+Requisições "hedged" para as chamadas de imagem
+Se uma chamada passa do percentil configurado das latências recentes do
+modelo, uma cópia é disparada; a primeira que der certo vence e a outra é
+cancelada. Um orçamento limita a fração de chamadas duplicadas.
+"""
+import math
+import time
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+
+
+class LatencyTracker:
+    """Janela das latências recentes (em segundos) de cada modelo"""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[str, deque] = {}
+
+    def record(self, model: str, seconds: float):
+        samples = self._samples.get(model)
+        if samples is None:
+            samples = self._samples[model] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def count(self, model: str) -> int:
+        return len(self._samples.get(model, ()))
+
+    def percentile(self, model: str, q: float) -> Optional[float]:
+        """Percentil q (0-1) por nearest-rank; None sem amostras"""
+        samples = self._samples.get(model)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        rank = max(1, math.ceil(q * len(ordered)))
+        return ordered[rank - 1]
+
+    def stats(self) -> dict:
+        return {
+            model: {
+                "amostras": len(samples),
+                "p50": round(self.percentile(model, 0.5), 2),
+                "p90": round(self.percentile(model, 0.9), 2),
+                "p99": round(self.percentile(model, 0.99), 2),
+            }
+            for model, samples in self._samples.items() if samples
+        }
+
+
+class HedgePolicy:
+    """
+    Decide quando duplicar uma chamada: após o percentil `percentile` das
+    latências do modelo, apenas com `min_samples` amostras e enquanto as
+    cópias não passarem de `max_fraction` das chamadas.
+    """
+
+    def __init__(self, tracker: LatencyTracker, percentile: float = 0.9, max_fraction: float = 0.1, min_samples: int = 20):
+        self.tracker = tracker
+        self.percentile = percentile
+        self.max_fraction = max_fraction
+        self.min_samples = min_samples
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def delay(self, model: str) -> Optional[float]:
+        """Tempo de espera antes da cópia; None se não há histórico suficiente"""
+        if self.tracker.count(model) < self.min_samples:
+            return None
+        return self.tracker.percentile(model, self.percentile)
+
+    def allow(self) -> bool:
+        return self.hedges + 1 <= self.max_fraction * max(self.calls, 1)
+
+    def stats(self) -> dict:
+        return {
+            "percentile": self.percentile,
+            "max_fraction": self.max_fraction,
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "latencias": self.tracker.stats(),
+        }
+
+
+async def hedged(
+    model: str,
+    call: Callable[[], Awaitable],
+    policy: Optional[HedgePolicy],
+    try_reserve: Callable[[], bool] = lambda: True,
+    release: Callable[[], None] = lambda: None,
+    on_hedge: Callable[[float], None] = None,
+):
+    """
+    Executa call(); se passar do limite da política, dispara uma cópia
+    (apenas se try_reserve() conseguir uma vaga extra, devolvida com
+    release()). Retorna o primeiro resultado bem-sucedido; se as duas
+    falharem, levanta o erro da primeira a falhar.
+    """
+    if policy is None:
+        return await call()
+
+    policy.calls += 1
+    started = time.monotonic()
+    primary = asyncio.ensure_future(call())
+    try:
+        delay = policy.delay(model)
+        if delay is not None:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if not done and policy.allow() and try_reserve():
+                return await _race(model, primary, call, policy, release, on_hedge, started)
+
+        result = await primary
+        policy.tracker.record(model, time.monotonic() - started)
+        return result
+    finally:
+        if not primary.done():
+            primary.cancel()
+
+
+async def _race(model, primary, call, policy, release, on_hedge, started):
+    policy.hedges += 1
+    if on_hedge:
+        on_hedge(time.monotonic() - started)
+    hedge_started = time.monotonic()
+    hedge = asyncio.ensure_future(call())
+    hedge.add_done_callback(lambda _: release())
+    pending = {primary, hedge}
+    first_error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        policy.hedge_wins += 1
+                        policy.tracker.record(model, time.monotonic() - hedge_started)
+                    else:
+                        policy.tracker.record(model, time.monotonic() - started)
+                    return task.result()
+                first_error = first_error or task.exception()
+        raise first_error
+    finally:
+        # A perdedora (ou as duas, se quem chamou foi cancelado) é cancelada
+        for task in (primary, hedge):
+            if not task.done():
+                task.cancel()
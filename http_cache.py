@@ -0,0 +1,167 @@
+"""
+Cache HTTP das leituras de histórias
+- Arquivos de /historias: as ilustrações nunca são regravadas com o mesmo
+  nome, então saem com Cache-Control immutable; o story.json é revalidado
+  (ETag) e servido a partir das cópias .gz/.br gravadas junto com ele.
+- Endpoints JSON: ETag fraco a partir da versão do índice (304 sem consultar
+  os dados) e corpos já serializados e comprimidos em uma LRU em memória.
+"""
+import os
+import gzip
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Sequence, Tuple
+from starlette.staticfiles import StaticFiles, NotModifiedResponse
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+
+try:
+    import brotli
+except ImportError:  # Opcional: sem o pacote, só gzip
+    brotli = None
+
+# Codificações suportadas, em ordem de preferência -> extensão da cópia comprimida
+ENCODINGS = {"br": "br", "gzip": "gz"} if brotli else {"gzip": "gz"}
+
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATE = "no-cache"
+IMMUTABLE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".avif")
+
+# Abaixo disso a compressão não compensa (cabe em um pacote)
+MIN_COMPRESS_SIZE = 1024
+
+
+def comprimir(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def escolher_codificacao(accept_encoding: Optional[str], available: Sequence[str] = tuple(ENCODINGS)) -> Optional[str]:
+    """Melhor codificação aceita (header Accept-Encoding), na ordem de `available`"""
+    accepted = set()
+    for item in (accept_encoding or "").lower().split(","):
+        token, _, params = item.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(token.strip())
+    for encoding in available:
+        if encoding in accepted or "*" in accepted:
+            return encoding
+    return None
+
+
+def etag_fraco(value: str) -> str:
+    return f'W/"{value}"'
+
+
+def nao_modificado(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match casa com o ETag (comparação fraca, aceita lista e *)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    target = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == target for tag in if_none_match.split(","))
+
+
+def gravar_copias_comprimidas(path: str) -> Dict[str, str]:
+    """Grava `path`.gz (e .br) ao lado do arquivo, de forma atômica. Retorna codificação -> caminho."""
+    with open(path, "rb") as f:
+        data = f.read()
+    copies = {}
+    for encoding, ext in ENCODINGS.items():
+        dest = f"{path}.{ext}"
+        tmp_path = f"{dest}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(comprimir(data, encoding))
+        os.replace(tmp_path, dest)
+        copies[encoding] = dest
+    return copies
+
+
+def copia_comprimida(path: str, encoding: str) -> Optional[str]:
+    """Cópia comprimida de `path`, se existir e não for mais antiga que o original"""
+    copy_path = f"{path}.{ENCODINGS[encoding]}"
+    try:
+        if os.stat(copy_path).st_mtime_ns >= os.stat(path).st_mtime_ns:
+            return copy_path
+    except FileNotFoundError:
+        pass
+    return None
+
+
+class StoryStaticFiles(StaticFiles):
+    """
+    /historias com cabeçalhos de cache: ilustrações imutáveis e story.json
+    revalidado, servido comprimido quando houver cópia e o cliente aceitar.
+    """
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200) -> Response:
+        full_path = str(full_path)
+        request_headers = Headers(scope=scope)
+
+        if full_path.lower().endswith(IMMUTABLE_EXTENSIONS):
+            headers = {"Cache-Control": CACHE_IMMUTABLE}
+        elif os.path.basename(full_path) == "story.json":
+            headers = {"Cache-Control": CACHE_REVALIDATE, "Vary": "Accept-Encoding"}
+            encoding = escolher_codificacao(request_headers.get("accept-encoding"))
+            copy_path = copia_comprimida(full_path, encoding) if encoding else None
+            if copy_path:
+                # ETag e Content-Length vêm do stat da cópia: um por codificação
+                headers["Content-Encoding"] = encoding
+                full_path, stat_result = copy_path, os.stat(copy_path)
+        else:
+            headers = {"Cache-Control": CACHE_REVALIDATE}
+
+        response = FileResponse(
+            full_path, status_code=status_code, stat_result=stat_result,
+            headers=headers, media_type="application/json" if "Content-Encoding" in headers else None
+        )
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+class EncodedBodyCache:
+    """
+    Corpos de resposta JSON já serializados, por chave (que inclui a versão do
+    índice), com as versões comprimidas geradas sob demanda. LRU em memória;
+    os métodos podem ser chamados de threads.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()  # chave -> {codificação ou None: bytes}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(self, key, encoding: Optional[str], build: Callable[[], bytes]) -> Tuple[bytes, Optional[str]]:
+        """
+        Corpo para `key` na codificação pedida; build() serializa o corpo na
+        primeira vez. Retorna (bytes, codificação usada ou None).
+        """
+        with self._lock:
+            bodies = self._entries.get(key)
+            if bodies is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if bodies is None:
+            self.misses += 1
+            bodies = {None: build()}
+
+        if encoding is None or len(bodies[None]) < MIN_COMPRESS_SIZE:
+            encoding = None
+        elif encoding not in bodies:
+            bodies[encoding] = comprimir(bodies[None], encoding)
+
+        with self._lock:
+            self._entries[key] = bodies
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return bodies[encoding], encoding
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
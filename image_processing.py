@@ -0,0 +1,266 @@
+"""
+Processamento de imagens (Pillow) fora do event loop
+As funções deste módulo rodam em um pool de processos dedicado; por isso não
+importam nada da API (o processo filho só carrega este arquivo).
+"""
+import os
+import json
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import List, Optional, Tuple, Union
+from PIL import Image, ImageFilter, ImageOps
+
+try:
+    # Opcional (opencv-python-headless): detector de rostos local, só CPU
+    import cv2
+    import numpy
+except ImportError:
+    cv2 = None
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def salvar_imagem_gerada(image_bytes: bytes, png_path: str) -> dict:
+    """
+    Salva a imagem gerada em PNG. As versões menores (WebP/AVIF/JPEG) são
+    geradas sob demanda por gerar_variante.
+    """
+    img = Image.open(BytesIO(image_bytes))
+    original_size = img.size
+
+    if image_bytes.startswith(PNG_SIGNATURE):
+        # A API já devolve PNG: confere a integridade (CRCs, sem decodificar) e
+        # grava os bytes como vieram, sem recodificar
+        img.verify()
+        with open(png_path, "wb") as f:
+            f.write(image_bytes)
+    else:
+        img.save(png_path, "PNG")
+
+    return {
+        "dimensoes": original_size,
+        "tamanho_png": os.path.getsize(png_path),
+    }
+
+
+# Parâmetros de codificação por formato das variantes
+_VARIANT_SAVE = {
+    "avif": ("AVIF", {"quality": 60}),
+    "webp": ("WEBP", {"quality": 82, "method": 4}),
+    "jpeg": ("JPEG", {"quality": 85, "optimize": True, "progressive": True}),
+}
+
+
+def gerar_variante(source_path: str, dest_path: str, width: int, fmt: str) -> int:
+    """
+    Reduz a imagem para `width` de largura (sem ampliar) e grava em `fmt`
+    (avif, webp ou jpeg). Retorna o tamanho do arquivo gerado.
+    """
+    img = Image.open(source_path)
+    if img.width > width:
+        img.thumbnail((width, round(img.height * width / img.width)), Image.Resampling.LANCZOS)
+    if img.mode not in ("RGB", "RGBA") or (fmt == "jpeg" and img.mode != "RGB"):
+        img = img.convert("RGB")
+
+    pil_format, options = _VARIANT_SAVE[fmt]
+    tmp_path = f"{dest_path}.tmp"
+    img.save(tmp_path, pil_format, **options)
+    os.replace(tmp_path, dest_path)
+    return os.path.getsize(dest_path)
+
+
+# Recortes que manteriam quase a foto inteira não compensam
+MAX_CROP_AREA = 0.85
+# Lado da cópia reduzida usada na detecção
+DETECTION_SIZE = 640
+ORIENTATION_TAG = 0x0112
+
+Box = Tuple[int, int, int, int]
+
+_face_cascade = None
+
+
+def _detectar_rosto(img: Image.Image) -> Optional[Box]:
+    """Maior rosto (Haar cascade do OpenCV) em coordenadas de `img`, ou None"""
+    global _face_cascade
+    if cv2 is None:
+        return None
+    if _face_cascade is None:
+        _face_cascade = cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml"))
+    small = img.convert("L")
+    small.thumbnail((DETECTION_SIZE, DETECTION_SIZE))
+    scale = img.width / small.width
+    faces = _face_cascade.detectMultiScale(numpy.asarray(small), scaleFactor=1.1, minNeighbors=5, minSize=(24, 24))
+    if len(faces) == 0:
+        return None
+    x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
+    return round(x * scale), round(y * scale), round((x + w) * scale), round((y + h) * scale)
+
+
+def _faixa_central(profile: List[float], trim: float) -> Tuple[int, int]:
+    """Índices que contêm a energia do perfil sem as pontas (`trim` de cada lado)"""
+    total = sum(profile)
+    if not total:
+        return 0, len(profile)
+    acc, start, end = 0.0, 0, len(profile)
+    for i, value in enumerate(profile):
+        acc += value
+        if acc / total < trim:
+            start = i + 1
+        if acc / total <= 1 - trim:
+            end = i + 1
+    return start, max(end, start + 1)
+
+
+def _regiao_por_bordas(img: Image.Image) -> Optional[Box]:
+    """
+    Heurística sem detector: o sujeito concentra as bordas (fundos de selfie
+    costumam ser lisos ou desfocados). Região com a maior parte da energia
+    de bordas nas linhas e colunas. None quando a imagem é estreita demais.
+    """
+    small = img.convert("L")
+    small.thumbnail((160, 160))
+    if small.width <= 2 or small.height <= 2:
+        return None  # Sem miolo depois de descartar a moldura do FIND_EDGES
+    edges = small.filter(ImageFilter.FIND_EDGES).crop((1, 1, small.width - 1, small.height - 1))
+    # Redução por média (BOX) a uma linha / uma coluna = perfil de energia
+    columns = list(edges.resize((edges.width, 1), Image.Resampling.BOX).getdata())
+    rows = list(edges.resize((1, edges.height), Image.Resampling.BOX).getdata())
+    left, right = _faixa_central(columns, 0.08)
+    top, bottom = _faixa_central(rows, 0.08)
+    sx, sy = img.width / edges.width, img.height / edges.height
+    return round(left * sx), round(top * sy), round(right * sx), round(bottom * sy)
+
+
+def _encaixar(lo: float, hi: float, limit: int, min_length: float) -> Tuple[int, int]:
+    """Intervalo com pelo menos min_length, deslocado para caber em [0, limit]"""
+    missing = min_length - (hi - lo)
+    if missing > 0:
+        lo, hi = lo - missing / 2, hi + missing / 2
+    if hi - lo >= limit:
+        return 0, limit
+    if lo < 0:
+        lo, hi = 0, hi - lo
+    if hi > limit:
+        lo, hi = lo - (hi - limit), limit
+    return round(lo), round(hi)
+
+
+def _expandir(box: Box, size: Tuple[int, int], left: float, top: float, right: float, bottom: float, min_fraction: float = 0.4) -> Box:
+    """Expande a caixa (frações da largura/altura dela), com tamanho mínimo, dentro da imagem"""
+    x0, y0, x1, y1 = box
+    w, h = x1 - x0, y1 - y0
+    x0, x1 = _encaixar(x0 - w * left, x1 + w * right, size[0], size[0] * min_fraction)
+    y0, y1 = _encaixar(y0 - h * top, y1 + h * bottom, size[1], size[1] * min_fraction)
+    return x0, y0, x1, y1
+
+
+def regiao_do_sujeito(img: Image.Image) -> Tuple[Optional[Box], Optional[str]]:
+    """
+    Região a manter na foto de referência e o método usado ("rosto" ou
+    "bordas"). Do rosto, a região inclui cabelo, ombros e parte do tronco.
+    Retorna (None, None) quando o recorte não compensa.
+    """
+    face = _detectar_rosto(img)
+    if face is not None:
+        box, method = _expandir(face, img.size, left=1.0, top=0.7, right=1.0, bottom=2.0), "rosto"
+    else:
+        edges = _regiao_por_bordas(img)
+        if edges is None:
+            return None, None
+        box, method = _expandir(edges, img.size, 0.1, 0.1, 0.1, 0.1), "bordas"
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    if area >= MAX_CROP_AREA * img.width * img.height:
+        return None, None
+    return box, method
+
+
+def preparar_referencia(image_data: Union[bytes, str], max_dimension: int, quality: int = 92, crop: bool = False) -> Tuple[bytes, dict]:
+    """
+    Normaliza uma foto de referência (bytes ou caminho do arquivo): aplica a
+    orientação do EXIF, recorta na região do sujeito (crop=True), limita a
+    dimensão máxima, converte para RGB e codifica em JPEG com `quality`.
+    Retorna (bytes_jpeg, transformação). A transformação também vai no
+    comentário do JPEG (ver ler_transformacao), para quem recebe do cache.
+    """
+    img = Image.open(BytesIO(image_data) if isinstance(image_data, bytes) else image_data)
+    info = {"original": list(img.size)}
+
+    if img.getexif().get(ORIENTATION_TAG, 1) != 1:
+        img = ImageOps.exif_transpose(img)
+        info["orientacao_exif"] = True
+
+    if crop:
+        try:
+            box, method = regiao_do_sujeito(img)
+        except Exception as e:
+            # O recorte é só uma otimização: uma falha nele nunca recusa a foto
+            box, info["erro_recorte"] = None, str(e)
+        if box is not None:
+            img = img.crop(box)
+            info["recorte"] = list(box)
+            info["metodo"] = method
+
+    # Redimensionar se muito grande para economizar memória/processamento
+    if max(img.size) > max_dimension:
+        img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+    info["final"] = list(img.size)
+
+    # Converter para RGB (remove alpha channel; JPEG não aceita outros modos)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    buffer = BytesIO()
+    img.save(buffer, "JPEG", quality=quality, comment=json.dumps(info, separators=(",", ":")).encode())
+    return buffer.getvalue(), info
+
+
+def ler_transformacao(prepared: bytes) -> dict:
+    """Transformação gravada por preparar_referencia (lê só o cabeçalho do JPEG)"""
+    try:
+        return json.loads(Image.open(BytesIO(prepared)).info.get("comment") or b"{}")
+    except (OSError, ValueError):
+        return {}
+
+
+class ImageProcessor:
+    """
+    API async para o pool de processos do Pillow.
+    workers=0 executa em thread (útil em ambientes sem multiprocessing).
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> Optional[ProcessPoolExecutor]:
+        if self.workers > 0 and self._executor is None:
+            # spawn: o filho não herda o estado do servidor (loop, conexões HTTP)
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def run(self, func, *args):
+        executor = self._get_executor()
+        if executor is None:
+            return await asyncio.to_thread(func, *args)
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    async def salvar_imagem_gerada(self, image_bytes: bytes, png_path: str) -> dict:
+        return await self.run(salvar_imagem_gerada, image_bytes, png_path)
+
+    async def gerar_variante(self, source_path: str, dest_path: str, width: int, fmt: str) -> int:
+        return await self.run(gerar_variante, source_path, dest_path, width, fmt)
+
+    async def preparar_referencia(self, image_data: Union[bytes, str], max_dimension: int, quality: int = 92, crop: bool = False) -> Tuple[bytes, dict]:
+        return await self.run(preparar_referencia, image_data, max_dimension, quality, crop)
+
+    def shutdown(self, wait: bool = True):
+        """Encerra o pool; com wait, espera os processos saírem (sem semáforos vazados)"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
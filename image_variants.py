@@ -0,0 +1,147 @@
+"""
+Variantes responsivas das ilustrações (largura x formato)
+Cada variante é gerada no primeiro pedido (no pool do Pillow) e guardada em
+disco com LRU limitado por tamanho. A chave inclui o mtime do original, então
+uma imagem regenerada ganha variantes novas e as antigas saem pela LRU.
+"""
+import os
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Sequence
+
+# Formato -> (extensão, content-type)
+VARIANT_FORMATS = {
+    "avif": ("avif", "image/avif"),
+    "webp": ("webp", "image/webp"),
+    "jpeg": ("jpg", "image/jpeg"),
+}
+
+
+def negociar_formato(accept: Optional[str], available: Sequence[str]) -> str:
+    """Melhor formato aceito pelo cliente (header Accept), na ordem de `available`"""
+    accept = (accept or "").lower()
+    for fmt in available:
+        if fmt != "jpeg" and VARIANT_FORMATS[fmt][1] in accept:
+            return fmt
+    return "jpeg"
+
+
+def escolher_largura(requested: Optional[int], widths: Sequence[int]) -> int:
+    """Menor largura configurada que cobre a pedida (limita as combinações em cache)"""
+    widths = sorted(widths)
+    if not requested:
+        return widths[-1]
+    for width in widths:
+        if width >= requested:
+            return width
+    return widths[-1]
+
+
+def _tocar(path: str):
+    os.utime(path)  # Mantém a ordem LRU entre reinícios
+
+
+def _remover(paths: Sequence[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class VariantCache:
+    """
+    Cache em disco das variantes, com LRU por tamanho total. Pedidos
+    simultâneos da mesma variante esperam uma única geração.
+    """
+
+    def __init__(self, directory: str, disk_budget: int):
+        self.directory = directory
+        self.disk_budget = disk_budget
+        self._entries: OrderedDict = OrderedDict()  # nome do arquivo -> tamanho
+        self._bytes = 0
+        self._pending: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(directory):
+            if name.endswith(".tmp"):
+                continue
+            stat = os.stat(os.path.join(directory, name))
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self._bytes += size
+
+    @staticmethod
+    def key(source_path: str, width: int, fmt: str) -> str:
+        """Nome do arquivo da variante (muda quando o original é regravado)"""
+        stat = os.stat(source_path)
+        digest = hashlib.sha256(f"{source_path}:{stat.st_mtime_ns}:{stat.st_size}:{width}".encode()).hexdigest()[:32]
+        return f"{digest}_{width}.{VARIANT_FORMATS[fmt][0]}"
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    async def get_or_create(self, name: str, create: Callable[[str], Awaitable[int]]) -> str:
+        """
+        Caminho da variante `name`; se não existir, create(caminho) a gera
+        (gravando no caminho recebido) e retorna o tamanho em bytes.
+        """
+        if name in self._entries:
+            self._entries.move_to_end(name)
+            self.hits += 1
+            try:
+                await asyncio.to_thread(_tocar, self.path(name))
+                return self.path(name)
+            except OSError:
+                self._bytes -= self._entries.pop(name, 0)  # Removido por fora: gera de novo
+
+        pending = self._pending.get(name)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[name] = future
+        try:
+            size = await create(self.path(name))
+            self._add(name, size)
+            future.set_result(self.path(name))
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Evita o aviso de exceção não lida se ninguém esperava
+            raise
+        finally:
+            del self._pending[name]
+        await self._evict()
+        return self.path(name)
+
+    def _add(self, name: str, size: int):
+        self._entries[name] = size
+        self._entries.move_to_end(name)
+        self._bytes += size
+
+    async def _evict(self):
+        evicted = []
+        # A mais recente (a que acabou de ser gerada) nunca sai
+        while self._bytes > self.disk_budget and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            evicted.append(self.path(name))
+        if evicted:
+            self.evictions += len(evicted)
+            await asyncio.to_thread(_remover, evicted)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
@@ -0,0 +1,487 @@
+"""
+Jobs de geração e seus logs de eventos
+Cada geração roda como um job com id; todo evento SSE é gravado em um log
+append-only (SQLite) com número sequencial, para que a conexão possa cair e
+ser retomada com Last-Event-ID sem perder nada.
+
+A tabela de jobs é também a fila: workers (no processo da API ou em
+processos separados, ver worker.py) reivindicam jobs com um lease renovado
+periodicamente. Se o processo morre, o lease expira e outro worker retoma o
+job a partir do último checkpoint salvo.
+
+Quem acompanha o stream marca o job como assistido (watched_at). Jobs não
+"detached" que ficam sem ninguém acompanhando além da carência configurada
+são cancelados pelo worker.
+
+Jobs criados com uma impressão digital (fingerprint) do pedido não se
+repetem: enquanto um estiver na fila ou em execução, pedidos iguais recebem
+o mesmo id e acompanham o mesmo log de eventos.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import sqlite3
+from contextlib import contextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id          TEXT PRIMARY KEY,
+    status      TEXT NOT NULL,
+    request     TEXT NOT NULL,
+    created_at  REAL NOT NULL,
+    updated_at  REAL NOT NULL,
+    last_seq    INTEGER NOT NULL DEFAULT 0,
+    checkpoint  TEXT,
+    worker      TEXT,
+    lease_until REAL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    detached    INTEGER NOT NULL DEFAULT 0,
+    watched_at  REAL,
+    fingerprint TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (status, created_at);
+-- No máximo um job ativo por pedido; os encerrados servem de cache de resultado
+CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active_fingerprint ON jobs (fingerprint)
+    WHERE status IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS idx_jobs_fingerprint ON jobs (fingerprint, status, updated_at);
+CREATE TABLE IF NOT EXISTS job_events (
+    job_id      TEXT NOT NULL,
+    seq         INTEGER NOT NULL,
+    type        TEXT NOT NULL,
+    payload     TEXT NOT NULL,
+    PRIMARY KEY (job_id, seq)
+) WITHOUT ROWID;
+"""
+
+# Estados terminais: o log não cresce mais
+FINISHED_STATUSES = ("complete", "error", "interrupted", "cancelled")
+
+# Colunas adicionadas depois da primeira versão da tabela
+_JOB_COLUMNS = {
+    "checkpoint": "TEXT",
+    "worker": "TEXT",
+    "lease_until": "REAL",
+    "attempts": "INTEGER NOT NULL DEFAULT 0",
+    "detached": "INTEGER NOT NULL DEFAULT 0",
+    "watched_at": "REAL",
+    "fingerprint": "TEXT",
+}
+
+
+class JobStore:
+    """
+    Persistência dos jobs e dos eventos. Cada operação abre sua própria
+    conexão, então os métodos podem ser chamados de qualquer thread.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if columns:
+                for name, definition in _JOB_COLUMNS.items():
+                    if name not in columns:
+                        conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {definition}")
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """Conexão curta: commit ao sair do bloco (rollback em erro) e fechamento"""
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def create(self, job_id: str, request: dict, detached: bool = False, fingerprint: Optional[str] = None) -> str:
+        """
+        Enfileira um job (detached: continua mesmo sem ninguém acompanhando).
+        Com fingerprint, se um job igual já estiver na fila ou em execução,
+        nada é criado (single-flight): retorna o id dele, que passa a ser
+        detached se este pedido for. Retorna o id do job a acompanhar.
+        """
+        now = time.time()
+        for _ in range(2):
+            with self._connect() as conn:
+                if fingerprint:
+                    # O UPDATE já reserva a escrita: verificação e INSERT na mesma transação
+                    row = conn.execute(
+                        "UPDATE jobs SET detached = MAX(detached, ?) "
+                        "WHERE fingerprint = ? AND status IN ('queued', 'running') RETURNING id",
+                        (int(detached), fingerprint),
+                    ).fetchone()
+                    if row:
+                        return row[0]
+                try:
+                    conn.execute(
+                        "INSERT INTO jobs (id, status, request, created_at, updated_at, detached, watched_at, fingerprint) "
+                        "VALUES (?, 'queued', ?, ?, ?, ?, ?, ?)",
+                        (job_id, json.dumps(request, ensure_ascii=False), now, now, int(detached), now, fingerprint),
+                    )
+                    return job_id
+                except sqlite3.IntegrityError:
+                    if not fingerprint:
+                        raise
+                    # Outro processo criou o mesmo job entre as duas instruções: junta-se a ele
+        raise RuntimeError(f"Não foi possível criar o job {job_id}")
+
+    def completed(self, fingerprint: str, max_age_seconds: float) -> Optional[Tuple[str, int]]:
+        """
+        Job concluído há menos de max_age_seconds com a mesma impressão digital.
+        Retorna (id do job, seq do evento "complete") ou None.
+        """
+        with self._connect() as conn:
+            return conn.execute(
+                """
+                SELECT jobs.id, job_events.seq FROM jobs
+                JOIN job_events ON job_events.job_id = jobs.id AND job_events.type = 'complete'
+                WHERE jobs.fingerprint = ? AND jobs.status = 'complete' AND jobs.updated_at >= ?
+                ORDER BY jobs.updated_at DESC
+                LIMIT 1
+                """,
+                (fingerprint, time.time() - max_age_seconds),
+            ).fetchone()
+
+    def claim(self, worker_id: str, lease_seconds: float) -> Optional[dict]:
+        """
+        Reivindica o job mais antigo na fila (ou com lease expirado).
+        Retorna {"id", "request", "checkpoint", "attempts"} ou None.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                """
+                UPDATE jobs SET status = 'running', worker = ?, lease_until = ?,
+                                attempts = attempts + 1, updated_at = ?
+                WHERE id = (
+                    SELECT id FROM jobs
+                    WHERE status = 'queued'
+                       OR (status = 'running' AND (lease_until IS NULL OR lease_until < ?))
+                    ORDER BY created_at
+                    LIMIT 1
+                )
+                RETURNING id, request, checkpoint, attempts
+                """,
+                (worker_id, now + lease_seconds, now, now),
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "request": json.loads(row[1]),
+            "checkpoint": json.loads(row[2]) if row[2] else None,
+            "attempts": row[3],
+        }
+
+    def renew(self, job_ids: List[str], worker_id: str, lease_seconds: float):
+        """Renova o lease dos jobs em execução por este worker"""
+        if not job_ids:
+            return
+        lease_until = time.time() + lease_seconds
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                [(lease_until, job_id, worker_id) for job_id in job_ids],
+            )
+
+    def touch(self, job_id: str):
+        """Registra que alguém está acompanhando o job"""
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET watched_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def abandoned(self, job_ids: List[str], idle_seconds: float) -> List[str]:
+        """Dentre job_ids, os não detached sem ninguém acompanhando há mais de idle_seconds"""
+        if not job_ids:
+            return []
+        placeholders = ", ".join("?" for _ in job_ids)
+        with self._connect() as conn:
+            return [row[0] for row in conn.execute(
+                f"SELECT id FROM jobs WHERE id IN ({placeholders}) AND detached = 0 AND watched_at < ?",
+                (*job_ids, time.time() - idle_seconds),
+            )]
+
+    def release(self, job_id: str):
+        """Devolve um job à fila (worker encerrado antes do fim)"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL, lease_until = NULL, updated_at = ? WHERE id = ?",
+                (time.time(), job_id),
+            )
+
+    def save_checkpoint(self, job_id: str, checkpoint: dict):
+        """Grava o estado já concluído do job (retomado se ele for reivindicado de novo)"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET checkpoint = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(checkpoint, ensure_ascii=False), time.time(), job_id),
+            )
+
+    def append(self, job_id: str, event_type: str, payload: str) -> int:
+        """Acrescenta um evento ao log do job e retorna seu número sequencial"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET last_seq = last_seq + 1, updated_at = ? WHERE id = ?",
+                (time.time(), job_id),
+            )
+            seq = conn.execute("SELECT last_seq FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+            conn.execute(
+                "INSERT INTO job_events (job_id, seq, type, payload) VALUES (?, ?, ?, ?)",
+                (job_id, seq, event_type, payload),
+            )
+        return seq
+
+    def events_after(self, job_id: str, after_seq: int, limit: int = 500) -> List[Tuple[int, str]]:
+        """Eventos com número maior que after_seq, em ordem: [(seq, payload)]"""
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT seq, payload FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (job_id, after_seq, limit),
+            ).fetchall()
+
+    def finish(self, job_id: str, status: str):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+                (status, time.time(), job_id),
+            )
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, status, created_at, updated_at, last_seq, attempts FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "status": row[1],
+            "createdAt": row[2],
+            "updatedAt": row[3],
+            "lastEventId": row[4],
+            "attempts": row[5],
+        }
+
+    def pending(self) -> int:
+        """Jobs na fila ou em execução"""
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+
+    def purge(self, max_age_seconds: float) -> int:
+        """Remove jobs encerrados há mais de max_age_seconds (e seus eventos)"""
+        cutoff = time.time() - max_age_seconds
+        placeholders = ", ".join("?" for _ in FINISHED_STATUSES)
+        with self._connect() as conn:
+            ids = [row[0] for row in conn.execute(
+                f"SELECT id FROM jobs WHERE status IN ({placeholders}) AND updated_at < ?",
+                (*FINISHED_STATUSES, cutoff),
+            )]
+            for job_id in ids:
+                conn.execute("DELETE FROM job_events WHERE job_id = ?", (job_id,))
+                conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        return len(ids)
+
+    def referenced_photos(self) -> Set[str]:
+        """photo_ids citados pelos pedidos dos jobs ainda guardados (qualquer estado)"""
+        photo_ids = set()
+        with self._connect() as conn:
+            for (request,) in conn.execute("SELECT request FROM jobs"):
+                try:
+                    characters = json.loads(request).get("characters") or []
+                except (TypeError, ValueError):
+                    continue
+                for character in characters:
+                    photo_ids.update(character.get("photo_ids") or [])
+        return photo_ids
+
+
+class JobEventLog:
+    """
+    Lado async do log: grava fora do event loop e acorda quem está
+    acompanhando o job. Eventos gravados por outro processo (workers
+    separados) são vistos na próxima leitura, a cada poll_interval.
+    """
+
+    def __init__(self, store: JobStore, poll_interval: float = 2.0):
+        self.store = store
+        self.poll_interval = poll_interval
+        self._versions: dict = {}
+        self._changed = asyncio.Condition()
+
+    async def _notify(self, job_id: str):
+        async with self._changed:
+            self._versions[job_id] = self._versions.get(job_id, 0) + 1
+            self._changed.notify_all()
+
+    async def append(self, job_id: str, event_type: str, payload: str) -> int:
+        seq = await asyncio.to_thread(self.store.append, job_id, event_type, payload)
+        await self._notify(job_id)
+        return seq
+
+    async def finish(self, job_id: str, status: str):
+        await asyncio.to_thread(self.store.finish, job_id, status)
+        await self._notify(job_id)
+        self._versions.pop(job_id, None)
+
+    async def follow(self, job_id: str, after_seq: int = 0, ping_interval: float = 2.0) -> AsyncIterator[Tuple[Optional[int], Optional[str]]]:
+        """
+        Repete os eventos após after_seq e continua ao vivo até o job terminar.
+        Gera (seq, payload); (None, None) quando passou ping_interval sem eventos.
+        """
+        last_sent = time.monotonic()
+        last_touch = None
+        while True:
+            if last_touch is None or time.monotonic() - last_touch >= ping_interval:
+                # Mantém o job marcado como assistido enquanto esta conexão existir
+                last_touch = time.monotonic()
+                await asyncio.to_thread(self.store.touch, job_id)
+            version = self._versions.get(job_id, 0)
+            job = await asyncio.to_thread(self.store.get, job_id)
+            if job is None:
+                return
+            events = await asyncio.to_thread(self.store.events_after, job_id, after_seq)
+            for seq, payload in events:
+                after_seq = seq
+                yield seq, payload
+            if events:
+                last_sent = time.monotonic()
+                continue
+            if job["status"] in FINISHED_STATUSES:
+                return
+
+            idle = time.monotonic() - last_sent
+            if idle >= ping_interval:
+                last_sent = time.monotonic()
+                yield None, None
+                continue
+            try:
+                async with self._changed:
+                    await asyncio.wait_for(
+                        self._changed.wait_for(lambda: self._versions.get(job_id, 0) != version),
+                        timeout=min(self.poll_interval, ping_interval - idle)
+                    )
+            except asyncio.TimeoutError:
+                pass
+
+
+JobHandler = Callable[[dict], Awaitable[str]]
+
+
+class JobWorker:
+    """
+    Consumidor da fila. Roda até `concurrency` jobs ao mesmo tempo, renova
+    os leases enquanto eles executam e registra o estado final retornado
+    pelo handler. Ao parar, os jobs em andamento voltam para a fila.
+
+    Com abandon_after, jobs sem ninguém acompanhando há mais desse tempo são
+    cancelados: o job recebe job["abandoned"] = True antes do cancelamento e
+    termina como "cancelled".
+    """
+
+    def __init__(
+        self,
+        events: JobEventLog,
+        handler: JobHandler,
+        concurrency: int = 4,
+        lease_seconds: float = 30.0,
+        poll_interval: float = 1.0,
+        worker_id: Optional[str] = None,
+        abandon_after: Optional[float] = None,
+    ):
+        self.events = events
+        self.store = events.store
+        self.handler = handler
+        self.concurrency = max(1, concurrency)
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.abandon_after = abandon_after
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.running: Dict[str, asyncio.Task] = {}
+        self.jobs: Dict[str, dict] = {}
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+    def wake(self):
+        """Avisa que há job novo na fila (evita esperar o próximo poll)"""
+        self._wakeup.set()
+
+    async def run(self):
+        renewer = asyncio.create_task(self._renew_leases())
+        try:
+            while not self._stopping:
+                while len(self.running) < self.concurrency:
+                    job = await asyncio.to_thread(self.store.claim, self.worker_id, self.lease_seconds)
+                    if job is None:
+                        break
+                    task = asyncio.create_task(self._run_job(job))
+                    self.running[job["id"]] = task
+                    self.jobs[job["id"]] = job
+                    task.add_done_callback(lambda t, job_id=job["id"]: self._job_done(job_id))
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            renewer.cancel()
+
+    def _job_done(self, job_id: str):
+        self.running.pop(job_id, None)
+        self.jobs.pop(job_id, None)
+        self._wakeup.set()  # Vaga livre: tenta reivindicar o próximo
+
+    async def _run_job(self, job: dict):
+        job_id = job["id"]
+        try:
+            status = await self.handler(job)
+        except asyncio.CancelledError:
+            if job.get("abandoned"):
+                status = "cancelled"
+            else:
+                if self._stopping:
+                    # Encerramento do worker: outro processo retoma do checkpoint
+                    await asyncio.shield(asyncio.to_thread(self.store.release, job_id))
+                raise
+        except Exception as e:
+            print(f"❌ Job {job_id} falhou: {e}")
+            status = "error"
+        await self.events.finish(job_id, status)
+
+    async def _renew_leases(self):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await asyncio.to_thread(self.store.renew, list(self.running), self.worker_id, self.lease_seconds)
+            except Exception as e:
+                print(f"⚠️ Falha ao renovar leases: {e}")
+            if self.abandon_after:
+                try:
+                    await self._cancel_abandoned()
+                except Exception as e:
+                    print(f"⚠️ Falha ao verificar jobs abandonados: {e}")
+
+    async def _cancel_abandoned(self):
+        job_ids = await asyncio.to_thread(self.store.abandoned, list(self.running), self.abandon_after)
+        for job_id in job_ids:
+            task = self.running.get(job_id)
+            if task and not task.done():
+                print(f"🛑 Job {job_id} sem ninguém acompanhando há {self.abandon_after:.0f}s: cancelando")
+                self.jobs[job_id]["abandoned"] = True
+                task.cancel()
+
+    async def stop(self):
+        """Para de reivindicar jobs e devolve os que estão em andamento à fila"""
+        self._stopping = True
+        self._wakeup.set()
+        tasks = list(self.running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
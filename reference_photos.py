@@ -0,0 +1,353 @@
+"""
+Fotos de referência dos personagens
+- PhotoStore: originais enviados por upload, endereçados pelo hash SHA-256
+- ReferencePhotoCache: fotos já preparadas (decodificadas, em RGB e
+  reduzidas), com LRU em memória e em disco
+- ReferenceSet: as fotos de uma história, enviadas uma única vez à Files API
+  quando esse modo está ativo
+- ReferenceMemory: memória ocupada pelas fotos das histórias em andamento
+"""
+import os
+import re
+import time
+import uuid
+import asyncio
+import hashlib
+from collections import OrderedDict
+from io import BytesIO
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from google.genai import types
+
+PHOTO_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _ler_arquivo(path: str) -> bytes:
+    with open(path, "rb") as f:
+        data = f.read()
+    os.utime(path)  # Mantém a ordem LRU entre reinícios
+    return data
+
+
+def _gravar_arquivo(path: str, data: bytes, remover: List[str]):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    for old_path in remover:
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass
+
+
+class PhotoTooLargeError(ValueError):
+    """Upload maior que o limite configurado"""
+
+
+class PhotoStore:
+    """
+    Originais das fotos enviadas, gravados uma única vez por conteúdo.
+    O id da foto é o SHA-256 dos bytes. A data do arquivo marca o último
+    envio: sweep() apaga as fotos paradas há mais tempo que a retenção.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, photo_id: str) -> str:
+        if not PHOTO_ID_PATTERN.match(photo_id):
+            raise ValueError(f"Id de foto inválido: {photo_id}")
+        return os.path.join(self.directory, f"{photo_id}.img")
+
+    def exists(self, photo_id: str) -> bool:
+        try:
+            return os.path.exists(self.path(photo_id))
+        except ValueError:
+            return False
+
+    async def save_stream(self, read_chunk: Callable[[int], Awaitable[bytes]], max_bytes: int) -> Tuple[str, int]:
+        """
+        Grava um upload em disco pedaço a pedaço, calculando o hash no caminho.
+        Retorna (photo_id, tamanho_em_bytes).
+        """
+        tmp_path = os.path.join(self.directory, f".upload_{uuid.uuid4().hex}")
+        digest = hashlib.sha256()
+        size = 0
+        f = await asyncio.to_thread(open, tmp_path, "wb")
+        try:
+            while chunk := await read_chunk(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise PhotoTooLargeError(f"Arquivo maior que {max_bytes // (1024 * 1024)}MB")
+                digest.update(chunk)
+                await asyncio.to_thread(f.write, chunk)
+        except BaseException:
+            f.close()
+            os.remove(tmp_path)
+            raise
+        f.close()
+
+        photo_id = digest.hexdigest()
+        final_path = self.path(photo_id)
+        if os.path.exists(final_path):
+            os.remove(tmp_path)  # Conteúdo já conhecido
+            os.utime(final_path)  # Enviada de novo: recomeça a contar a retenção
+        else:
+            os.replace(tmp_path, final_path)
+        return photo_id, size
+
+    def save_bytes(self, data: bytes, photo_id: Optional[str] = None) -> str:
+        """Grava uma foto já em memória (ex.: recebida em Base64). Retorna o id."""
+        photo_id = photo_id or hashlib.sha256(data).hexdigest()
+        final_path = self.path(photo_id)
+        if os.path.exists(final_path):
+            os.utime(final_path)
+        else:
+            _gravar_arquivo(final_path, data, [])
+        return photo_id
+
+    def remove(self, photo_id: str):
+        try:
+            os.remove(self.path(photo_id))
+        except (OSError, ValueError):
+            pass
+
+    def sweep(self, max_age_seconds: float, keep: Iterable[str] = ()) -> int:
+        """
+        Apaga as fotos (e uploads interrompidos) sem novo envio há mais de
+        max_age_seconds, exceto as de `keep` (citadas por jobs ainda guardados).
+        Retorna quantas fotos foram apagadas.
+        """
+        cutoff = time.time() - max_age_seconds
+        keep = set(keep)
+        removed = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(".img"):
+                if name[:-4] in keep:
+                    continue
+            elif not name.startswith(".upload_"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+                os.remove(path)
+            except OSError:
+                continue  # Removida ou regravada no meio da varredura
+            if name.endswith(".img"):
+                removed += 1
+        return removed
+
+
+class ReferencePhotoCache:
+    """
+    Cache LRU de duas camadas para as fotos preparadas.
+    O índice fica no event loop; apenas a leitura/escrita dos arquivos vai para thread.
+    """
+
+    def __init__(self, directory: str, memory_budget: int, disk_budget: int):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self._memory: OrderedDict = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: OrderedDict = OrderedDict()
+        self._disk_bytes = 0
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(directory):
+            if not name.endswith(".jpg"):
+                continue
+            path = os.path.join(directory, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.jpg")
+
+    async def get(self, key: str) -> Optional[bytes]:
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self.hits_memory += 1
+            return data
+
+        if key in self._disk:
+            try:
+                data = await asyncio.to_thread(_ler_arquivo, self._path(key))
+            except OSError:
+                self._disk_bytes -= self._disk.pop(key, 0)
+            else:
+                self._disk.move_to_end(key)
+                self._store_memory(key, data)
+                self.hits_disk += 1
+                return data
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, data: bytes):
+        self._store_memory(key, data)
+        if key in self._disk or len(data) > self.disk_budget:
+            return
+
+        self._disk[key] = len(data)
+        self._disk_bytes += len(data)
+        evicted = []
+        while self._disk_bytes > self.disk_budget:
+            old_key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            evicted.append(self._path(old_key))
+        await asyncio.to_thread(_gravar_arquivo, self._path(key), data, evicted)
+
+    def _store_memory(self, key: str, data: bytes):
+        if len(data) > self.memory_budget:
+            return
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_budget:
+            _, old = self._memory.popitem(last=False)
+            self._memory_bytes -= len(old)
+
+    def stats(self) -> dict:
+        return {
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "disk_entries": len(self._disk),
+            "disk_bytes": self._disk_bytes,
+        }
+
+
+class ReferenceMemory:
+    """
+    Contabilidade das fotos de referência em uso pelas histórias em andamento.
+    A mesma foto (o mesmo objeto bytes, vindo do cache) usada por várias
+    histórias conta uma vez no total do processo.
+    """
+
+    def __init__(self):
+        self._buffers: Dict[int, list] = {}  # id(bytes) -> [referências, tamanho]
+        self.bytes = 0
+        self.peak_bytes = 0
+        self.sets = 0
+        self.story_peak_bytes = 0
+
+    def acquire(self, buffers: List[bytes]):
+        self.sets += 1
+        self.story_peak_bytes = max(self.story_peak_bytes, sum(len(data) for data in buffers))
+        for data in buffers:
+            entry = self._buffers.get(id(data))
+            if entry is None:
+                # O ReferenceSet mantém o objeto vivo, então o id não é reutilizado até o release
+                self._buffers[id(data)] = [1, len(data)]
+                self.bytes += len(data)
+            else:
+                entry[0] += 1
+        self.peak_bytes = max(self.peak_bytes, self.bytes)
+
+    def release(self, buffers: List[bytes]):
+        self.sets -= 1
+        for data in buffers:
+            entry = self._buffers.get(id(data))
+            if entry is None:
+                continue
+            entry[0] -= 1
+            if entry[0] == 0:
+                del self._buffers[id(data)]
+                self.bytes -= entry[1]
+
+    def stats(self) -> dict:
+        return {
+            "historias": self.sets,
+            "bytes": self.bytes,
+            "pico_bytes": self.peak_bytes,
+            "pico_bytes_por_historia": self.story_peak_bytes,
+        }
+
+
+class ReferenceSet:
+    """
+    Fotos de referência de uma história, já codificadas (JPEG): os mesmos
+    bytes são anexados às seis chamadas, sem recodificar.
+    mode="inline": os bytes vão em cada chamada de imagem.
+    mode="files": as fotos são enviadas uma vez à Files API (na primeira
+    chamada que precisar delas) e as chamadas passam apenas as referências.
+    memory: contabilidade do processo (liberada em close()).
+    """
+
+    def __init__(self, parts: List[types.Part], mode: str = "inline", files_service=None, label: str = "historia",
+                 memory: Optional[ReferenceMemory] = None):
+        self.parts = parts
+        self.mode = mode if files_service is not None else "inline"
+        self.files_service = files_service
+        self.label = label
+        self.uploaded: List[types.File] = []
+        self._file_parts: Optional[List[types.Part]] = None
+        self._lock = asyncio.Lock()
+        self.memory = memory
+        if memory is not None:
+            memory.acquire(self._buffers())
+
+    def _buffers(self) -> List[bytes]:
+        return [part.inline_data.data for part in self.parts if part.inline_data is not None]
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes das fotos desta história"""
+        return sum(len(data) for data in self._buffers())
+
+    def __len__(self) -> int:
+        return len(self.parts)
+
+    async def contents(self) -> List[types.Part]:
+        """Partes a anexar em cada chamada de imagem"""
+        if self.mode != "files" or not self.parts:
+            return self.parts
+        async with self._lock:
+            if self._file_parts is None:
+                file_parts = []
+                for idx, part in enumerate(self.parts):
+                    uploaded = await self.files_service.upload(
+                        file=BytesIO(part.inline_data.data),
+                        config={
+                            "mime_type": part.inline_data.mime_type,
+                            "display_name": f"{self.label}_ref_{idx + 1}"
+                        }
+                    )
+                    self.uploaded.append(uploaded)
+                    file_parts.append(types.Part.from_uri(file_uri=uploaded.uri, mime_type=uploaded.mime_type))
+                self._file_parts = file_parts
+        return self._file_parts
+
+    async def close(self) -> int:
+        """
+        Libera a contabilidade de memória e remove os arquivos enviados à
+        Files API. Retorna quantos foram removidos.
+        """
+        if self.memory is not None:
+            self.memory.release(self._buffers())
+            self.memory = None
+        files, self.uploaded = self.uploaded, []
+        self._file_parts = None
+        if not files:
+            return 0
+        results = await asyncio.gather(
+            *[self.files_service.delete(name=f.name) for f in files],
+            return_exceptions=True
+        )
+        return sum(1 for r in results if not isinstance(r, BaseException))
@@ -0,0 +1,277 @@
+"""
+Agendador global das chamadas ao Gemini
+Limita o número de chamadas simultâneas no processo inteiro e distribui as
+vagas em round-robin entre as histórias, para que os retries de uma história
+não passem na frente das primeiras tentativas de outra.
+"""
+import re
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Optional
+
+_RETRY_DELAY_PATTERNS = [
+    re.compile(r"retryDelay['\"]?\s*:\s*['\"]?(\d+(?:\.\d+)?)s", re.IGNORECASE),
+    re.compile(r"retry (?:in|after) (\d+(?:\.\d+)?)\s*s", re.IGNORECASE),
+]
+
+
+def is_quota_error(error) -> bool:
+    """True para erros de cota (HTTP 429 / RESOURCE_EXHAUSTED)"""
+    if getattr(error, "code", None) == 429:
+        return True
+    error_str = str(error)
+    return "RESOURCE_EXHAUSTED" in error_str or error_str.startswith("429")
+
+
+def retry_after_hint(error) -> Optional[float]:
+    """Extrai o tempo de espera sugerido pela API (retryDelay / Retry-After), se houver"""
+    retry_after = getattr(error, "retry_after", None)  # Ex.: CircuitOpenError
+    if isinstance(retry_after, (int, float)):
+        return float(retry_after)
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers:
+        try:
+            value = headers.get("retry-after")
+            if value is not None:
+                return float(value)
+        except (TypeError, ValueError):
+            pass
+    error_str = str(error)
+    for pattern in _RETRY_DELAY_PATTERNS:
+        match = pattern.search(error_str)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+class _Waiter:
+    """Uma chamada aguardando vaga"""
+    __slots__ = ("future", "on_position", "position")
+
+    def __init__(self, future: asyncio.Future, on_position: Optional[Callable[[int], None]]):
+        self.future = future
+        self.on_position = on_position
+        self.position = None
+
+
+class GenerationScheduler:
+    """
+    Fila justa com limite de chamadas em andamento.
+    Cada história tem sua própria fila FIFO; as vagas são entregues uma por
+    história a cada rodada.
+    """
+
+    def __init__(self, name: str, max_in_flight: int, controller: "AimdController" = None):
+        self.name = name
+        self.max_in_flight = max(1, max_in_flight)
+        self.limit = self.max_in_flight  # Limite efetivo (ajustado pelo controlador)
+        self.controller = controller
+        if controller:
+            controller.attach(self)
+        self.in_flight = 0
+        self._queues: Dict[str, deque] = {}
+        self._order: deque = deque()
+        self._tasks: Dict[str, set] = {}
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    @asynccontextmanager
+    async def slot(self, story_key: str, on_position: Callable[[int], None] = None):
+        """Reserva uma vaga durante o bloco `async with`"""
+        await self.acquire(story_key, on_position)
+        try:
+            yield
+        except Exception as e:
+            if self.controller:
+                self.controller.record_error(e)
+            raise
+        else:
+            if self.controller:
+                self.controller.record_success()
+        finally:
+            self.release()
+
+    async def acquire(self, story_key: str, on_position: Callable[[int], None] = None):
+        """
+        Aguarda uma vaga. on_position(n) é chamado sempre que a posição na fila
+        muda (1 = próxima a sair) e com 0 quando a vaga é concedida.
+        """
+        if self.in_flight < self.limit and not self._order:
+            self.in_flight += 1
+            return
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), on_position)
+        key = story_key or "_"
+        if key not in self._queues:
+            self._queues[key] = deque()
+            self._order.append(key)
+        self._queues[key].append(waiter)
+        self._notify_positions()
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # A vaga foi concedida junto com o cancelamento: devolve
+                self.release()
+            else:
+                self._remove(key, waiter)
+            raise
+
+        if on_position:
+            on_position(0)
+
+    def try_acquire(self) -> bool:
+        """Pega uma vaga apenas se houver sobra agora (sem fila); usado por chamadas opcionais"""
+        if self.in_flight < self.limit and not self._order:
+            self.in_flight += 1
+            return True
+        return False
+
+    def release(self):
+        """Libera uma vaga e entrega a próxima na rotação"""
+        self.in_flight -= 1
+        self._dispatch()
+
+    def set_limit(self, limit: int):
+        """Ajusta o limite efetivo (entre 1 e max_in_flight) e libera a fila se cresceu"""
+        self.limit = max(1, min(self.max_in_flight, limit))
+        self._dispatch()
+
+    def submit(self, story_key: str, coro) -> asyncio.Task:
+        """Cria a task de uma história e a registra para cancelamento em grupo"""
+        task = asyncio.create_task(coro)
+        tasks = self._tasks.setdefault(story_key, set())
+        tasks.add(task)
+
+        def _done(t, key=story_key):
+            group = self._tasks.get(key)
+            if group is not None:
+                group.discard(t)
+                if not group:
+                    del self._tasks[key]
+
+        task.add_done_callback(_done)
+        return task
+
+    def cancel(self, story_key: str) -> int:
+        """Cancela todas as tasks ainda pendentes de uma história"""
+        pending = [t for t in self._tasks.get(story_key, ()) if not t.done()]
+        for task in pending:
+            task.cancel()
+        return len(pending)
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "max_in_flight": self.max_in_flight,
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "stories_waiting": len(self._order),
+            "controller": self.controller.stats() if self.controller else None,
+        }
+
+    def _dispatch(self):
+        while self.in_flight < self.limit and self._order:
+            key = self._order.popleft()
+            queue = self._queues[key]
+            waiter = queue.popleft()
+            if queue:
+                self._order.append(key)  # Volta para o fim da rodada
+            else:
+                del self._queues[key]
+            if waiter.future.done():
+                continue
+            self.in_flight += 1
+            waiter.future.set_result(None)
+        self._notify_positions()
+
+    def _remove(self, key: str, waiter: _Waiter):
+        queue = self._queues.get(key)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[key]
+            self._order.remove(key)
+        self._notify_positions()
+
+    def _notify_positions(self):
+        """Simula a rotação para calcular a posição de cada chamada na fila"""
+        queues = [self._queues[key] for key in self._order]
+        position = 1
+        depth = 0
+        while True:
+            advanced = False
+            for queue in queues:
+                if depth < len(queue):
+                    advanced = True
+                    waiter = queue[depth]
+                    if waiter.position != position:
+                        waiter.position = position
+                        if waiter.on_position:
+                            waiter.on_position(position)
+                    position += 1
+            if not advanced:
+                break
+            depth += 1
+
+
+class AimdController:
+    """
+    Controle adaptativo AIMD do limite de concorrência, compartilhado por
+    todas as requisições: erros de cota reduzem o limite multiplicativamente
+    e sucessos o aumentam de forma aditiva (+increase a cada `limit` sucessos).
+    """
+
+    def __init__(self, min_limit: int = 1, increase: float = 1.0, decrease: float = 0.5, cooldown: float = 5.0):
+        self.min_limit = max(1, min_limit)
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.scheduler: Optional[GenerationScheduler] = None
+        self.window = 0.0  # Limite "contínuo"; o agendador usa a parte inteira
+        self.successes = 0
+        self.quota_errors = 0
+        self.decreases = 0
+        self.last_decrease = 0.0
+
+    def attach(self, scheduler: GenerationScheduler):
+        self.scheduler = scheduler
+        self.window = float(scheduler.max_in_flight)
+
+    def record_success(self):
+        self.successes += 1
+        if self.scheduler is None or self.window >= self.scheduler.max_in_flight:
+            return
+        self.window = min(self.scheduler.max_in_flight, self.window + self.increase / max(self.window, 1.0))
+        if int(self.window) != self.scheduler.limit:
+            self.scheduler.set_limit(int(self.window))
+
+    def record_error(self, error):
+        if not is_quota_error(error):
+            return
+        self.quota_errors += 1
+        now = time.monotonic()
+        # Vários 429 da mesma rajada contam como um único sinal de congestionamento
+        if self.scheduler is None or now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        self.decreases += 1
+        self.window = max(float(self.min_limit), self.window * self.decrease)
+        self.scheduler.set_limit(int(self.window))
+
+    def stats(self) -> dict:
+        return {
+            "window": round(self.window, 2),
+            "min_limit": self.min_limit,
+            "successes": self.successes,
+            "quota_errors": self.quota_errors,
+            "decreases": self.decreases,
+        }
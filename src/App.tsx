@@ -8,7 +8,7 @@ import StoryViewer from './components/StoryViewer';
 import Modal from './components/Modal';
 import { useCharacters } from './hooks/useCharacters';
 import { useStories } from './hooks/useStories';
-import { getImageUrl } from './utils/imageUtils';
+import { getStoryImageUrl } from './utils/imageUtils';
 import type { User, Story, StoryRequest } from './types';
 import './App.css';
 
@@ -23,7 +23,10 @@ function App() {
 
     // Custom hooks for data management
     const { characters, addCharacter, deleteCharacter, hasCharacters } = useCharacters();
-    const { stories, addStory, storiesCount, isLoading: isLoadingStories, error: storiesError } = useStories();
+    const {
+        stories, addStory, storiesCount, isLoading: isLoadingStories, error: storiesError,
+        hasMore, loadMoreStories, fetchStory
+    } = useStories();
 
     // Placeholder: Google Login
     const handleLogin = (): void => {
@@ -68,8 +71,11 @@ function App() {
         setView('home');
     };
 
-    const handleViewSavedStory = (story: Story): void => {
-        setCompletedStory(story);
+    const handleViewSavedStory = async (story: Story): Promise<void> => {
+        // A galeria traz só o resumo; o texto completo vem de /api/stories/{id}
+        const fullStory = story.parts?.length ? story : await fetchStory(story.id);
+        if (!fullStory) return;
+        setCompletedStory(fullStory);
         setShowGalleryModal(false);
         setView('viewing');
     };
@@ -261,7 +267,7 @@ function App() {
                                 </span>
                             </div>
 
-                            {isLoadingStories ? (
+                            {isLoadingStories && stories.length === 0 ? (
                                 <div className="loading-stories">
                                     <div className="spinner"></div>
                                     <p>Buscando suas histórias...</p>
@@ -293,7 +299,12 @@ function App() {
                                             )}
                                             <div className="story-card-cover">
                                                 {story.images?.capa ? (
-                                                    <img src={getImageUrl(story.images.capa) || ''} alt="" />
+                                                    <img
+                                                        src={getStoryImageUrl(story.id, 'capa', 320)}
+                                                        srcSet={`${getStoryImageUrl(story.id, 'capa', 320)} 1x, ${getStoryImageUrl(story.id, 'capa', 640)} 2x`}
+                                                        alt=""
+                                                        loading="lazy"
+                                                    />
                                                 ) : (
                                                     <span className="story-card-placeholder" aria-hidden="true">📚</span>
                                                 )}
@@ -370,7 +381,7 @@ function App() {
             </main>
 
             <Modal isOpen={showGalleryModal} onClose={() => setShowGalleryModal(false)} title="🖼️ Minhas Histórias">
-                {isLoadingStories ? (
+                {isLoadingStories && stories.length === 0 ? (
                     <div className="gallery-placeholder">
                         <div className="spinner"></div>
                         <p>Carregando galeria...</p>
@@ -402,9 +413,11 @@ function App() {
                                 )}
                                 {story.images?.capa ? (
                                     <img
-                                        src={getImageUrl(story.images.capa) || ''}
+                                        src={getStoryImageUrl(story.id, 'capa', 320)}
+                                        srcSet={`${getStoryImageUrl(story.id, 'capa', 320)} 1x, ${getStoryImageUrl(story.id, 'capa', 640)} 2x`}
                                         alt=""
                                         className="gallery-story-cover"
+                                        loading="lazy"
                                     />
                                 ) : (
                                     <div className="gallery-story-cover cover-placeholder-mini">
@@ -420,6 +433,15 @@ function App() {
                                 </div>
                             </article>
                         ))}
+                        {hasMore && (
+                            <button
+                                className="btn btn-primary"
+                                onClick={() => loadMoreStories()}
+                                disabled={isLoadingStories}
+                            >
+                                {isLoadingStories ? 'Carregando...' : 'Carregar mais'}
+                            </button>
+                        )}
                     </div>
                 )}
             </Modal>
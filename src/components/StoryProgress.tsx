@@ -7,6 +7,9 @@ import './StoryProgress.css';
 const GENERATION_TIMEOUT_MS = 5 * 60 * 1000;
 // Timeout de inatividade - igual ao timeout global para evitar cortes prematuros
 const INACTIVITY_TIMEOUT_MS = 5 * 60 * 1000;
+// Retomada do stream do job (Last-Event-ID) quando a conexão cai
+const MAX_STREAM_RECONNECTS = 5;
+const RECONNECT_DELAY_MS = 2000;
 
 interface CurrentImage {
     id: string;
@@ -37,6 +40,7 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }: St
     const [imagesInProgress, setImagesInProgress] = useState<Record<string, number>>({});
     const [imageElapsedTimes, setImageElapsedTimes] = useState<Record<string, number>>({});
     const [imageAttempts, setImageAttempts] = useState<Record<string, number>>({});
+    const [imageQueuePositions, setImageQueuePositions] = useState<Record<string, number>>({});
     const [imageErrors, setImageErrors] = useState<Record<string, string>>({});
     const [error, setError] = useState<string | null>(null);
     const [isComplete, setIsComplete] = useState(false);
@@ -141,44 +145,83 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }: St
                     }),
                 });
 
-                if (!response.body) {
-                    throw new Error('Response body is null');
-                }
-
-                const reader = response.body.getReader();
-                const decoder = new TextDecoder();
-                let streamFinishedCleanly = false;
+                // Id do job no servidor: permite retomar o stream se a conexão cair
+                const jobId = response.headers.get('X-Job-Id');
+                let lastEventId: string | null = null;
                 let terminalEventReceived = false;
+                let reconnects = 0;
+                let currentResponse: Response | null = response;
 
-                while (true) {
-                    const { done, value } = await reader.read();
-                    if (done) {
-                        streamFinishedCleanly = true;
-                        break;
+                const readStream = async (res: Response): Promise<void> => {
+                    if (!res.body) {
+                        throw new Error('Response body is null');
                     }
 
-                    const text = decoder.decode(value);
-                    const lines = text.split('\n');
+                    const reader = res.body.getReader();
+                    const decoder = new TextDecoder();
 
-                    for (const line of lines) {
-                        if (line.startsWith('data: ')) {
-                            try {
-                                const data = JSON.parse(line.slice(6)) as SSEEvent;
-                                handleEvent(data);
+                    while (true) {
+                        const { done, value } = await reader.read();
+                        if (done) {
+                            break;
+                        }
 
-                                if (data.type === 'error' || data.type === 'complete') {
-                                    terminalEventReceived = true;
+                        const text = decoder.decode(value);
+                        const lines = text.split('\n');
+
+                        for (const line of lines) {
+                            if (line.startsWith('id: ')) {
+                                lastEventId = line.slice(4).trim();
+                            } else if (line.startsWith('data: ')) {
+                                try {
+                                    const data = JSON.parse(line.slice(6)) as SSEEvent;
+                                    handleEvent(data);
+
+                                    if (data.type === 'error' || data.type === 'complete') {
+                                        terminalEventReceived = true;
+                                    }
+                                } catch {
+                                    console.warn('Failed to parse SSE data:', line);
                                 }
-                            } catch {
-                                console.warn('Failed to parse SSE data:', line);
                             }
                         }
                     }
-                }
+                };
+
+                while (true) {
+                    const resumedFrom = lastEventId;
+                    try {
+                        if (currentResponse) await readStream(currentResponse);
+                    } catch (err) {
+                        if (!jobId || reconnects >= MAX_STREAM_RECONNECTS) throw err;
+                        console.warn('⚠️ Conexão interrompida, tentando retomar...', err);
+                    }
+                    if (terminalEventReceived) break;
+                    if (lastEventId !== resumedFrom) {
+                        reconnects = 0; // A conexão anterior trouxe eventos novos
+                    }
+
+                    if (!jobId || reconnects >= MAX_STREAM_RECONNECTS) {
+                        console.error('❌ Stream encerrado sem evento de conclusão');
+                        setError('A conexão foi encerrada inesperadamente antes da conclusão da história.');
+                        break;
+                    }
 
-                if (streamFinishedCleanly && !terminalEventReceived) {
-                    console.error('❌ Stream encerrado sem evento de conclusão');
-                    setError('A conexão foi encerrada inesperadamente antes da conclusão da história.');
+                    // A geração continua no servidor: retoma a partir do último evento recebido
+                    reconnects += 1;
+                    await new Promise(resolve => setTimeout(resolve, RECONNECT_DELAY_MS));
+                    try {
+                        currentResponse = await fetch(`${API_BASE}/api/jobs/${jobId}/events`, {
+                            headers: lastEventId ? { 'Last-Event-ID': lastEventId } : {}
+                        });
+                    } catch (err) {
+                        console.warn('⚠️ Falha ao reconectar:', err);
+                        currentResponse = null;
+                        continue;
+                    }
+                    if (!currentResponse.ok) {
+                        throw new Error(`HTTP ${currentResponse.status}`);
+                    }
                 }
             } catch (err) {
                 console.error('SSE Error:', err);
@@ -226,7 +269,11 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }: St
                 setStageTitle(data.title);
                 setMessage(data.message);
                 setProgress(data.progress);
-                setStoryData(data.data);
+                // Eventos parciais (streaming) só atualizam o progresso: a história
+                // ainda está incompleta até o evento final
+                if (!data.partial) {
+                    setStoryData(data.data);
+                }
                 break;
 
             case 'image_start':
@@ -247,6 +294,20 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }: St
                 setMessage(data.message);
                 break;
 
+            case 'image_queued':
+                // Só a posição na fila: tentativas e cronômetro seguem os de image_start/image_retry
+                setImageQueuePositions(prev => {
+                    const updated = { ...prev };
+                    if (data.queuePosition > 0) {
+                        updated[data.imageId] = data.queuePosition;
+                    } else {
+                        delete updated[data.imageId];
+                    }
+                    return updated;
+                });
+                setMessage(data.message);
+                break;
+
             case 'image_retry':
                 setImageAttempts(prev => ({
                     ...prev,
@@ -265,6 +326,11 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }: St
                     delete updated[data.imageId];
                     return updated;
                 });
+                setImageQueuePositions(prev => {
+                    const updated = { ...prev };
+                    delete updated[data.imageId];
+                    return updated;
+                });
                 setProgress(data.progress);
                 setMessage(data.message);
                 break;
@@ -279,6 +345,11 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }: St
                     delete updated[data.imageId];
                     return updated;
                 });
+                setImageQueuePositions(prev => {
+                    const updated = { ...prev };
+                    delete updated[data.imageId];
+                    return updated;
+                });
                 break;
 
             case 'complete':
@@ -446,6 +517,9 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }: St
                                             <div className="img-loading-stats">
                                                 <span className="img-attempt">{(imageAttempts.capa || 1)}/{MAX_IMAGE_RETRIES}</span>
                                                 <span className="img-elapsed">{imageElapsedTimes.capa || 0}s</span>
+                                                {imageQueuePositions.capa && (
+                                                    <span className="img-queue">fila #{imageQueuePositions.capa}</span>
+                                                )}
                                             </div>
                                         </div>
                                     ) : (
@@ -487,6 +561,9 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }: St
                                                     <div className="img-loading-stats">
                                                         <span className="img-attempt">{(imageAttempts[imageId] || 1)}/{MAX_IMAGE_RETRIES}</span>
                                                         <span className="img-elapsed">{imageElapsedTimes[imageId] || 0}s</span>
+                                                        {imageQueuePositions[imageId] && (
+                                                            <span className="img-queue">fila #{imageQueuePositions[imageId]}</span>
+                                                        )}
                                                     </div>
                                                 </div>
                                             ) : (
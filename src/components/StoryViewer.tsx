@@ -1,12 +1,57 @@
 import { useState, useEffect, useCallback } from 'react';
-import type { StoryViewerProps, Universe } from '../types';
+import type { StoryImages, StoryViewerProps, Universe } from '../types';
 import { API_BASE } from '../constants';
+import { getStoryImageSrcSet } from '../utils';
 import { UNIVERSES } from './UniverseSelector';
 import './StoryViewer.css';
 
 export default function StoryViewer({ story, onClose }: StoryViewerProps) {
     const [currentPage, setCurrentPage] = useState(0); // 0 = cover, 1-5 = chapters
     const totalPages = story.parts.length + 1; // cover + chapters
+    // Ilustrações podem ser regeneradas aqui (histórias salvas como incompletas)
+    const [images, setImages] = useState<StoryImages>(story.images || {});
+    const [regenerating, setRegenerating] = useState<string | null>(null);
+    const [regenerateError, setRegenerateError] = useState<string | null>(null);
+
+    const regenerateImage = async (imageKey: string): Promise<void> => {
+        setRegenerating(imageKey);
+        setRegenerateError(null);
+        try {
+            const response = await fetch(
+                `${API_BASE}/api/stories/${encodeURIComponent(story.id)}/images/${imageKey}/regenerate`,
+                { method: 'POST' }
+            );
+            if (!response.ok) {
+                throw new Error('Falha ao gerar a ilustração');
+            }
+            const updated = await response.json();
+            setImages(updated.images || {});
+        } catch (e) {
+            console.error('Erro ao regenerar ilustração:', e);
+            setRegenerateError('Não foi possível gerar a ilustração. Tente novamente.');
+        } finally {
+            setRegenerating(null);
+        }
+    };
+
+    const renderRegenerateButton = (imageKey: string) => {
+        if (!story.id) return null;
+        if (regenerating === imageKey) {
+            return <span className="no-image-text">Gerando ilustração...</span>;
+        }
+        return (
+            <>
+                <button
+                    className="btn btn-primary btn-sm"
+                    onClick={() => regenerateImage(imageKey)}
+                    disabled={regenerating !== null}
+                >
+                    🔄 Gerar ilustração
+                </button>
+                {regenerateError && <span className="no-image-text">{regenerateError}</span>}
+            </>
+        );
+    };
 
     const getImageUrl = (imagePath: string | undefined): string | null => {
         if (!imagePath) return null;
@@ -115,14 +160,17 @@ export default function StoryViewer({ story, onClose }: StoryViewerProps) {
 
             {/* Imagem de fundo fullscreen (desktop) / Imagem normal (mobile) */}
             <div className="cover-fullscreen-bg">
-                {story.images.capa ? (
+                {images.capa ? (
                     <img
-                        src={getImageUrl(story.images.capa) || ''}
+                        src={getImageUrl(images.capa) || ''}
+                        srcSet={story.id ? getStoryImageSrcSet(story.id, 'capa') : undefined}
+                        sizes="100vw"
                         alt={`Capa da história: ${story.title}`}
                     />
                 ) : (
                     <div className="cover-no-image">
                         <span className="cover-placeholder" aria-hidden="true">📖</span>
+                        {renderRegenerateButton('capa')}
                     </div>
                 )}
             </div>
@@ -183,7 +231,7 @@ export default function StoryViewer({ story, onClose }: StoryViewerProps) {
     const renderChapterPage = (chapterIndex: number) => {
         const [text, imagePrompt] = story.parts[chapterIndex] || ['', ''];
         const imageKey = `parte_${chapterIndex + 1}`;
-        const imageUrl = getImageUrl(story.images[imageKey]);
+        const imageUrl = getImageUrl(images[imageKey]);
 
         return (
             <div className="book-page chapter-page">
@@ -191,12 +239,15 @@ export default function StoryViewer({ story, onClose }: StoryViewerProps) {
                     {imageUrl ? (
                         <img
                             src={imageUrl}
+                            srcSet={story.id ? getStoryImageSrcSet(story.id, imageKey) : undefined}
+                            sizes="(max-width: 768px) 100vw, 50vw"
                             alt={`Ilustração do capítulo ${chapterIndex + 1}`}
                         />
                     ) : (
                         <div className="chapter-no-image">
                             <span className="no-image-icon" aria-hidden="true">🎨</span>
                             <span className="no-image-text">Ilustração em breve</span>
+                            {renderRegenerateButton(imageKey)}
                         </div>
                     )}
                 </div>
@@ -5,22 +5,37 @@ import type { Story, UseStoriesReturn } from '../types';
 /**
  * Hook customizado para gerenciar histórias
  * Agora lê diretamente da API do servidor (pasta /historias)
+ * A galeria recebe apenas o resumo de cada história, página por página;
+ * o conteúdo completo é buscado ao abrir a história (fetchStory).
+ * storiesCount vem do total informado pela API, não das páginas já carregadas
  */
 export function useStories(): UseStoriesReturn {
     const [stories, setStories] = useState<Story[]>([]);
+    const [nextCursor, setNextCursor] = useState<string | null>(null);
+    const [total, setTotal] = useState<number | null>(null);
     const [isLoading, setIsLoading] = useState(false);
     const [error, setError] = useState<string | null>(null);
 
-    const fetchStories = useCallback(async () => {
+    const fetchPage = useCallback(async (cursor: string | null) => {
         setIsLoading(true);
         setError(null);
         try {
-            const response = await fetch(`${API_BASE}/api/stories`);
+            const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+            const response = await fetch(`${API_BASE}/api/stories${query}`);
             if (!response.ok) {
                 throw new Error('Falha ao bscar histórias do servidor');
             }
             const data = await response.json();
-            setStories(data.stories || []);
+            const page: Story[] = data.stories || [];
+            setStories(prev => {
+                if (!cursor) return page;
+                const known = new Set(prev.map(s => s.id));
+                return [...prev, ...page.filter(s => !known.has(s.id))];
+            });
+            setNextCursor(data.nextCursor || null);
+            if (typeof data.total === 'number') {
+                setTotal(data.total);
+            }
         } catch (e) {
             console.error('Erro ao buscar histórias:', e);
             setError('Não foi possível carregar suas histórias.');
@@ -29,6 +44,27 @@ export function useStories(): UseStoriesReturn {
         }
     }, []);
 
+    const fetchStories = useCallback(() => fetchPage(null), [fetchPage]);
+
+    const loadMoreStories = useCallback(async () => {
+        if (nextCursor) {
+            await fetchPage(nextCursor);
+        }
+    }, [fetchPage, nextCursor]);
+
+    const fetchStory = useCallback(async (id: string): Promise<Story | null> => {
+        try {
+            const response = await fetch(`${API_BASE}/api/stories/${encodeURIComponent(id)}`);
+            if (!response.ok) {
+                throw new Error('Falha ao buscar a história');
+            }
+            return await response.json();
+        } catch (e) {
+            console.error('Erro ao buscar história:', e);
+            return null;
+        }
+    }, []);
+
     // Carregar histórias na montagem do componente
     useEffect(() => {
         fetchStories();
@@ -37,6 +73,9 @@ export function useStories(): UseStoriesReturn {
     const addStory = useCallback((storyData: Partial<Story>): Story => {
         const newStory = storyData as Story;
 
+        if (!stories.some(s => s.id === newStory.id)) {
+            setTotal(prev => (prev === null ? prev : prev + 1));
+        }
         setStories(prev => {
             // Verificar se já existe uma história com esse ID (evita duplicados)
             if (prev.some(s => s.id === newStory.id)) {
@@ -46,13 +85,16 @@ export function useStories(): UseStoriesReturn {
         });
 
         return newStory;
-    }, []);
+    }, [stories]);
 
     const deleteStory = useCallback((id: string): void => {
         // Nota: Atualmente a API não tem endpoint de delete
         // Remove apenas do estado local por enquanto
+        if (stories.some(s => s.id === id)) {
+            setTotal(prev => (prev === null ? prev : Math.max(0, prev - 1)));
+        }
         setStories(prev => prev.filter(s => s.id !== id));
-    }, []);
+    }, [stories]);
 
     const getStoryById = useCallback((id: string): Story | undefined => {
         return stories.find(s => s.id === id);
@@ -64,10 +106,13 @@ export function useStories(): UseStoriesReturn {
         deleteStory,
         getStoryById,
         hasStories: stories.length > 0,
-        storiesCount: stories.length,
+        storiesCount: total ?? stories.length,
         isLoading,
         error,
-        refreshStories: fetchStories
+        refreshStories: fetchStories,
+        hasMore: nextCursor !== null,
+        loadMoreStories,
+        fetchStory
     };
 }
 
@@ -57,6 +57,9 @@ export interface Story {
     characters: Character[] | { id: string; name: string }[];
     totalTime?: number;
     is_complete?: boolean;
+    status?: 'completed' | 'incomplete';
+    image_state?: Record<string, { status: 'done' | 'failed' | 'missing'; error?: string }>;
+    models?: { text: string | null; images: Record<string, string | null> }; // Modelos que de fato geraram cada parte
 }
 
 export interface StoryRequest {
@@ -83,6 +86,7 @@ export type SSEEventType =
     | 'stage'
     | 'story_created'
     | 'image_start'
+    | 'image_queued'
     | 'image_done'
     | 'image_error'
     | 'image_retry'
@@ -104,6 +108,7 @@ export interface SSEStoryCreatedEvent {
     message: string;
     progress: number;
     elapsed: number;
+    partial?: boolean;  // true enquanto o texto ainda chega via streaming
     data: {
         title: string;
         parts: [string, string][];
@@ -133,6 +138,14 @@ export interface SSEImageDoneEvent {
     progress: number;
 }
 
+export interface SSEImageQueuedEvent {
+    type: 'image_queued';
+    stage: number;
+    imageId: string;
+    message: string;
+    queuePosition: number;  // 0 = vaga concedida, a geração começou
+}
+
 export interface SSEImageErrorEvent {
     type: 'image_error';
     stage: number;
@@ -170,6 +183,7 @@ export type SSEEvent =
     | SSEStageEvent
     | SSEStoryCreatedEvent
     | SSEImageStartEvent
+    | SSEImageQueuedEvent
     | SSEImageDoneEvent
     | SSEImageErrorEvent
     | SSEImageRetryEvent
@@ -252,6 +266,9 @@ export interface UseStoriesReturn {
     isLoading: boolean;
     error: string | null;
     refreshStories: () => Promise<void>;
+    hasMore: boolean;
+    loadMoreStories: () => Promise<void>;
+    fetchStory: (id: string) => Promise<Story | null>;
 }
 
 // ============================================
@@ -22,6 +22,21 @@ export function getImageUrl(url: string | null | undefined): string | null {
     return url;
 }
 
+/**
+ * URL de uma ilustração redimensionada pela API
+ * O formato (AVIF/WebP/JPEG) é negociado pelo header Accept do navegador
+ */
+export function getStoryImageUrl(storyId: string, imageId: string, width: number): string {
+    return `${API_BASE}/api/stories/${encodeURIComponent(storyId)}/images/${imageId}?w=${width}`;
+}
+
+/**
+ * srcSet com as larguras servidas pela API (IMAGE_VARIANT_WIDTHS)
+ */
+export function getStoryImageSrcSet(storyId: string, imageId: string, widths: number[] = [320, 640, 1200]): string {
+    return widths.map(w => `${getStoryImageUrl(storyId, imageId, w)} ${w}w`).join(', ');
+}
+
 /**
  * Extrai nomes de uma lista de personagens
  * Aceita array de strings ou array de objetos {name: string}
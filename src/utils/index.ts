@@ -1,4 +1,4 @@
 /**
  * Central export for all utility functions
  */
-export { getImageUrl, getCharacterNames, getUniverseName } from './imageUtils';
+export { getImageUrl, getStoryImageUrl, getStoryImageSrcSet, getCharacterNames, getUniverseName } from './imageUtils';
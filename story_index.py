@@ -0,0 +1,325 @@
+"""
+Índice SQLite das histórias salvas
+Alimentado sempre que um story.json é gravado; serve a galeria e a busca
+por id sem varrer a pasta de histórias.
+
+Reconstrução a partir das pastas existentes:
+    python story_index.py rebuild [--stories-dir historias] [--db dados/index.sqlite3]
+"""
+import os
+import json
+import base64
+import sqlite3
+import argparse
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+REQUIRED_IMAGES = ["capa", "parte_1", "parte_2", "parte_3", "parte_4", "parte_5"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stories (
+    id          TEXT PRIMARY KEY,
+    folder      TEXT NOT NULL,
+    created_at  TEXT NOT NULL,
+    is_complete INTEGER NOT NULL,
+    status      TEXT,
+    universe_id TEXT,
+    title       TEXT,
+    summary     TEXT,
+    data        TEXT NOT NULL,
+    version     INTEGER NOT NULL DEFAULT 0
+);
+-- Contador global de alterações: ETag da galeria e de cada história
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+CREATE INDEX IF NOT EXISTS idx_stories_gallery ON stories (is_complete, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_stories_universe ON stories (universe_id, is_complete, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_stories_folder ON stories (folder);
+"""
+
+# Campos de primeiro nível do story.json aceitos em `fields=` (também evita
+# SQL arbitrário no json_extract)
+STORY_FIELDS = (
+    "id", "folder", "createdAt", "status", "title", "visual_style", "character_bible",
+    "cover_prompt", "parts", "images", "image_state", "models", "reference_photos",
+    "universe", "characters", "totalTime",
+)
+
+
+class InvalidCursorError(ValueError):
+    """Cursor de paginação malformado"""
+
+
+class InvalidFieldError(ValueError):
+    """Campo pedido em `fields=` que não existe na história"""
+
+
+def story_is_complete(story: dict) -> bool:
+    """Uma história está completa quando tem as 6 imagens"""
+    images = story.get("images") or {}
+    return all(key in images for key in REQUIRED_IMAGES)
+
+
+def story_summary(story: dict) -> dict:
+    """Representação leve usada pela galeria: título, capa, data e universo"""
+    universe = story.get("universe")
+    if isinstance(universe, dict):
+        universe = {"id": universe.get("id"), "name": universe.get("name")}
+    images = story.get("images") or {}
+    return {
+        "id": story["id"],
+        "folder": story.get("folder") or story["id"],
+        "title": story.get("title"),
+        "createdAt": story.get("createdAt") or "",
+        "status": story.get("status"),
+        "universe": universe,
+        "images": {"capa": images["capa"]} if "capa" in images else {},
+        "is_complete": story_is_complete(story),
+    }
+
+
+def encode_cursor(is_complete: int, created_at: str, story_id: str) -> str:
+    raw = json.dumps([is_complete, created_at, story_id], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[int, str, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        is_complete, created_at, story_id = json.loads(raw)
+        return int(is_complete), str(created_at), str(story_id)
+    except Exception:
+        raise InvalidCursorError("Cursor inválido")
+
+
+class StoryIndex:
+    """
+    Índice das histórias. Cada operação abre sua própria conexão, então os
+    métodos podem ser chamados de qualquer thread (ex.: asyncio.to_thread).
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self._migrate(conn)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """Conexão curta: commit ao sair do bloco (rollback em erro) e fechamento"""
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _migrate(self, conn: sqlite3.Connection):
+        """Índices criados antes das colunas `summary` e `version`: adiciona e preenche"""
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(stories)")}
+        if "version" not in columns:
+            conn.execute("ALTER TABLE stories ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        if "summary" in columns:
+            return
+        conn.execute("ALTER TABLE stories ADD COLUMN summary TEXT")
+        rows = conn.execute("SELECT id, data FROM stories").fetchall()
+        for story_id, data in rows:
+            summary = story_summary(json.loads(data))
+            conn.execute(
+                "UPDATE stories SET summary = ? WHERE id = ?",
+                (json.dumps(summary, ensure_ascii=False), story_id),
+            )
+
+    def upsert(self, story: dict):
+        """Insere ou atualiza uma história (chamado ao gravar o story.json)"""
+        with self._connect() as conn:
+            self._upsert(conn, story)
+
+    def _upsert(self, conn: sqlite3.Connection, story: dict):
+        universe = story.get("universe")
+        universe_id = universe.get("id") if isinstance(universe, dict) else universe
+        # Incremento atômico mesmo com vários processos gravando (API e workers)
+        version = conn.execute(
+            "UPDATE meta SET value = value + 1 WHERE key = 'version' RETURNING value"
+        ).fetchone()[0]
+        conn.execute(
+            """
+            INSERT INTO stories (id, folder, created_at, is_complete, status, universe_id, title, summary, data, version)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                folder = excluded.folder,
+                created_at = excluded.created_at,
+                is_complete = excluded.is_complete,
+                status = excluded.status,
+                universe_id = excluded.universe_id,
+                title = excluded.title,
+                summary = excluded.summary,
+                data = excluded.data,
+                version = excluded.version
+            """,
+            (
+                story["id"],
+                story.get("folder") or story["id"],
+                story.get("createdAt") or "",
+                int(story_is_complete(story)),
+                story.get("status"),
+                universe_id,
+                story.get("title"),
+                json.dumps(story_summary(story), ensure_ascii=False),
+                json.dumps(story, ensure_ascii=False),
+                version,
+            ),
+        )
+
+    def get(self, story_id: str) -> Optional[dict]:
+        """Busca uma história pelo id (ou pelo nome da pasta)"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT data FROM stories WHERE id = ? UNION ALL SELECT data FROM stories WHERE folder = ? LIMIT 1",
+                (story_id, story_id),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def version(self) -> int:
+        """Versão do índice: muda a cada história gravada (ou índice reconstruído)"""
+        with self._connect() as conn:
+            return conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def lookup(self, story_id: str) -> Optional[Tuple[str, str, int]]:
+        """(id, pasta, versão) de uma história, sem carregar os dados"""
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT id, folder, version FROM stories WHERE id = ? "
+                "UNION ALL SELECT id, folder, version FROM stories WHERE folder = ? LIMIT 1",
+                (story_id, story_id),
+            ).fetchone()
+
+    def get_raw(self, story_id: str) -> Optional[str]:
+        """JSON da história como está gravado no índice (sem desserializar)"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM stories WHERE id = ?", (story_id,)).fetchone()
+        return row[0] if row else None
+
+    def list_page(
+        self,
+        limit: int = 24,
+        cursor: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+        universe_id: Optional[str] = None,
+        complete: Optional[bool] = None,
+    ) -> Tuple[List[dict], Optional[str]]:
+        """
+        Uma página da galeria, completas primeiro, depois as mais recentes, com paginação por
+        cursor (keyset): o custo não depende de quantas páginas vieram antes.
+        fields=None devolve o resumo; ["*"] a história completa; caso contrário
+        apenas os campos de primeiro nível pedidos (extraídos no próprio SQLite).
+        Retorna (histórias, próximo_cursor).
+        """
+        if fields is None:
+            column = "summary"
+        elif "*" in fields:
+            column = "data"
+        else:
+            unknown = [name for name in fields if name not in STORY_FIELDS]
+            if unknown:
+                raise InvalidFieldError(
+                    f"Campos desconhecidos: {', '.join(unknown)}. Permitidos: {', '.join(STORY_FIELDS)}"
+                )
+            pairs = ", ".join(f"'{name}', json_extract(data, '$.{name}')" for name in fields)
+            column = f"json_object({pairs})"
+
+        where, params = self._filtros(universe_id, complete)
+        if cursor:
+            where.append("(is_complete, created_at, id) < (?, ?, ?)")
+            params.extend(decode_cursor(cursor))
+
+        sql = f"SELECT {column}, is_complete, created_at, id FROM stories"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY is_complete DESC, created_at DESC, id DESC LIMIT ?"
+        params.append(limit + 1)
+
+        with self._connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            _, is_complete, created_at, story_id = rows[-1]
+            next_cursor = encode_cursor(is_complete, created_at, story_id)
+
+        stories = []
+        for data, is_complete, _, _ in rows:
+            story = json.loads(data)
+            story["is_complete"] = bool(is_complete)
+            stories.append(story)
+        return stories, next_cursor
+
+    @staticmethod
+    def _filtros(universe_id: Optional[str], complete: Optional[bool]) -> Tuple[List[str], list]:
+        where, params = [], []
+        if universe_id is not None:
+            where.append("universe_id = ?")
+            params.append(universe_id)
+        if complete is not None:
+            where.append("is_complete = ?")
+            params.append(int(complete))
+        return where, params
+
+    def count(self, universe_id: Optional[str] = None, complete: Optional[bool] = None) -> int:
+        """Total de histórias (com os mesmos filtros de list_page)"""
+        where, params = self._filtros(universe_id, complete)
+        sql = "SELECT COUNT(*) FROM stories"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        with self._connect() as conn:
+            return conn.execute(sql, params).fetchone()[0]
+
+    def rebuild(self, stories_dir: str) -> int:
+        """Recria o índice a partir das pastas de histórias existentes"""
+        indexed = 0
+        with self._connect() as conn:
+            conn.execute("DELETE FROM stories")
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+            if os.path.isdir(stories_dir):
+                for folder_name in os.listdir(stories_dir):
+                    json_path = os.path.join(stories_dir, folder_name, "story.json")
+                    if not os.path.isfile(json_path):
+                        continue
+                    try:
+                        with open(json_path, "r", encoding="utf-8") as f:
+                            story = json.load(f)
+                        story.setdefault("folder", folder_name)
+                        self._upsert(conn, story)
+                        indexed += 1
+                    except Exception as e:
+                        print(f"Erro ao indexar {json_path}: {e}")
+        return indexed
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    data_dir = os.getenv("DATA_DIR") or os.path.join(base_dir, "dados")
+
+    parser = argparse.ArgumentParser(description="Índice SQLite das histórias")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--stories-dir", default=os.path.join(base_dir, "historias"))
+    parser.add_argument("--db", default=os.path.join(data_dir, "index.sqlite3"))
+    args = parser.parse_args()
+
+    index = StoryIndex(args.db)
+    total = index.rebuild(args.stories_dir)
+    print(f"✅ {total} histórias indexadas em {args.db}")
+
+
+if __name__ == "__main__":
+    main()
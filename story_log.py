@@ -0,0 +1,146 @@
+"""
+Escrita em segundo plano dos logs de geração
+O event loop só enfileira os registros; uma thread agrupa as linhas por
+arquivo e grava em lotes (um open por arquivo a cada lote), quando o lote
+enche ou quando o registro mais antigo do lote completa flush_interval
+segundos na fila (mesmo com registros chegando sem parar). A serialização em JSON Lines também
+acontece nessa thread.
+"""
+import json
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# Valores maiores que isso são truncados no log
+MAX_VALUE_LENGTH = 2000
+
+
+def _valor(value):
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    if isinstance(value, (dict, list, tuple)):
+        # Estruturas pequenas continuam consultáveis como JSON
+        try:
+            if len(json.dumps(value, ensure_ascii=False)) <= MAX_VALUE_LENGTH:
+                return value
+        except (TypeError, ValueError):
+            pass
+    text = str(value)
+    if len(text) > MAX_VALUE_LENGTH:
+        text = text[:MAX_VALUE_LENGTH] + "... [TRUNCADO]"
+    return text
+
+
+def serializar_registro(record: dict) -> str:
+    """
+    Converte um registro (ts em epoch, demais campos livres) em uma linha
+    JSON; ts vira ISO 8601 e os valores de "data" são truncados.
+    """
+    entry = dict(record)
+    entry["ts"] = datetime.fromtimestamp(record["ts"]).isoformat(timespec="milliseconds")
+    data = record.get("data")
+    if data:
+        entry["data"] = {str(key): _valor(value) for key, value in data.items()}
+    return json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+
+
+class LogWriter:
+    """
+    Escritor em lote compartilhado por todos os StoryLogger do processo.
+    write() não bloqueia; flush() espera até tudo o que foi enfileirado
+    estar no disco (para testes e encerramento).
+    """
+
+    def __init__(self, flush_interval: float = 1.0, max_batch: int = 500):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="story-log-writer", daemon=True)
+                    self._thread.start()
+
+    def write_record(self, path: str, record: dict):
+        """Enfileira um registro para o arquivo JSON Lines `path`"""
+        self._ensure_thread()
+        self._queue.put(("record", path, record))
+
+    def write_text(self, path: str, text: str, truncate: bool = False):
+        """Enfileira texto já formatado (truncate=True recria o arquivo)"""
+        self._ensure_thread()
+        self._queue.put(("text", path, (text, truncate)))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Bloqueia até os itens enfileirados até agora estarem gravados"""
+        if self._thread is None or not self._thread.is_alive():
+            return True
+        done = threading.Event()
+        self._queue.put(("flush", None, done))
+        return done.wait(timeout)
+
+    def close(self):
+        """Grava o que falta e encerra a thread (um write posterior a reinicia)"""
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        self._queue.put(("stop", None, None))
+        thread.join()
+
+    def _run(self):
+        pending: Dict[str, List[str]] = {}
+        truncate: set = set()
+        size = 0
+        first_pending = None  # Chegada do registro mais antigo ainda não gravado
+        while True:
+            timeout = None
+            if first_pending is not None:
+                timeout = max(0.0, first_pending + self.flush_interval - time.monotonic())
+            try:
+                kind, path, payload = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                kind = None
+
+            if kind == "record":
+                try:
+                    line = serializar_registro(payload)
+                except Exception as e:
+                    line = json.dumps({"level": "ERROR", "message": f"Registro de log inválido: {e}"}) + "\n"
+                pending.setdefault(path, []).append(line)
+                size += 1
+            elif kind == "text":
+                text, recreate = payload
+                if recreate:
+                    pending[path] = []
+                    truncate.add(path)
+                pending.setdefault(path, []).append(text)
+                size += 1
+            if size and first_pending is None:
+                first_pending = time.monotonic()
+
+            expired = first_pending is not None and time.monotonic() - first_pending >= self.flush_interval
+            if kind in (None, "flush", "stop") or expired or size >= self.max_batch:
+                if size:
+                    self._write(pending, truncate)
+                pending, truncate, size, first_pending = {}, set(), 0, None
+            if kind == "flush":
+                payload.set()
+            elif kind == "stop":
+                return
+
+    @staticmethod
+    def _write(pending: Dict[str, List[str]], truncate: set):
+        for path, chunks in pending.items():
+            try:
+                with open(path, "w" if path in truncate else "a", encoding="utf-8") as f:
+                    f.writelines(chunks)
+            except OSError as e:
+                print(f"⚠️ Falha ao gravar log em {path}: {e}")
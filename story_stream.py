@@ -0,0 +1,113 @@
+"""
+Parser incremental para o JSON da história (schema `Story`)
+Recebe os pedaços de texto do streaming do Gemini e avisa assim que cada
+campo de primeiro nível ou cada elemento de `parts` fica completo.
+"""
+import json
+from typing import Any, List, Tuple
+
+# Eventos emitidos pelo parser:
+#   ("field", nome_do_campo, valor)  -> campo de primeiro nível completo
+#   ("part", indice, [texto, prompt]) -> elemento de `parts` completo (índice a partir de 0)
+StoryStreamEvent = Tuple[str, Any, Any]
+
+
+class StoryStreamParser:
+    """
+    Scanner de JSON que mantém apenas o estado mínimo (pilha de containers,
+    string/escape) e nunca re-lê o buffer inteiro a cada pedaço recebido.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.fields = {}
+        self.parts: List[list] = []
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        # Estado do objeto raiz
+        self._expect_key = True
+        self._key_start = None
+        self._key = None
+        self._value_start = None
+        # Estado do array `parts`
+        self._part_start = None
+
+    def feed(self, chunk: str) -> List[StoryStreamEvent]:
+        """Adiciona texto ao buffer e retorna os eventos completados por ele."""
+        if not chunk:
+            return []
+        self.buffer += chunk
+        events = []
+        buf = self.buffer
+
+        for i in range(self._pos, len(buf)):
+            ch = buf[i]
+            depth = len(self._stack)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if depth == 1:
+                        if self._key_start is not None:
+                            self._key = json.loads(buf[self._key_start:i + 1])
+                            self._key_start = None
+                        elif self._value_start is not None:
+                            self._complete_field(buf[self._value_start:i + 1], events)
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                if depth == 1:
+                    if self._expect_key:
+                        self._key_start = i
+                    elif self._value_start is None:
+                        self._value_start = i
+            elif ch in "{[":
+                if depth == 1 and not self._expect_key and self._value_start is None:
+                    self._value_start = i
+                if depth == 2 and self._key == "parts" and ch == "[":
+                    self._part_start = i
+                self._stack.append(ch)
+            elif ch in "}]":
+                if self._stack:
+                    self._stack.pop()
+                depth = len(self._stack)
+                if depth == 2 and self._key == "parts" and self._part_start is not None:
+                    part = json.loads(buf[self._part_start:i + 1])
+                    self.parts.append(part)
+                    events.append(("part", len(self.parts) - 1, part))
+                    self._part_start = None
+                elif depth == 1 and self._value_start is not None:
+                    self._complete_field(buf[self._value_start:i + 1], events)
+                elif depth == 0 and self._value_start is not None:
+                    # Valor primitivo encerrado pelo fim do objeto raiz
+                    self._complete_field(buf[self._value_start:i].strip(), events)
+            elif depth == 1:
+                if ch == ":":
+                    self._expect_key = False
+                elif ch == ",":
+                    if self._value_start is not None:
+                        self._complete_field(buf[self._value_start:i].strip(), events)
+                    self._expect_key = True
+                elif not ch.isspace() and not self._expect_key and self._value_start is None:
+                    # Início de número / true / false / null
+                    self._value_start = i
+
+        self._pos = len(buf)
+        return events
+
+    def _complete_field(self, raw: str, events: List[StoryStreamEvent]):
+        self._value_start = None
+        self._expect_key = True
+        if self._key is None:
+            return
+        value = json.loads(raw)
+        self.fields[self._key] = value
+        events.append(("field", self._key, value))
+        self._key = None
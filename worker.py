@@ -0,0 +1,69 @@
+"""
+Worker de geração de histórias
+Consome a fila de jobs (dados/jobs.sqlite3) fora do processo da API. Use com
+JOB_RUNNER=external para que a API apenas enfileire e transmita o progresso.
+
+    python worker.py [--processes N]
+
+Cada processo roda até JOB_CONCURRENCY jobs ao mesmo tempo. Ao receber
+SIGINT/SIGTERM, os jobs em andamento voltam para a fila e são retomados do
+último checkpoint por qualquer worker.
+"""
+import signal
+import asyncio
+import argparse
+import multiprocessing
+
+
+async def _executar_worker():
+    import api
+
+    worker = api.criar_job_worker()
+    loop = asyncio.get_running_loop()
+    parar = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, parar.set)
+
+    print(f"👷 Worker {worker.worker_id} aguardando jobs (até {worker.concurrency} simultâneos)")
+    worker_task = asyncio.create_task(worker.run())
+    await parar.wait()
+
+    print(f"⏹️ Worker {worker.worker_id} encerrando; {len(worker.running)} jobs voltam para a fila")
+    await worker.stop()
+    await asyncio.gather(worker_task, return_exceptions=True)
+    api.image_processor.shutdown()
+    await asyncio.to_thread(api.log_writer.close)
+
+
+def run_worker():
+    asyncio.run(_executar_worker())
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Worker da fila de geração de histórias")
+    parser.add_argument("--processes", type=int, default=1, help="Número de processos de worker")
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        run_worker()
+        return
+
+    # spawn: cada worker inicia limpo (cliente Gemini, agendadores e pool próprios)
+    ctx = multiprocessing.get_context("spawn")
+    processes = [ctx.Process(target=run_worker, name=f"worker-{i + 1}") for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # O SIGINT também chega aos filhos; aguarda eles devolverem os jobs à fila
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()